@@ -1,6 +1,30 @@
+from django.db.models.signals import post_migrate
+from django.db import connections
 from django.apps import AppConfig
 
+'''
+    Create the trigram indexes used to search inventory items on PostgreSQL
+    -----------------------------------------------------------------------
+    The indexes need the pg_trgm extension and a GIN operator class that have no equivalent on other databases, so
+    they are created after migrating instead of being declared on the models.
+'''
+def create_search_indexes(sender, using, **kwargs):
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for model in [sender.get_model('Material'), sender.get_model('Tool')]:
+            table = model._meta.db_table
+            for field in model.SEARCH_FIELDS:
+                column = model._meta.get_field(field).column
+                name = connection.ops.quote_name(f'{table}_{column}_trgm_idx')
+                cursor.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {connection.ops.quote_name(table)} USING gin ({connection.ops.quote_name(column)} gin_trgm_ops)')
+
 
 class InventoryConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'inventory'
+
+    def ready(self):
+        post_migrate.connect(create_search_indexes, sender=self)
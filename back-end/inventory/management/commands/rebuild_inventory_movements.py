@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand
+from inventory.models import MaterialStock, ToolStock
+from django.db import transaction
+import heapq
+
+class Command(BaseCommand):
+    help = 'Rebuilds the material and tool movement journals and their running balances from the purchase and order history.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-b', '--batch-size', type=int, default=1000, help='Define how many movements are read and written per batch.')
+
+    def handle(self, *args, **kwargs):
+        batch_size = kwargs['batch_size']
+        recorded = 0
+
+        for stock_model in [MaterialStock, ToolStock]:
+            movement_model = stock_model.movement_model
+            with transaction.atomic():
+                movement_model.objects.all().delete()
+                # Merge the purchase and order lines of every item in (item, date) order, purchases first on the same date
+                movements = heapq.merge(*self._get_line_movements(stock_model, batch_size), key=lambda movement: movement[:2])
+                batch = []
+                item_id = None
+                balance = 0
+                for movement_item_id, date, kind, quantity in movements:
+                    if movement_item_id != item_id:
+                        item_id = movement_item_id
+                        balance = 0
+                    balance += quantity
+                    batch.append(movement_model(item_id=item_id, date=date, kind=kind, quantity=quantity, balance=balance))
+                    if len(batch) >= batch_size:
+                        recorded += len(movement_model.objects.bulk_create(batch))
+                        batch = []
+                recorded += len(movement_model.objects.bulk_create(batch))
+
+        # Indicate rebuild is complete
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {recorded} inventory movements.'))
+
+    def _get_line_movements(self, stock_model, batch_size):
+        item_model = stock_model._meta.get_field('item').related_model
+        streams = []
+        for relation in stock_model.lines:
+            line_model = item_model._meta.get_field(relation).related_model
+            for kind, sign in [('purchased', 1), (stock_model.consumed, -1)]:
+                field = line_model.STOCK_COUNTS.get(kind)
+                if field is None:
+                    continue
+                date_field = f'{line_model.STOCK_PARENT}__date'
+                lines = line_model.objects.filter(**{f'{field}__gt': 0}).order_by('inventory_item', date_field, 'id').values_list('inventory_item', date_field, field)
+                streams.append(self._movements(lines.iterator(chunk_size=batch_size), kind, sign))
+        return streams
+
+    def _movements(self, lines, kind, sign):
+        for item_id, date, quantity in lines:
+            yield item_id, date, kind, sign * quantity
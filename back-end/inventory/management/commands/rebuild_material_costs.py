@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from inventory.models import Material, MaterialStock
+from django.db import transaction
+
+class Command(BaseCommand):
+    help = 'Rebuilds the material cost layers and the latest, average and FIFO unit costs from the purchase and order history.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-b', '--batch-size', type=int, default=500, help='Define how many materials are read per batch.')
+
+    def handle(self, *args, **kwargs):
+        batch_size = kwargs['batch_size']
+        rebuilt = 0
+
+        # Replay each material in its own transaction so the stock level rows are only locked briefly
+        for material_id in Material.objects.order_by('pk').values_list('pk', flat=True).iterator(chunk_size=batch_size):
+            with transaction.atomic():
+                MaterialStock.rebuild_costs(material_id)
+            rebuilt += 1
+
+        # Indicate rebuild is complete
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt costs for {rebuilt} materials.'))
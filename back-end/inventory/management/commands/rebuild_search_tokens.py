@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from inventory.models import Material, Tool
+from django.db import transaction
+
+class Command(BaseCommand):
+    help = 'Rebuilds the search token index of every material and tool, such as after items were written in bulk.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-b', '--batch-size', type=int, default=1000, help='Define how many search tokens are written per batch.')
+
+    def handle(self, *args, **kwargs):
+        batch_size = kwargs['batch_size']
+        indexed = 0
+
+        for model in [Material, Tool]:
+            search_model = model.get_search_model()
+            with transaction.atomic():
+                search_model.objects.all().delete()
+                batch = []
+                for item in model.objects.only('pk', *model.SEARCH_FIELDS).iterator(chunk_size=batch_size):
+                    batch.extend(search_model(item=item, token=token) for token in search_model.tokenize(*(getattr(item, field) for field in model.SEARCH_FIELDS)))
+                    indexed += 1
+                    if len(batch) >= batch_size:
+                        search_model.objects.bulk_create(batch)
+                        batch = []
+                search_model.objects.bulk_create(batch)
+
+        # Indicate rebuild is complete
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt search tokens for {indexed} inventory items.'))
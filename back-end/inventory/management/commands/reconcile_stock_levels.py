@@ -0,0 +1,55 @@
+from inventory.models import Material, MaterialStock, Tool, ToolStock
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+class Command(BaseCommand):
+    help = 'Rebuilds the material and tool stock levels from their purchase and order history and reconciles any that have drifted.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-b', '--batch-size', type=int, default=500, help='Define how many inventory items are reconciled per batch.')
+        parser.add_argument('-d', '--dry-run', action='store_true', help='Report inventory items with drifted stock levels without updating them.')
+
+    def handle(self, *args, **kwargs):
+        batch_size = kwargs['batch_size']
+        dry_run = kwargs['dry_run']
+        checked = 0
+        reconciled = 0
+
+        for item_model, stock_model in [(Material, MaterialStock), (Tool, ToolStock)]:
+            created = []
+            changed = []
+            # Calculate the stock of every item from its history in one query per chunk
+            items = stock_model.with_history(item_model.objects.select_related('stock')).order_by('pk')
+            for item in items.iterator(chunk_size=batch_size):
+                checked += 1
+                counts = {count: getattr(item, f'history_{count}') for count in stock_model.COUNTS}
+                try:
+                    stock = item.stock
+                except stock_model.DoesNotExist:
+                    created.append(stock_model(item=item, **counts))
+                else:
+                    if all(getattr(stock, count) == amount for count, amount in counts.items()):
+                        continue
+                    for count, amount in counts.items():
+                        setattr(stock, count, amount)
+                    changed.append(stock)
+                if dry_run:
+                    self.stdout.write(self.style.WARNING(f'{item_model.__name__} {item.pk} stock level has drifted.'))
+                if len(created) + len(changed) >= batch_size:
+                    reconciled += self._update_stock(stock_model, created, changed, dry_run)
+                    created = []
+                    changed = []
+            reconciled += self._update_stock(stock_model, created, changed, dry_run)
+
+        # Indicate reconciliation is complete
+        if dry_run:
+            self.stdout.write(self.style.SUCCESS(f'{reconciled} of {checked} inventory items have drifted stock levels.'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Reconciled stock levels for {reconciled} of {checked} inventory items.'))
+
+    def _update_stock(self, stock_model, created, changed, dry_run):
+        if not dry_run:
+            with transaction.atomic():
+                stock_model.objects.bulk_create(created)
+                stock_model.objects.bulk_update(changed, stock_model.COUNTS)
+        return len(created) + len(changed)
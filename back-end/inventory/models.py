@@ -1,41 +1,231 @@
-from django.core.validators import MinLengthValidator, MaxLengthValidator
+from django.core.validators import MinLengthValidator, MaxLengthValidator, MinValueValidator
+from django.db.models import Case, F, Max, OuterRef, Q, Subquery, Sum, Value, When, Window
+from django.db.models.functions import Coalesce, FirstValue, Greatest
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, models, transaction
 from utils.mixins import AtomicOperationsMixin
-from django.db import models
-from decimal import Decimal
+from django.conf import settings
+from collections import Counter
+from decimal import localcontext
+from functools import reduce
+from utils import money
+import unicodedata
+import operator
+import re
+
+''' Queryset for inventory items with support for database calculated stock and unit cost '''
+class InventoryItemQuerySet(models.QuerySet):
+
+    '''
+        Annotate the available quantity and unit cost of each inventory item
+        ---------------------------------------------------------------------
+        The quantity on hand is read from the stock level, or calculated from the item history when it has no stock
+        level yet, and the latest purchase is read with subqueries so a list of items is fetched in a single query.
+        Items whose stock level keeps costs also get the unit cost of the active costing strategy.
+    '''
+    def with_stock(self):
+        stock_model = self.model.get_stock_model()
+        purchase_model = self.model._meta.get_field(stock_model.lines[0]).related_model
+        latest_purchase = purchase_model.objects.filter(inventory_item=OuterRef('pk')).order_by('-id')
+        queryset = self.with_on_hand().annotate(
+            latest_purchase_cost=Subquery(latest_purchase.values('cost')[:1]),
+            latest_purchase_quantity=Subquery(latest_purchase.values('quantity')[:1]),
+        )
+        cost_field = stock_model.get_cost_field()
+        if cost_field:
+            queryset = queryset.annotate(stock_unit_cost=F(f'stock__{cost_field}'))
+        return queryset
+
+    ''' Annotate the quantity on hand of each inventory item from its stock level, or its history when it has no stock level yet '''
+    def with_on_hand(self):
+        stock_model = self.model.get_stock_model()
+        history = stock_model.get_history_expressions()
+        return self.annotate(stock_on_hand=Coalesce(F('stock__on_hand'), history['purchased'] - history[stock_model.consumed]))
+
+    '''
+        Annotate the quantity of each inventory item consumed by orders dated between two dates
+        ---------------------------------------------------------------------------------------
+        Materials are consumed when they are used and tools when they are broken, so the usage adds up the order line
+        field that the stock level takes off the quantity on hand.
+    '''
+    def with_usage(self, start_date, end_date):
+        stock_model = self.model.get_stock_model()
+        order_model = self.model._meta.get_field(stock_model.lines[1]).related_model
+        date_field = f'{order_model.STOCK_PARENT}__date'
+        usage = order_model.objects.filter(**{'inventory_item': OuterRef('pk'), f'{date_field}__gte': start_date, f'{date_field}__lte': end_date}).order_by().values('inventory_item').annotate(total=Sum(order_model.STOCK_COUNTS[stock_model.consumed])).values('total')
+        return self.annotate(recent_usage=Coalesce(Subquery(usage), Value(0)))
+
+    ''' Filter the inventory items with a reorder point whose quantity on hand is at or below it '''
+    def low_stock(self):
+        return self.filter(reorder_point__gt=0).with_on_hand().filter(stock_on_hand__lte=F('reorder_point'))
+
+    '''
+        Read the quantity on hand and costs that value each inventory item, in a single query of values
+        -----------------------------------------------------------------------------------------------
+        The purchase lines are joined to their items and a FIRST_VALUE window over the lines of each item, newest
+        first, picks the cost and quantity of its latest purchase, with DISTINCT folding the lines back to one row per
+        item. Items whose stock level keeps costs also return the unit cost of the active costing strategy. Materials
+        and tools return the same columns, so both can be read with one union.
+    '''
+    def with_valuation(self):
+        stock_model = self.model.get_stock_model()
+        relation = stock_model.lines[0]
+        cost_field = stock_model.get_cost_field()
+        has_size = any(field.name == 'size' for field in self.model._meta.concrete_fields)
+        latest_purchase = lambda field: Window(FirstValue(f'{relation}__{field}'), partition_by=[F('pk')], order_by=F(f'{relation}__id').desc())
+        return self.annotate(
+            item_type=Value(self.model._meta.model_name),
+            item_size=F('size') if has_size else Value(None, output_field=models.CharField()),
+            on_hand=Coalesce(F('stock__on_hand'), Value(0)),
+            stock_unit_cost=F(f'stock__{cost_field}') if cost_field else Value(None, output_field=models.DecimalField()),
+            latest_purchase_cost=latest_purchase('cost'),
+            latest_purchase_quantity=latest_purchase('quantity'),
+        ).values('item_type', 'id', 'name', 'item_size', 'on_hand', 'stock_unit_cost', 'latest_purchase_cost', 'latest_purchase_quantity').order_by().distinct()
+
+    '''
+        Create or update inventory items in bulk, matched on the fields of a unique constraint
+        ---------------------------------------------------------------------------------------
+        Items are written in batches of INSERT ... ON CONFLICT DO UPDATE, updating update_fields of the items that
+        already exist. The stock levels and search tokens that save creates one item at a time are then written in
+        bulk too. Returns the saved items with their primary keys.
+    '''
+    def bulk_upsert(self, items, unique_fields, update_fields, batch_size=500):
+        with transaction.atomic():
+            if update_fields:
+                self.bulk_create(items, batch_size=batch_size, update_conflicts=True, unique_fields=unique_fields, update_fields=update_fields)
+            else:
+                self.bulk_create(items, batch_size=batch_size, ignore_conflicts=True)
+            # Upserted rows do not return their primary keys on every database, so the items are read back by their keys
+            keys = {tuple(getattr(item, field) for field in unique_fields) for item in items}
+            candidates = self.filter(**{f'{unique_fields[0]}__in': {key[0] for key in keys}})
+            saved = [item for item in candidates if tuple(getattr(item, field) for field in unique_fields) in keys]
+            stock_model = self.model.get_stock_model()
+            stock_model.objects.bulk_create([stock_model(item=item) for item in saved], batch_size=batch_size, ignore_conflicts=True)
+            self.model.get_search_model().index_items(saved)
+            return saved
+
+    '''
+        Search inventory items by their SEARCH_FIELDS, best matches first
+        -----------------------------------------------------------------
+        On PostgreSQL items are matched and ranked by trigram word similarity using the trigram indexes created by the
+        app, so misspelt words still match. Other databases use the search token index instead.
+    '''
+    def search(self, query):
+        if connections[self.db].vendor == 'postgresql':
+            return self.search_trigrams(query)
+        return self.search_tokens(query)
+
+    def search_trigrams(self, query):
+        # Imported here as it needs the PostgreSQL driver
+        from django.contrib.postgres.search import TrigramWordSimilarity
+        fields = self.model.SEARCH_FIELDS
+        matches = reduce(operator.or_, [Q(**{f'{field}__trigram_word_similar': query}) for field in fields])
+        rank = Greatest(*[Coalesce(TrigramWordSimilarity(query, field), Value(0.0)) for field in fields])
+        return self.filter(matches).annotate(search_rank=rank).order_by('-search_rank', 'name', 'pk')
+
+    '''
+        Search inventory items with the search token index
+        --------------------------------------------------
+        Every word of the query must start a word of the item. Each word is found with an index range scan of the
+        tokens, and items matching whole words, then items whose name starts with the query, are ranked first.
+    '''
+    def search_tokens(self, query):
+        search_model = self.model.get_search_model()
+        tokens = search_model.tokenize(query)
+        if not tokens:
+            return self.none()
+        prefixes = [Q(search_tokens__token__gte=token, search_tokens__token__lt=token + search_model.PREFIX_END) for token in tokens]
+        matched = [Max(Case(When(prefix, then=1), default=0)) for prefix in prefixes]
+        exact = [Max(Case(When(search_tokens__token=token, then=1), default=0)) for token in tokens]
+        return self.filter(reduce(operator.or_, prefixes)).annotate(
+            search_matched=sum(matched[1:], matched[0]),
+            search_exact=sum(exact[1:], exact[0]),
+            search_name_prefix=Case(When(name__istartswith=query.strip(), then=1), default=0),
+        ).filter(search_matched=len(tokens)).annotate(search_rank=F('search_exact') + F('search_name_prefix')).order_by('-search_rank', 'name', 'pk')
 
 ''' Base model for inventory items with shared properties '''
 class InventoryItemBase(models.Model):
+    # Quantity on hand at or below which the item is reported as low on stock, 0 to never report it
+    reorder_point = models.PositiveIntegerField(default=0, validators=[MinValueValidator(0)])
+
+    objects = InventoryItemQuerySet.as_manager()
+
     # Ensures model is abstract and not created in database
     class Meta:
         abstract = True
 
-    ''' Dynamically calculate available quantity based on purchases and orders '''
+    ''' Return the stock level model kept for this kind of inventory item '''
+    @classmethod
+    def get_stock_model(cls):
+        return cls._meta.get_field('stock').related_model
+
+    ''' Return the search token model kept for this kind of inventory item '''
+    @classmethod
+    def get_search_model(cls):
+        return cls._meta.get_field('search_tokens').related_model
+
+    ''' Read the available quantity from the with_stock annotation or the stock level, rebuilding it from history when it is missing '''
     @property
     def available_quantity(self):
-        total_purchased = self.items_purchased.all().aggregate(total=models.Sum('quantity'))['total'] or 0
-        if hasattr(self, 'items_used'):
-            total_used = self.items_used.all().aggregate(total=models.Sum('quantity'))['total'] or 0
-        elif hasattr(self, 'items_broken'):
-            total_used = self.items_broken.all().aggregate(total=models.Sum('quantity_broken'))['total'] or 0
-        else:
-            total_used = 0
-        return max(total_purchased - total_used, 0)
+        if hasattr(self, 'stock_on_hand'):
+            return max(self.stock_on_hand, 0)
+        stock_model = self.get_stock_model()
+        try:
+            on_hand = self.stock.on_hand
+        except stock_model.DoesNotExist:
+            on_hand = stock_model.rebuild(self.pk).on_hand
+        return max(on_hand, 0)
 
-    ''' Dynamically calculate unit cost based on latest purchase '''
+    ''' Override save method to create the stock level of new inventory items and index their search tokens '''
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            adding = self._state.adding
+            super().save(*args, **kwargs)
+            if adding:
+                self.get_stock_model().objects.get_or_create(item=self)
+            self.get_search_model().index(self)
+
+    '''
+        Read the unit cost of the inventory item
+        ----------------------------------------
+        Items whose stock level keeps costs read the cost of the active costing strategy from it. Other items, and
+        items that have not been costed yet, are costed by their latest purchase. Both are read from the with_stock
+        annotations when present.
+    '''
     @property
     def unit_cost(self):
-        latest_purchase = self.items_purchased.all().order_by('-id').first()
-        if latest_purchase and latest_purchase.quantity > 0:
-            return Decimal(float(latest_purchase.cost / latest_purchase.quantity)).quantize(Decimal('0.01'))
-        return Decimal(0.0).quantize(Decimal('0.01'))
+        stock_model = self.get_stock_model()
+        cost_field = stock_model.get_cost_field()
+        if cost_field:
+            try:
+                unit_cost = self.stock_unit_cost if hasattr(self, 'stock_unit_cost') else getattr(self.stock, cost_field)
+            except stock_model.DoesNotExist:
+                unit_cost = None
+            if unit_cost is not None:
+                return self.calculate_unit_cost(unit_cost, None, None)
+        if hasattr(self, 'latest_purchase_quantity'):
+            cost, quantity = self.latest_purchase_cost, self.latest_purchase_quantity
+        else:
+            latest_purchase = getattr(self, stock_model.lines[0]).order_by('-id').first()
+            cost, quantity = (latest_purchase.cost, latest_purchase.quantity) if latest_purchase else (None, None)
+        return self.calculate_unit_cost(None, cost, quantity)
+
+    ''' Calculate a unit cost from the unit cost kept by the stock level, or else from the cost and quantity of the latest purchase '''
+    @staticmethod
+    def calculate_unit_cost(stock_unit_cost, latest_purchase_cost, latest_purchase_quantity):
+        if stock_unit_cost is not None:
+            return money.round_money(stock_unit_cost)
+        if latest_purchase_quantity and latest_purchase_quantity > 0:
+            return money.round_money(money.to_decimal(latest_purchase_cost) / latest_purchase_quantity)
+        return money.round_money(0)
 
 ''' Model for materials '''
 class Material(AtomicOperationsMixin, InventoryItemBase):
     name = models.CharField(max_length=255, validators=[MinLengthValidator(2), MaxLengthValidator(255)])
     description = models.CharField(blank=True, null=True, max_length=500, validators=[MaxLengthValidator(500)])
     size = models.CharField(max_length=255, validators=[MinLengthValidator(2), MaxLengthValidator(255)])
-    items_purchased = models.ManyToManyField('purchase.PurchaseMaterial', related_name='materials')
-    items_used = models.ManyToManyField('order.OrderMaterial', related_name='materials')
+
+    SEARCH_FIELDS = ['name', 'size', 'description']
 
     class Meta:
         constraints = [ models.UniqueConstraint(fields=['name', 'size'], name='unique_material') ]
@@ -44,5 +234,562 @@ class Material(AtomicOperationsMixin, InventoryItemBase):
 class Tool(AtomicOperationsMixin, InventoryItemBase):
     name = models.CharField(max_length=255, validators=[MinLengthValidator(2), MaxLengthValidator(255)])
     description = models.CharField(blank=True, null=True, max_length=500, validators=[MaxLengthValidator(500)])
-    items_purchased = models.ManyToManyField('purchase.PurchaseTool', related_name='tools')
-    items_broken = models.ManyToManyField('order.OrderTool', related_name='tools')
+
+    SEARCH_FIELDS = ['name', 'description']
+
+'''
+    Base model for the search token index of an inventory item
+    ----------------------------------------------------------
+    Holds each word of the SEARCH_FIELDS of an item in lower case without accents, so a word of a query is found by an
+    index range scan over the tokens instead of a LIKE over every item. The tokens of an item are replaced whenever it
+    is saved.
+'''
+class InventorySearchTokenBase(models.Model):
+    token = models.CharField(max_length=64)
+
+    PREFIX_END = '\uffff'
+
+    # Ensures model is abstract and not created in database
+    class Meta:
+        abstract = True
+        indexes = [ models.Index(fields=['token', 'item'], name='%(class)s_token_idx') ]
+
+    ''' Split text into its distinct lower case words without accents '''
+    @classmethod
+    def tokenize(cls, *values):
+        text = unicodedata.normalize('NFKD', ' '.join(value for value in values if value)).encode('ascii', 'ignore').decode('ascii').lower()
+        return sorted({token[:cls._meta.get_field('token').max_length] for token in re.findall(r'[a-z0-9]+', text)})
+
+    ''' Replace the search tokens of an inventory item with the words of its searchable fields '''
+    @classmethod
+    def index(cls, item):
+        cls.index_items([item])
+
+    ''' Replace the search tokens of inventory items in bulk '''
+    @classmethod
+    def index_items(cls, items, batch_size=1000):
+        cls.objects.filter(item__in=[item.pk for item in items]).delete()
+        tokens = [cls(item=item, token=token) for item in items for token in cls.tokenize(*(getattr(item, field) for field in item.SEARCH_FIELDS))]
+        cls.objects.bulk_create(tokens, batch_size=batch_size)
+
+''' Model for the search tokens of a material '''
+class MaterialSearchToken(InventorySearchTokenBase):
+    item = models.ForeignKey(Material, on_delete=models.CASCADE, related_name='search_tokens')
+
+''' Model for the search tokens of a tool '''
+class ToolSearchToken(InventorySearchTokenBase):
+    item = models.ForeignKey(Tool, on_delete=models.CASCADE, related_name='search_tokens')
+
+'''
+    Base model for the stock movement journal of an inventory item
+    ----------------------------------------------------------------
+    Movements are only ever added. Each one stores the change to the quantity on hand and the balance on hand after
+    it in (date, id) order, so the stock on any date is read from the last movement on or before that date.
+'''
+class InventoryMovementBase(models.Model):
+    class KIND_CHOICES(models.TextChoices):
+        PURCHASED = 'purchased', 'Purchased'
+        USED = 'used', 'Used'
+        BROKEN = 'broken', 'Broken'
+
+    date = models.DateField()
+    kind = models.CharField(max_length=9, choices=KIND_CHOICES.choices)
+    quantity = models.IntegerField()
+    balance = models.IntegerField()
+
+    # Ensures model is abstract and not created in database
+    class Meta:
+        abstract = True
+        indexes = [ models.Index(fields=['item', 'date', 'id'], name='%(class)s_item_date_idx') ]
+
+    '''
+        Add a movement to the journal of an inventory item
+        --------------------------------------------------
+        The balance continues from the last movement on or before the date, and movements already recorded after
+        the date are moved by the same quantity, so back dated purchases and orders keep every balance correct.
+    '''
+    @classmethod
+    def record(cls, item_id, date, kind, quantity):
+        previous = cls.objects.filter(item_id=item_id, date__lte=date).order_by('-date', '-id').values_list('balance', flat=True).first()
+        movement = cls.objects.create(item_id=item_id, date=date, kind=kind, quantity=quantity, balance=(previous or 0) + quantity)
+        cls.objects.filter(item_id=item_id, date__gt=date).update(balance=F('balance') + quantity)
+        return movement
+
+    ''' Build the expression reading the balance on hand of the inventory item in the outer query on a date '''
+    @classmethod
+    def balance_on(cls, date):
+        latest = cls.objects.filter(item=OuterRef('pk'), date__lte=date).order_by('-date', '-id').values('balance')[:1]
+        return Coalesce(Subquery(latest), Value(0))
+
+''' Model for the stock movements of a material '''
+class MaterialMovement(InventoryMovementBase):
+    item = models.ForeignKey(Material, on_delete=models.CASCADE, related_name='movements')
+
+''' Model for the stock movements of a tool '''
+class ToolMovement(InventoryMovementBase):
+    item = models.ForeignKey(Tool, on_delete=models.CASCADE, related_name='movements')
+
+''' Raised when a reservation takes more of an inventory item than is on hand '''
+class InsufficientStock(Exception):
+
+    def __init__(self, available, requested):
+        self.available = max(available, 0)
+        self.requested = requested
+        super().__init__(f'Only {self.available} in stock, {requested} requested.')
+
+'''
+    Base model for the stock level of an inventory item
+    ---------------------------------------------------
+    Stores the purchased, used and broken counts and the quantity on hand, kept up to date in the same transaction
+    by every purchase and order line so reading stock never aggregates the purchase and order history.
+    lines: reverse relations from the inventory item to the purchase and order lines that move its stock
+    consumed: the count that is taken off the quantity on hand, used for materials and broken for tools
+    movement_model: the journal the changes to the quantity on hand are recorded in
+'''
+class StockLevelBase(models.Model):
+    purchased = models.IntegerField(default=0)
+    used = models.IntegerField(default=0)
+    broken = models.IntegerField(default=0)
+    on_hand = models.IntegerField(default=0)
+
+    COUNTS = ['purchased', 'used', 'broken', 'on_hand']
+
+    # Ensures model is abstract and not created in database
+    class Meta:
+        abstract = True
+
+    '''
+        Add stock changes to the stock level of an inventory item
+        ---------------------------------------------------------
+        changes: amounts to add to the purchased, used and broken counts, negative to take them away
+        date: the purchase or order date the changes are recorded in the movement journal on
+        reserve: reject changes that take more off the quantity on hand than is left, raising InsufficientStock
+        The counts are changed with a single UPDATE of F expressions so concurrent changes are never lost, and the
+        stock level row stays locked until the transaction ends so movements of an item are recorded in turn.
+    '''
+    @classmethod
+    def apply_changes(cls, item_id, changes, date, reserve=False):
+        changes = {count: amount for count, amount in changes.items() if amount}
+        changes['on_hand'] = changes.get('purchased', 0) - changes.get(cls.consumed, 0)
+        updates = {count: F(count) + amount for count, amount in changes.items() if amount}
+        stock = cls.objects.filter(item_id=item_id)
+        if reserve and changes['on_hand'] < 0:
+            # Take the stock only when enough is on hand, checked by the same conditional UPDATE so concurrent reservations can not oversell
+            stock = stock.filter(on_hand__gte=-changes['on_hand'])
+        if updates and not stock.update(**updates):
+            on_hand = cls.objects.filter(item_id=item_id).values_list('on_hand', flat=True).first()
+            if on_hand is not None:
+                raise InsufficientStock(on_hand, -changes['on_hand'])
+            # Items without a stock level yet are rebuilt from their history, which already includes these changes
+            on_hand = cls.rebuild(item_id).on_hand
+            if reserve and changes['on_hand'] < 0 and on_hand < 0:
+                raise InsufficientStock(on_hand - changes['on_hand'], -changes['on_hand'])
+        cls.record_movements(item_id, changes, date)
+
+    ''' Record the changes to the quantity on hand in the movement journal of an inventory item '''
+    @classmethod
+    def record_movements(cls, item_id, changes, date):
+        for kind, sign in [('purchased', 1), (cls.consumed, -1)]:
+            if changes.get(kind):
+                cls.movement_model.record(item_id, date, kind, sign * changes[kind])
+
+    ''' Build the expressions calculating the purchased, used and broken counts of an inventory item from its history '''
+    @classmethod
+    def get_history_expressions(cls):
+        item_model = cls._meta.get_field('item').related_model
+        counts = {count: [] for count in cls.COUNTS if count != 'on_hand'}
+        for relation in cls.lines:
+            line_model = item_model._meta.get_field(relation).related_model
+            for count, field in line_model.STOCK_COUNTS.items():
+                lines = line_model.objects.filter(inventory_item=OuterRef('pk')).order_by().values('inventory_item').annotate(total=Sum(field)).values('total')
+                counts[count].append(Coalesce(Subquery(lines), Value(0)))
+        return {count: sum(expressions[1:], expressions[0]) if expressions else Value(0) for count, expressions in counts.items()}
+
+    ''' Annotate inventory items with the stock counts calculated from their purchase and order history '''
+    @classmethod
+    def with_history(cls, items):
+        history = {f'history_{count}': expression for count, expression in cls.get_history_expressions().items()}
+        return items.annotate(**history).annotate(history_on_hand=F('history_purchased') - F(f'history_{cls.consumed}'))
+
+    ''' Rebuild the stock level of an inventory item from its purchase and order history '''
+    @classmethod
+    def rebuild(cls, item_id):
+        item_model = cls._meta.get_field('item').related_model
+        history = cls.with_history(item_model.objects.filter(pk=item_id)).values(*[f'history_{count}' for count in cls.COUNTS]).first()
+        counts = {count: history[f'history_{count}'] for count in cls.COUNTS} if history else {}
+        stock, _ = cls.objects.update_or_create(item_id=item_id, defaults=counts)
+        return stock
+
+    ''' Lock and return the stock level of an inventory item, rebuilding it when it is missing '''
+    @classmethod
+    def lock(cls, item_id):
+        stock = cls.objects.select_for_update().filter(item_id=item_id).first()
+        return stock if stock is not None else cls.rebuild(item_id)
+
+    ''' Return the stock level field holding the unit cost of the active costing strategy, or None when costs are not kept '''
+    @classmethod
+    def get_cost_field(cls):
+        return None
+
+'''
+    Model for the stock level of a material
+    ---------------------------------------
+    Also keeps the current unit cost of the material under each costing strategy, so reading a cost is a single
+    column of a row that is already fetched with the stock:
+    latest_cost: the unit cost of the latest purchase
+    average_cost: the weighted moving average unit cost of the purchases, kept as stock is received
+    fifo_cost: the unit cost of the oldest cost layer with stock remaining
+    The costs are empty until the material is first purchased, and the active strategy is set by INVENTORY_COSTING.
+'''
+class MaterialStock(StockLevelBase):
+    item = models.OneToOneField(Material, on_delete=models.CASCADE, primary_key=True, related_name='stock')
+    latest_cost = models.DecimalField(max_digits=16, decimal_places=6, null=True, blank=True)
+    average_cost = models.DecimalField(max_digits=16, decimal_places=6, null=True, blank=True)
+    fifo_cost = models.DecimalField(max_digits=16, decimal_places=6, null=True, blank=True)
+
+    lines = ['purchse_materials', 'order_materials']
+    consumed = 'used'
+    movement_model = MaterialMovement
+
+    COSTINGS = ['latest', 'average', 'fifo']
+    COST_FIELDS = [f'{costing}_cost' for costing in COSTINGS]
+
+    @classmethod
+    def get_cost_field(cls):
+        costing = settings.INVENTORY_COSTING
+        if costing not in cls.COSTINGS:
+            raise ImproperlyConfigured(f'INVENTORY_COSTING must be one of {", ".join(cls.COSTINGS)}, not {costing!r}.')
+        return f'{costing}_cost'
+
+    ''' Return the unit cost of a purchase line, zero when nothing was purchased '''
+    @staticmethod
+    def get_line_unit_cost(cost, quantity):
+        with localcontext(money.MONEY_CONTEXT):
+            return money.to_decimal(cost) / quantity if quantity else money.ZERO
+
+    '''
+        Receive a new purchase line into the cost layers and costs of its material
+        --------------------------------------------------------------------------
+        The line adds one cost layer and the costs are moved on from their stored values without reading the
+        purchase history. Lines dated before an existing layer change the order of the layers, and lines dated on or
+        before an existing issue change what it was issued from, so the costs of the material are replayed instead.
+    '''
+    @classmethod
+    def receive(cls, line, date):
+        return cls.receive_lines([line], date)[line.inventory_item_id]
+
+    '''
+        Receive new purchase lines of the same date, such as the lines of a whole receipt, like receive
+        -----------------------------------------------------------------------------------------------
+        The stock levels are locked, the cost layers written, the oldest open layers read and the costs saved with
+        one query each however many lines there are. Returns the stock levels of the materials by their primary keys.
+    '''
+    @classmethod
+    def receive_lines(cls, lines, date):
+        item_ids = {line.inventory_item_id for line in lines}
+        stocks = {stock.item_id: stock for stock in cls.objects.select_for_update().filter(item_id__in=item_ids)}
+        for item_id in item_ids - stocks.keys():
+            stocks[item_id] = cls.rebuild(item_id)
+        replayed = set(MaterialCostLayer.objects.filter(item_id__in=item_ids, date__gt=date).values_list('item_id', flat=True))
+        # Purchases replay before orders of the same date, so issues on the date of the lines are replayed as well
+        replayed |= set(MaterialMovement.objects.filter(item_id__in=item_ids, kind=MaterialMovement.KIND_CHOICES.USED, date__gte=date).values_list('item_id', flat=True))
+        for item_id in replayed:
+            stocks[item_id] = cls.rebuild_costs(item_id)
+        # The stock levels already include every line, so the quantity before a line is on hand less the lines from it on
+        pending = Counter()
+        for line in lines:
+            pending[line.inventory_item_id] += line.quantity
+        layers = []
+        for line in (line for line in lines if line.inventory_item_id not in replayed):
+            stock = stocks[line.inventory_item_id]
+            unit_cost = cls.get_line_unit_cost(line.cost, line.quantity)
+            if line.quantity:
+                layers.append(MaterialCostLayer(item_id=line.inventory_item_id, purchase_line=line, date=date, quantity=line.quantity, remaining=line.quantity, unit_cost=unit_cost))
+                stock.average_cost = cls.get_average_cost(stock.average_cost, stock.on_hand - pending[line.inventory_item_id], line.cost, line.quantity)
+                pending[line.inventory_item_id] -= line.quantity
+            stock.latest_cost = unit_cost
+        MaterialCostLayer.objects.bulk_create(layers)
+        received = [stock for item_id, stock in stocks.items() if item_id not in replayed]
+        oldest = MaterialCostLayer.objects.filter(item=OuterRef('item'), remaining__gt=0).order_by('date', 'id').values('unit_cost')[:1]
+        oldest_costs = dict(cls.objects.filter(item_id__in=[stock.item_id for stock in received]).annotate(oldest_cost=Subquery(oldest)).values_list('item_id', 'oldest_cost'))
+        for stock in received:
+            oldest_cost = oldest_costs.get(stock.item_id)
+            stock.fifo_cost = oldest_cost if oldest_cost is not None else stock.latest_cost
+        cls.objects.bulk_update(received, cls.COST_FIELDS)
+        return stocks
+
+    '''
+        Issue a new order line from the cost layers of its material
+        -----------------------------------------------------------
+        The quantity is taken off the oldest cost layers with stock remaining. Lines dated before an existing layer
+        would have been issued from different layers, so the costs of the material are replayed instead.
+    '''
+    @classmethod
+    def issue(cls, line, date):
+        stock = cls.lock(line.inventory_item_id)
+        if MaterialCostLayer.objects.filter(item_id=line.inventory_item_id, date__gt=date).exists():
+            return cls.rebuild_costs(line.inventory_item_id)
+        layers = MaterialCostLayer.objects.select_for_update().filter(item_id=line.inventory_item_id, remaining__gt=0).order_by('date', 'id')
+        issued = []
+        quantity = line.quantity
+        for layer in layers if quantity else []:
+            taken = min(layer.remaining, quantity)
+            layer.remaining -= taken
+            quantity -= taken
+            issued.append(layer)
+            if not quantity:
+                break
+        MaterialCostLayer.objects.bulk_update(issued, ['remaining'])
+        stock.fifo_cost = cls.get_fifo_cost(line.inventory_item_id, stock.latest_cost)
+        stock.save(update_fields=['fifo_cost'])
+        return stock
+
+    '''
+        Calculate the cost of taking a quantity of a material out of stock with the active costing strategy
+        ---------------------------------------------------------------------------------------------------
+        FIFO adds up the oldest cost layers with stock remaining, costing any quantity beyond them at the latest
+        unit cost. Returns None when the material has not been costed yet.
+    '''
+    @classmethod
+    def cost_of(cls, item_id, quantity):
+        cost_field = cls.get_cost_field()
+        quantity = money.to_decimal(quantity)
+        stock = cls.objects.filter(item_id=item_id).values(*cls.COST_FIELDS).first()
+        if stock is None or stock[cost_field] is None:
+            return None
+        if cost_field != 'fifo_cost':
+            return money.round_money(money.round_money(stock[cost_field]) * quantity)
+        with localcontext(money.MONEY_CONTEXT):
+            cost = money.ZERO
+            layers = MaterialCostLayer.objects.filter(item_id=item_id, remaining__gt=0).order_by('date', 'id').values_list('remaining', 'unit_cost')
+            for remaining, unit_cost in layers if quantity else []:
+                taken = min(remaining, quantity)
+                cost += unit_cost * taken
+                quantity -= taken
+                if not quantity:
+                    break
+            return money.round_money(cost + money.to_decimal(stock['latest_cost']) * quantity)
+
+    ''' Move a weighted average unit cost on by a purchase, starting again from the purchase when nothing was on hand '''
+    @staticmethod
+    def get_average_cost(average_cost, on_hand, cost, quantity):
+        with localcontext(money.MONEY_CONTEXT):
+            if average_cost is None or on_hand <= 0:
+                return money.to_decimal(cost) / quantity
+            return (average_cost * on_hand + money.to_decimal(cost)) / (on_hand + quantity)
+
+    ''' Read the unit cost of the oldest cost layer with stock remaining, using the latest unit cost when every layer is used up '''
+    @staticmethod
+    def get_fifo_cost(item_id, latest_cost):
+        oldest = MaterialCostLayer.objects.filter(item_id=item_id, remaining__gt=0).order_by('date', 'id').values_list('unit_cost', flat=True).first()
+        return oldest if oldest is not None else latest_cost
+
+    '''
+        Replay the cost layers and costs of a material from its purchase and order history
+        ----------------------------------------------------------------------------------
+        Purchases and orders are replayed by date, purchases first on the same date, so changed, deleted and back
+        dated lines leave the same costs as if every line had been written in date order.
+    '''
+    @classmethod
+    def rebuild_costs(cls, item_id):
+        stock = cls.lock(item_id)
+        item_model = cls._meta.get_field('item').related_model
+        purchase_model, order_model = (item_model._meta.get_field(relation).related_model for relation in cls.lines)
+        purchases = purchase_model.objects.filter(inventory_item_id=item_id).values_list('purchase__date', 'id', 'quantity', 'cost')
+        orders = order_model.objects.filter(inventory_item_id=item_id).values_list('order__date', 'id', 'quantity')
+        events = sorted([(date, 0, line_id, quantity, cost) for date, line_id, quantity, cost in purchases] + [(date, 1, line_id, quantity, None) for date, line_id, quantity in orders])
+        layers = []
+        on_hand = 0
+        stock.average_cost = None
+        for date, is_order, line_id, quantity, cost in events:
+            if is_order:
+                on_hand -= quantity
+                for layer in (layer for layer in layers if layer.remaining):
+                    taken = min(layer.remaining, quantity)
+                    layer.remaining -= taken
+                    quantity -= taken
+                    if not quantity:
+                        break
+            elif quantity:
+                layers.append(MaterialCostLayer(item_id=item_id, purchase_line_id=line_id, date=date, quantity=quantity, remaining=quantity, unit_cost=cls.get_line_unit_cost(cost, quantity)))
+                stock.average_cost = cls.get_average_cost(stock.average_cost, on_hand, cost, quantity)
+                on_hand += quantity
+        latest = max(((line_id, quantity, cost) for _, line_id, quantity, cost in purchases), default=None)
+        stock.latest_cost = cls.get_line_unit_cost(latest[2], latest[1]) if latest else None
+        MaterialCostLayer.objects.filter(item_id=item_id).delete()
+        MaterialCostLayer.objects.bulk_create(layers)
+        stock.fifo_cost = next((layer.unit_cost for layer in layers if layer.remaining), stock.latest_cost)
+        stock.save(update_fields=cls.COST_FIELDS)
+        return stock
+
+'''
+    Model for a FIFO cost layer of a material
+    -----------------------------------------
+    Each purchase line of a material adds a layer with the quantity purchased at its unit cost, and order lines take
+    their quantity off the oldest layers with stock remaining. Only layers with stock remaining are indexed, so
+    finding the oldest open layer stays cheap however long the purchase history grows.
+'''
+class MaterialCostLayer(models.Model):
+    item = models.ForeignKey(Material, on_delete=models.CASCADE, related_name='cost_layers')
+    purchase_line = models.OneToOneField('purchase.PurchaseMaterial', on_delete=models.CASCADE, related_name='cost_layer')
+    date = models.DateField()
+    quantity = models.PositiveIntegerField()
+    remaining = models.PositiveIntegerField()
+    unit_cost = models.DecimalField(max_digits=16, decimal_places=6)
+
+    class Meta:
+        indexes = [ models.Index(fields=['item', 'date', 'id'], condition=Q(remaining__gt=0), name='cost_layer_open_idx') ]
+
+''' Model for the stock level of a tool '''
+class ToolStock(StockLevelBase):
+    item = models.OneToOneField(Tool, on_delete=models.CASCADE, primary_key=True, related_name='stock')
+
+    lines = ['purchase_tools', 'order_tools']
+    consumed = 'broken'
+    movement_model = ToolMovement
+
+'''
+    Mixin for purchase and order lines that move the stock of their inventory item
+    -------------------------------------------------------------------------------
+    STOCK_COUNTS: maps the stock counts the line adds to, to the line fields holding the amounts
+    STOCK_PARENT: the purchase or order field of the line, whose date the stock moves on
+    Saving a line applies the difference to the item stock level and movement journal in the same transaction, and
+    remove_deleted_line_stock takes the stock of deleted lines off again. Used with AtomicOperationsMixin, whose
+    save_transaction shares the locked previous row of the line with every save method.
+'''
+class StockMovementMixin:
+    STOCK_COUNTS = {}
+    STOCK_PARENT = None
+
+    ''' Return the stock counts this line adds to its inventory item '''
+    def get_stock_changes(self):
+        return Counter({count: getattr(self, field) or 0 for count, field in self.STOCK_COUNTS.items()})
+
+    ''' Return the date the stock of this line moves on '''
+    def get_stock_date(self):
+        return getattr(self, self.STOCK_PARENT).date
+
+    ''' Return the date the stock of a deleted line moves on, taken from the purchase or order being deleted when the line is deleted in cascade with it '''
+    def get_deleted_stock_date(self, origin):
+        parent = self._meta.get_field(self.STOCK_PARENT)
+        if isinstance(origin, parent.related_model) and origin.pk == getattr(self, parent.attname):
+            return origin.date
+        return self.get_stock_date()
+
+    '''
+        Override save method to apply the change in stock of a new or updated line
+        reserve_stock: reject the line with InsufficientStock when it takes more stock than is on hand
+    '''
+    def save(self, *args, reserve_stock=False, **kwargs):
+        with self.save_transaction() as previous:
+            super().save(*args, **kwargs)
+            stock_model = self.inventory_item.get_stock_model()
+            changes = self.get_stock_changes()
+            parent_field = f'{self.STOCK_PARENT}_id'
+            if previous is not None and (previous.inventory_item_id, getattr(previous, parent_field)) == (self.inventory_item_id, getattr(self, parent_field)):
+                changes.subtract(previous.get_stock_changes())
+            elif previous is not None:
+                stock_model.apply_changes(previous.inventory_item_id, self.reverse(previous.get_stock_changes()), previous.get_stock_date())
+            stock_model.apply_changes(self.inventory_item_id, changes, self.get_stock_date(), reserve=reserve_stock)
+            self.clear_cached_stock()
+
+    ''' Forget the stock level cached on the inventory item so it is read again after the stock changed '''
+    def clear_cached_stock(self):
+        if not self._meta.get_field('inventory_item').is_cached(self):
+            return
+        stock = self.inventory_item._meta.get_field('stock')
+        if stock.is_cached(self.inventory_item):
+            stock.delete_cached_value(self.inventory_item)
+
+    ''' Determine if a line is deleted in cascade with its inventory item, whose stock level, movements and cost layers are deleted with it '''
+    def is_deleted_with_item(self, origin):
+        item_model = self._meta.get_field('inventory_item').related_model
+        if isinstance(origin, item_model):
+            return origin.pk == self.inventory_item_id
+        return isinstance(origin, models.QuerySet) and origin.model is item_model
+
+    @staticmethod
+    def reverse(changes):
+        return {count: -amount for count, amount in changes.items()}
+
+    ''' Add up the stock counts of a set of lines for each inventory item '''
+    @classmethod
+    def get_stock_totals(cls, lines):
+        totals = lines.order_by().values('inventory_item').annotate(**{f'total_{count}': Sum(field) for count, field in cls.STOCK_COUNTS.items()})
+        return [(total['inventory_item'], {count: total[f'total_{count}'] or 0 for count in cls.STOCK_COUNTS}) for total in totals]
+
+    @classmethod
+    def get_stock_model(cls):
+        return cls._meta.get_field('inventory_item').related_model.get_stock_model()
+
+    ''' Add the stock of new lines written in bulk, which skips save, to their inventory items '''
+    @classmethod
+    def add_stock(cls, lines, date):
+        totals = {}
+        for line in lines:
+            totals.setdefault(line.inventory_item_id, Counter()).update(line.get_stock_changes())
+        stock_model = cls.get_stock_model()
+        for item_id, changes in totals.items():
+            stock_model.apply_changes(item_id, changes, date)
+
+    '''
+        Move the stock of lines to a new date in the movement journal when the date of their purchase or order changes
+        ----------------------------------------------------------------------------------------------------------------
+        The stock level row of each item is locked first, as apply_changes does, so movements of an item are recorded in turn.
+    '''
+    @classmethod
+    def redate_stock(cls, lines, old_date, new_date):
+        stock_model = cls.get_stock_model()
+        for item_id, changes in cls.get_stock_totals(lines):
+            stock_model.lock(item_id)
+            stock_model.record_movements(item_id, cls.reverse(changes), old_date)
+            stock_model.record_movements(item_id, changes, new_date)
+
+'''
+    Mixin for purchase and order material lines that keep the cost layers and costs of their material up to date
+    ---------------------------------------------------------------------------------------------------------------
+    COST_MOVE: the MaterialStock method moving the costs on for a new line, receive for purchased and issue for used
+    New lines move the costs on incrementally with COST_MOVE on the date of the line, while changed lines replay the
+    costs of their materials in the same transaction. Deleted lines are replayed by replay_deleted_line_costs.
+'''
+class MaterialCostingMixin:
+    COST_MOVE = None
+
+    ''' Override save method to cost a new line incrementally and replay the costs of the materials of a changed line '''
+    def save(self, *args, **kwargs):
+        with self.save_transaction() as previous:
+            adding = self._state.adding
+            previous_item_id = previous.inventory_item_id if previous is not None else None
+            super().save(*args, **kwargs)
+            if adding:
+                getattr(MaterialStock, self.COST_MOVE)(self, self.get_stock_date())
+            else:
+                for item_id in {previous_item_id, self.inventory_item_id} - {None}:
+                    MaterialStock.rebuild_costs(item_id)
+            self.clear_cached_stock()
+
+    ''' Replay the costs of the materials of lines, such as the lines of a purchase or order whose date changed '''
+    @classmethod
+    def rebuild_costs(cls, lines):
+        for item_id in set(lines.values_list('inventory_item', flat=True)):
+            MaterialStock.rebuild_costs(item_id)
+
+'''
+    Take the stock of a deleted purchase or order line off its inventory item
+    -------------------------------------------------------------------------
+    Connected to post_delete of each line model, which Django also sends for lines deleted in cascade with their
+    purchase, order, supplier or customer, so the stock levels and movement journal never keep deleted history.
+    Lines deleted with their inventory item are skipped, as its stock level and movements are deleted with it.
+'''
+def remove_deleted_line_stock(sender, instance, origin=None, **kwargs):
+    if instance.is_deleted_with_item(origin):
+        return
+    sender.get_stock_model().apply_changes(instance.inventory_item_id, instance.reverse(instance.get_stock_changes()), instance.get_deleted_stock_date(origin))
+    instance.clear_cached_stock()
+
+''' Replay the costs of the material of a deleted purchase or order line, connected to post_delete of each material line model '''
+def replay_deleted_line_costs(sender, instance, origin=None, **kwargs):
+    if instance.is_deleted_with_item(origin):
+        return
+    MaterialStock.rebuild_costs(instance.inventory_item_id)
+    instance.clear_cached_stock()
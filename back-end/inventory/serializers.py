@@ -1,14 +1,35 @@
 from inventory.models import Material, Tool
 from rest_framework import serializers
+from django.utils import timezone
 
 ''' Serializer for material model '''
 class MaterialSerializer(serializers.ModelSerializer):
     class Meta:
         model = Material
-        fields = ['id', 'name', 'description', 'size', 'available_quantity', 'unit_cost']
+        fields = ['id', 'name', 'description', 'size', 'reorder_point', 'available_quantity', 'unit_cost']
+
+''' Serializer for a row of a material import, which matches existing materials by name and size instead of rejecting them '''
+class MaterialImportSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Material
+        fields = ['name', 'size', 'description', 'reorder_point']
+        validators = []
 
 ''' Serializer for tool model '''
 class ToolSerializer(serializers.ModelSerializer):
     class Meta:
         model = Tool
-        fields = ['id', 'name', 'description', 'available_quantity', 'unit_cost']
+        fields = ['id', 'name', 'description', 'reorder_point', 'available_quantity', 'unit_cost']
+
+''' Serializer for the date to read the stock on hand on, today when it is not given '''
+class StockDateSerializer(serializers.Serializer):
+    date = serializers.DateField(required=False)
+
+    def validate(self, data):
+        data.setdefault('date', timezone.localdate())
+        return data
+
+''' Serializer for the low stock report filters, usage is measured over the given number of days up to today '''
+class LowStockFilterSerializer(serializers.Serializer):
+    type = serializers.ChoiceField(choices=['material', 'tool'], required=False)
+    days = serializers.IntegerField(min_value=1, max_value=365, default=30)
@@ -1,11 +1,24 @@
+from inventory.models import Material, MaterialCostLayer, MaterialMovement, MaterialSearchToken, MaterialStock, Tool, ToolMovement, ToolStock
+from purchase.models import Purchase, PurchaseMaterial, PurchaseTool
 from inventory.serializers import MaterialSerializer, ToolSerializer
 from rest_framework.test import APITestCase, APIClient
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.contrib.auth.hashers import make_password
-from inventory.models import Material, Tool
+from order.models import Order, OrderMaterial, OrderTool
+from supplier.models import Supplier, SupplierAddress
+from django.core.exceptions import ImproperlyConfigured
+from django.test.utils import CaptureQueriesContext
+from django.test import TestCase, override_settings
+from django.core.management import call_command
+from customer.models import Customer
+from service.models import Service
+from django.utils import timezone
 from rest_framework import status
-from django.test import TestCase
+from django.db import connection
 from django.urls import reverse
 from user.models import User
+from decimal import Decimal
+from io import StringIO
 
 ''' Tests for material serializer '''
 class TestMaterialSerializers(TestCase):
@@ -90,6 +103,16 @@ class TestMaterialView(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.data), Material.objects.count())
 
+    ''' Test the material list is fetched in a single query '''
+    def test_get_materials_query_count(self):
+        for index in range(5):
+            Material.objects.create(name=f'material {index}', size='1 inch')
+        self.client.force_authenticate(user=self.user)
+        with self.assertNumQueries(1):
+            response = self.client.get(self.list_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 6)
+
     ''' Test create material with empty data '''
     def test_create_material_empty_data(self):
         self.client.force_authenticate(user=self.user)
@@ -254,6 +277,16 @@ class TestToolView(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.data), Tool.objects.count())
 
+    ''' Test the tool list is fetched in a single query '''
+    def test_get_tools_query_count(self):
+        for index in range(5):
+            Tool.objects.create(name=f'tool {index}')
+        self.client.force_authenticate(user=self.user)
+        with self.assertNumQueries(1):
+            response = self.client.get(self.list_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 6)
+
     ''' Test create tool with empty data '''
     def test_create_tool_empty_data(self):
         self.client.force_authenticate(user=self.user)
@@ -322,3 +355,641 @@ class TestToolView(APITestCase):
         response = self.client.delete(self.detail_url(self.tool.pk))
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
         self.assertEqual(Tool.objects.count(), 0)
+
+''' Tests for material and tool stock levels '''
+class TestStockLevels(TestCase):
+
+    ''' Setup for tests '''
+    @classmethod
+    def setUpTestData(cls):
+        cls.date = timezone.now().date()
+        cls.supplier = Supplier.objects.create(name='supplier')
+        cls.address = SupplierAddress.objects.create(supplier=cls.supplier, street_address='123 Test Street', city='City', state='State', zip=12345)
+        cls.purchase = Purchase.objects.create(supplier=cls.supplier, supplier_address=cls.address, tax=0, date=cls.date)
+        cls.customer = Customer.objects.create(first_name='first', last_name='last', email='firstlast@email.com', phone='1 (234) 567-8901')
+        cls.service = Service.objects.create(name='test service')
+        cls.order = Order.objects.create(customer=cls.customer, date=cls.date, description='test description', service=cls.service)
+        cls.material = Material.objects.create(name='material', size='2 inch X 4 inch X 8 feet')
+        cls.tool = Tool.objects.create(name='tool')
+        cls.purchase_material = PurchaseMaterial.objects.create(purchase=cls.purchase, inventory_item=cls.material, quantity=20, cost=100.0)
+        cls.purchase_tool = PurchaseTool.objects.create(purchase=cls.purchase, inventory_item=cls.tool, quantity=5, cost=50.0)
+
+    def assertStock(self, stock_model, item, **counts):
+        stock = stock_model.objects.get(item=item)
+        for count, amount in counts.items():
+            self.assertEqual(getattr(stock, count), amount)
+
+    ''' Test new inventory items start with an empty stock level '''
+    def test_stock_created_with_item(self):
+        material = Material.objects.create(name='new material', size='1 inch')
+        self.assertStock(MaterialStock, material, purchased=0, used=0, broken=0, on_hand=0)
+
+    ''' Test purchases add to the stock level '''
+    def test_stock_purchased(self):
+        self.assertStock(MaterialStock, self.material, purchased=20, on_hand=20)
+        self.assertStock(ToolStock, self.tool, purchased=5, on_hand=5)
+        self.assertEqual(Material.objects.get(pk=self.material.pk).available_quantity, 20)
+
+    ''' Test order materials are used and order tools are broken '''
+    def test_stock_used_and_broken(self):
+        OrderMaterial.objects.create(order=self.order, inventory_item=self.material, quantity=8)
+        OrderTool.objects.create(order=self.order, inventory_item=self.tool, quantity=3, quantity_broken=2)
+        self.assertStock(MaterialStock, self.material, purchased=20, used=8, on_hand=12)
+        self.assertStock(ToolStock, self.tool, purchased=5, used=3, broken=2, on_hand=3)
+
+    ''' Test updating and deleting lines applies the difference to the stock level '''
+    def test_stock_updated_and_deleted(self):
+        order_material = OrderMaterial.objects.create(order=self.order, inventory_item=self.material, quantity=8)
+        order_material.quantity = 5
+        order_material.save()
+        self.assertStock(MaterialStock, self.material, used=5, on_hand=15)
+        other_material = Material.objects.create(name='other material', size='1 inch')
+        order_material.inventory_item = other_material
+        order_material.save()
+        self.assertStock(MaterialStock, self.material, used=0, on_hand=20)
+        self.assertStock(MaterialStock, other_material, used=5, on_hand=-5)
+        order_material.delete()
+        self.assertStock(MaterialStock, other_material, used=0, on_hand=0)
+
+    ''' Test deleting a purchase or order takes its lines off the stock level '''
+    def test_stock_parent_deleted(self):
+        OrderMaterial.objects.create(order=self.order, inventory_item=self.material, quantity=8)
+        Order.objects.get(pk=self.order.pk).delete()
+        self.assertStock(MaterialStock, self.material, used=0, on_hand=20)
+        Purchase.objects.get(pk=self.purchase.pk).delete()
+        self.assertStock(MaterialStock, self.material, purchased=0, on_hand=0)
+        self.assertStock(ToolStock, self.tool, purchased=0, on_hand=0)
+
+    ''' Test deleting a customer or supplier takes the lines of their orders and purchases deleted in cascade off the stock level '''
+    def test_stock_cascade_deleted(self):
+        OrderMaterial.objects.create(order=self.order, inventory_item=self.material, quantity=4)
+        OrderTool.objects.create(order=self.order, inventory_item=self.tool, quantity=2, quantity_broken=1)
+        self.customer.delete()
+        self.assertStock(MaterialStock, self.material, purchased=20, used=0, on_hand=20)
+        self.assertStock(ToolStock, self.tool, purchased=5, used=0, broken=0, on_hand=5)
+        self.supplier.delete()
+        self.assertStock(MaterialStock, self.material, purchased=0, used=0, on_hand=0, latest_cost=None, average_cost=None, fifo_cost=None)
+        self.assertStock(ToolStock, self.tool, purchased=0, broken=0, on_hand=0)
+        self.assertEqual(Material.objects.get(pk=self.material.pk).available_quantity, 0)
+        self.assertFalse(MaterialCostLayer.objects.filter(item=self.material).exists())
+        self.assertEqual(Material.objects.annotate(balance=MaterialMovement.balance_on(self.date)).get(pk=self.material.pk).balance, 0)
+
+    ''' Test deleting an inventory item deletes its lines without touching the stock of other items '''
+    def test_stock_item_deleted(self):
+        OrderMaterial.objects.create(order=self.order, inventory_item=self.material, quantity=4)
+        Material.objects.get(pk=self.material.pk).delete()
+        self.assertFalse(MaterialStock.objects.filter(item_id=self.material.pk).exists())
+        self.assertFalse(MaterialMovement.objects.filter(item_id=self.material.pk).exists())
+        self.assertStock(ToolStock, self.tool, purchased=5, on_hand=5)
+
+    ''' Test a purchase line is written with one insert, one stock level update and one journal movement, without join table writes or reloads '''
+    def test_stock_write_queries(self):
+        tool = Tool.objects.create(name='new tool')
+        with CaptureQueriesContext(connection) as context:
+            PurchaseTool.objects.create(purchase=self.purchase, inventory_item=tool, quantity=3, cost=30.0)
+        statements = [query['sql'].split()[0] for query in context.captured_queries if 'SAVEPOINT' not in query['sql']]
+        # New lines have no saved row to lock
+        self.assertEqual(statements, ['INSERT', 'UPDATE', 'SELECT', 'INSERT', 'UPDATE'])
+        self.assertStock(ToolStock, tool, purchased=3, on_hand=3)
+
+    ''' Test material lines read their saved row once per save, shared by every save method of the line '''
+    def test_material_line_write_queries(self):
+        with self.assertNumQueries(13):
+            purchase_material = PurchaseMaterial.objects.create(purchase=self.purchase, inventory_item=self.material, quantity=10, cost=50.0)
+        purchase_material.quantity = 8
+        with self.assertNumQueries(14):
+            purchase_material.save()
+        with self.assertNumQueries(18):
+            order_material = OrderMaterial.objects.create(order=self.order, inventory_item=self.material, quantity=4)
+        order_material.quantity = 6
+        with self.assertNumQueries(18):
+            order_material.save()
+        self.assertStock(MaterialStock, self.material, purchased=28, used=6, on_hand=22)
+
+    ''' Test with_stock annotates the available quantity and unit cost read by the serializers '''
+    def test_with_stock(self):
+        PurchaseMaterial.objects.create(purchase=self.purchase, inventory_item=self.material, quantity=4, cost=10.0)
+        OrderMaterial.objects.create(order=self.order, inventory_item=self.material, quantity=6)
+        with self.assertNumQueries(1):
+            data = MaterialSerializer(Material.objects.with_stock().filter(pk=self.material.pk), many=True).data
+        self.assertEqual(data[0]['available_quantity'], 18)
+        self.assertEqual(str(data[0]['unit_cost']), '2.50')
+        tool = Tool.objects.with_stock().get(pk=self.tool.pk)
+        self.assertEqual(tool.available_quantity, Tool.objects.get(pk=self.tool.pk).available_quantity)
+        self.assertEqual(tool.unit_cost, Tool.objects.get(pk=self.tool.pk).unit_cost)
+
+    ''' Test with_stock calculates the stock of items without a stock level from their history '''
+    def test_with_stock_without_stock_level(self):
+        OrderTool.objects.create(order=self.order, inventory_item=self.tool, quantity=3, quantity_broken=2)
+        ToolStock.objects.filter(item=self.tool).delete()
+        self.assertEqual(Tool.objects.with_stock().get(pk=self.tool.pk).available_quantity, 3)
+
+    ''' Test a missing stock level is rebuilt from history when read '''
+    def test_stock_rebuilt_when_missing(self):
+        MaterialStock.objects.filter(item=self.material).delete()
+        self.assertEqual(Material.objects.get(pk=self.material.pk).available_quantity, 20)
+        self.assertStock(MaterialStock, self.material, purchased=20, on_hand=20)
+
+    ''' Test the reconcile command rebuilds drifted and missing stock levels '''
+    def test_reconcile_stock_levels_command(self):
+        OrderTool.objects.create(order=self.order, inventory_item=self.tool, quantity=3, quantity_broken=1)
+        MaterialStock.objects.filter(item=self.material).update(purchased=0, on_hand=0)
+        ToolStock.objects.filter(item=self.tool).delete()
+        output = StringIO()
+        call_command('reconcile_stock_levels', '--dry-run', stdout=output)
+        self.assertIn('2 of 2 inventory items have drifted stock levels.', output.getvalue())
+        self.assertStock(MaterialStock, self.material, purchased=0)
+        call_command('reconcile_stock_levels', stdout=output)
+        self.assertStock(MaterialStock, self.material, purchased=20, used=0, on_hand=20)
+        self.assertStock(ToolStock, self.tool, purchased=5, used=3, broken=1, on_hand=4)
+        self.assertIn('Reconciled stock levels for 2 of 2 inventory items.', output.getvalue())
+
+''' Tests for the material and tool movement journals '''
+class TestInventoryMovements(TestCase):
+
+    ''' Setup for tests '''
+    @classmethod
+    def setUpTestData(cls):
+        cls.date = timezone.now().date()
+        cls.supplier = Supplier.objects.create(name='supplier')
+        cls.address = SupplierAddress.objects.create(supplier=cls.supplier, street_address='123 Test Street', city='City', state='State', zip=12345)
+        cls.customer = Customer.objects.create(first_name='first', last_name='last', email='firstlast@email.com', phone='1 (234) 567-8901')
+        cls.service = Service.objects.create(name='test service')
+        cls.material = Material.objects.create(name='material', size='2 inch X 4 inch X 8 feet')
+        cls.tool = Tool.objects.create(name='tool')
+        cls.purchase = Purchase.objects.create(supplier=cls.supplier, supplier_address=cls.address, tax=0, date=cls.date - timezone.timedelta(days=10))
+        cls.order = Order.objects.create(customer=cls.customer, date=cls.date - timezone.timedelta(days=5), description='test description', service=cls.service)
+        PurchaseMaterial.objects.create(purchase=cls.purchase, inventory_item=cls.material, quantity=20, cost=100.0)
+        PurchaseTool.objects.create(purchase=cls.purchase, inventory_item=cls.tool, quantity=4, cost=40.0)
+        OrderMaterial.objects.create(order=cls.order, inventory_item=cls.material, quantity=8)
+        OrderTool.objects.create(order=cls.order, inventory_item=cls.tool, quantity=2, quantity_broken=1)
+
+    def balance_on(self, movement_model, item, days_ago):
+        return movement_model.objects.filter(item=item, date__lte=self.date - timezone.timedelta(days=days_ago)).order_by('-date', '-id').values_list('balance', flat=True).first() or 0
+
+    ''' Test purchase and order lines add movements with a running balance '''
+    def test_movements_recorded(self):
+        movements = list(MaterialMovement.objects.filter(item=self.material).order_by('date', 'id').values_list('kind', 'quantity', 'balance'))
+        self.assertEqual(movements, [('purchased', 20, 20), ('used', -8, 12)])
+        movements = list(ToolMovement.objects.filter(item=self.tool).order_by('date', 'id').values_list('kind', 'quantity', 'balance'))
+        self.assertEqual(movements, [('purchased', 4, 4), ('broken', -1, 3)])
+
+    ''' Test a back dated purchase moves the balances recorded after it '''
+    def test_back_dated_movement(self):
+        purchase = Purchase.objects.create(supplier=self.supplier, supplier_address=self.address, tax=0, date=self.date - timezone.timedelta(days=7))
+        PurchaseMaterial.objects.create(purchase=purchase, inventory_item=self.material, quantity=5, cost=25.0)
+        self.assertEqual(self.balance_on(MaterialMovement, self.material, 10), 20)
+        self.assertEqual(self.balance_on(MaterialMovement, self.material, 7), 25)
+        self.assertEqual(self.balance_on(MaterialMovement, self.material, 0), 17)
+        self.assertEqual(MaterialStock.objects.get(item=self.material).on_hand, 17)
+
+    ''' Test updating, deleting and redating lines adds correcting movements '''
+    def test_movements_corrected(self):
+        order_material = OrderMaterial.objects.get(order=self.order, inventory_item=self.material)
+        order_material.quantity = 10
+        order_material.save()
+        self.assertEqual(self.balance_on(MaterialMovement, self.material, 0), 10)
+        order = Order.objects.get(pk=self.order.pk)
+        order.date = self.date - timezone.timedelta(days=2)
+        order.save()
+        self.assertEqual(self.balance_on(MaterialMovement, self.material, 3), 20)
+        self.assertEqual(self.balance_on(MaterialMovement, self.material, 0), 10)
+        order.delete()
+        self.assertEqual(self.balance_on(MaterialMovement, self.material, 0), 20)
+        self.assertEqual(self.balance_on(ToolMovement, self.tool, 0), 4)
+
+    ''' Test the rebuild command recreates the journals from history '''
+    def test_rebuild_inventory_movements_command(self):
+        expected = list(MaterialMovement.objects.order_by('item', 'date', 'id').values_list('item', 'date', 'kind', 'quantity', 'balance'))
+        MaterialMovement.objects.all().delete()
+        ToolMovement.objects.filter(item=self.tool).update(balance=0)
+        output = StringIO()
+        call_command('rebuild_inventory_movements', stdout=output)
+        self.assertEqual(list(MaterialMovement.objects.order_by('item', 'date', 'id').values_list('item', 'date', 'kind', 'quantity', 'balance')), expected)
+        self.assertEqual(self.balance_on(ToolMovement, self.tool, 0), 3)
+        self.assertIn('Rebuilt 4 inventory movements.', output.getvalue())
+
+''' Tests for material costing strategies and cost layers '''
+class TestMaterialCosting(TestCase):
+
+    ''' Setup for tests '''
+    @classmethod
+    def setUpTestData(cls):
+        cls.date = timezone.now().date()
+        cls.supplier = Supplier.objects.create(name='supplier')
+        cls.address = SupplierAddress.objects.create(supplier=cls.supplier, street_address='123 Test Street', city='City', state='State', zip=12345)
+        cls.customer = Customer.objects.create(first_name='first', last_name='last', email='firstlast@email.com', phone='1 (234) 567-8901')
+        cls.service = Service.objects.create(name='test service')
+        cls.material = Material.objects.create(name='material', size='2 inch X 4 inch X 8 feet')
+        cls.first_purchase = Purchase.objects.create(supplier=cls.supplier, supplier_address=cls.address, tax=0, date=cls.date - timezone.timedelta(days=10))
+        cls.second_purchase = Purchase.objects.create(supplier=cls.supplier, supplier_address=cls.address, tax=0, date=cls.date - timezone.timedelta(days=5))
+        cls.order = Order.objects.create(customer=cls.customer, date=cls.date, description='test description', service=cls.service)
+        PurchaseMaterial.objects.create(purchase=cls.first_purchase, inventory_item=cls.material, quantity=10, cost=10.0)
+        PurchaseMaterial.objects.create(purchase=cls.second_purchase, inventory_item=cls.material, quantity=10, cost=20.0)
+
+    def get_costs(self):
+        return MaterialStock.objects.filter(item=self.material).values_list('latest_cost', 'average_cost', 'fifo_cost').get()
+
+    def get_layers(self):
+        return list(MaterialCostLayer.objects.filter(item=self.material).order_by('date', 'id').values_list('quantity', 'remaining', 'unit_cost'))
+
+    ''' Test purchases add cost layers and move every cost on '''
+    def test_costs_received(self):
+        self.assertEqual(self.get_costs(), (Decimal('2'), Decimal('1.5'), Decimal('1')))
+        self.assertEqual(self.get_layers(), [(10, 10, Decimal('1')), (10, 10, Decimal('2'))])
+        for costing, unit_cost in [('latest', Decimal('2.00')), ('average', Decimal('1.50')), ('fifo', Decimal('1.00'))]:
+            with self.subTest(costing=costing), override_settings(INVENTORY_COSTING=costing):
+                self.assertEqual(Material.objects.get(pk=self.material.pk).unit_cost, unit_cost)
+                self.assertEqual(Material.objects.with_stock().get(pk=self.material.pk).unit_cost, unit_cost)
+
+    ''' Test order materials snapshot their cost with the active costing strategy '''
+    def test_order_material_cost_snapshot(self):
+        for costing, cost in [('latest', Decimal('30.00')), ('average', Decimal('22.50')), ('fifo', Decimal('20.00'))]:
+            with self.subTest(costing=costing), override_settings(INVENTORY_COSTING=costing):
+                order_material = OrderMaterial.objects.create(order=self.order, inventory_item=self.material, quantity=15)
+                self.assertEqual(order_material.cost, cost)
+                order_material.delete()
+
+    ''' Test order materials take their quantity off the oldest cost layers '''
+    @override_settings(INVENTORY_COSTING='fifo')
+    def test_fifo_layers_issued(self):
+        OrderMaterial.objects.create(order=self.order, inventory_item=self.material, quantity=15)
+        self.assertEqual(self.get_layers(), [(10, 0, Decimal('1')), (10, 5, Decimal('2'))])
+        self.assertEqual(self.get_costs(), (Decimal('2'), Decimal('1.5'), Decimal('2')))
+        # Using more than is left in the layers costs the shortfall at the latest unit cost
+        order_material = OrderMaterial.objects.create(order=self.order, inventory_item=self.material, quantity=8)
+        self.assertEqual(order_material.cost, Decimal('16.00'))
+        self.assertEqual(self.get_layers(), [(10, 0, Decimal('1')), (10, 0, Decimal('2'))])
+
+    ''' Test the weighted average continues from the quantity on hand '''
+    def test_average_cost_moved_on(self):
+        OrderMaterial.objects.create(order=self.order, inventory_item=self.material, quantity=15)
+        purchase = Purchase.objects.create(supplier=self.supplier, supplier_address=self.address, tax=0, date=self.date + timezone.timedelta(days=1))
+        PurchaseMaterial.objects.create(purchase=purchase, inventory_item=self.material, quantity=5, cost=15.0)
+        self.assertEqual(self.get_costs(), (Decimal('3'), Decimal('2.25'), Decimal('2')))
+
+    ''' Test changed, deleted and back dated lines replay the costs '''
+    def test_costs_replayed(self):
+        OrderMaterial.objects.create(order=self.order, inventory_item=self.material, quantity=15)
+        purchase_material = PurchaseMaterial.objects.get(purchase=self.second_purchase)
+        purchase_material.cost = 40.0
+        purchase_material.save()
+        self.assertEqual(self.get_costs(), (Decimal('4'), Decimal('2.5'), Decimal('4')))
+        purchase_material.delete()
+        self.assertEqual(self.get_costs(), (Decimal('1'), Decimal('1'), Decimal('1')))
+        self.assertEqual(self.get_layers(), [(10, 0, Decimal('1'))])
+        purchase = Purchase.objects.create(supplier=self.supplier, supplier_address=self.address, tax=0, date=self.date - timezone.timedelta(days=20))
+        PurchaseMaterial.objects.create(purchase=purchase, inventory_item=self.material, quantity=10, cost=30.0)
+        self.assertEqual(self.get_layers(), [(10, 0, Decimal('3')), (10, 5, Decimal('1'))])
+        self.assertEqual(self.get_costs(), (Decimal('3'), Decimal('2'), Decimal('1')))
+        purchase.delete()
+        self.assertEqual(self.get_layers(), [(10, 0, Decimal('1'))])
+
+    ''' Test a purchase dated before an existing order leaves the same costs as replaying the history '''
+    def test_purchase_before_order_matches_replay(self):
+        for quantity in [10, 25]:
+            with self.subTest(quantity=quantity):
+                order_material = OrderMaterial.objects.create(order=self.order, inventory_item=self.material, quantity=quantity)
+                for days in [7, 0]:
+                    purchase = Purchase.objects.create(supplier=self.supplier, supplier_address=self.address, tax=0, date=self.date - timezone.timedelta(days=days))
+                    PurchaseMaterial.objects.create(purchase=purchase, inventory_item=self.material, quantity=10, cost=30.0)
+                    received = (self.get_costs(), self.get_layers())
+                    MaterialStock.rebuild_costs(self.material.pk)
+                    self.assertEqual((self.get_costs(), self.get_layers()), received)
+                    purchase.delete()
+                order_material.delete()
+
+    ''' Test reading the current cost does not read the purchase history '''
+    @override_settings(INVENTORY_COSTING='average')
+    def test_unit_cost_query_count(self):
+        material = Material.objects.get(pk=self.material.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(material.unit_cost, Decimal('1.50'))
+        material = Material.objects.with_stock().get(pk=self.material.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(material.unit_cost, Decimal('1.50'))
+
+    ''' Test an unknown costing strategy is rejected '''
+    @override_settings(INVENTORY_COSTING='lifo')
+    def test_unknown_costing(self):
+        with self.assertRaises(ImproperlyConfigured):
+            Material.objects.get(pk=self.material.pk).unit_cost
+
+    ''' Test the rebuild command recreates the cost layers and costs from history '''
+    def test_rebuild_material_costs_command(self):
+        OrderMaterial.objects.create(order=self.order, inventory_item=self.material, quantity=15)
+        expected = (self.get_costs(), self.get_layers())
+        MaterialCostLayer.objects.all().delete()
+        MaterialStock.objects.update(latest_cost=None, average_cost=None, fifo_cost=None)
+        output = StringIO()
+        call_command('rebuild_material_costs', stdout=output)
+        self.assertEqual((self.get_costs(), self.get_layers()), expected)
+        self.assertIn('Rebuilt costs for 1 materials.', output.getvalue())
+
+''' Tests for material and tool stock on a date views '''
+class TestInventoryStockView(APITestCase):
+
+    ''' Setup for tests '''
+    @classmethod
+    def setUpTestData(cls):
+        cls.client = APIClient()
+        cls.date = timezone.now().date()
+        cls.supplier = Supplier.objects.create(name='supplier')
+        cls.address = SupplierAddress.objects.create(supplier=cls.supplier, street_address='123 Test Street', city='City', state='State', zip=12345)
+        cls.material = Material.objects.create(name='material', size='2 inch X 4 inch X 8 feet')
+        cls.other_material = Material.objects.create(name='other material', size='1 inch')
+        cls.tool = Tool.objects.create(name='tool')
+        cls.purchase = Purchase.objects.create(supplier=cls.supplier, supplier_address=cls.address, tax=0, date=cls.date - timezone.timedelta(days=10))
+        PurchaseMaterial.objects.create(purchase=cls.purchase, inventory_item=cls.material, quantity=20, cost=100.0)
+        PurchaseTool.objects.create(purchase=cls.purchase, inventory_item=cls.tool, quantity=4, cost=40.0)
+        cls.user = User.objects.create(first_name='first', last_name='last', email='firstlast@example.com', phone='1 (234) 567-8901', password=make_password('test1234'))
+
+    ''' Test stock of every material on a date '''
+    def test_get_material_stock(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(reverse('material-stock-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual({item['name']: item['on_hand'] for item in response.data}, {'material': 20, 'other material': 0})
+        response = self.client.get(reverse('material-stock-list'), {'date': self.date - timezone.timedelta(days=11)})
+        self.assertEqual({item['name']: item['on_hand'] for item in response.data}, {'material': 0, 'other material': 0})
+
+    ''' Test stock of a single tool on a date '''
+    def test_get_tool_stock(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(reverse('tool-stock-detail', kwargs={'pk': self.tool.pk}), {'date': self.date - timezone.timedelta(days=10)})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['on_hand'], 4)
+        self.assertEqual(response.data['date'], self.date - timezone.timedelta(days=10))
+
+    ''' Test stock of an unknown item or with an invalid date '''
+    def test_get_stock_invalid(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(reverse('tool-stock-detail', kwargs={'pk': 9999}))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(response.data['detail'], 'Tool Not Found.')
+        response = self.client.get(reverse('material-stock-list'), {'date': 'yesterday'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('date', response.data)
+
+''' Tests for low stock view '''
+class TestLowStockView(APITestCase):
+
+    ''' Setup for tests '''
+    @classmethod
+    def setUpTestData(cls):
+        cls.client = APIClient()
+        cls.date = timezone.localdate()
+        cls.supplier = Supplier.objects.create(name='supplier')
+        cls.address = SupplierAddress.objects.create(supplier=cls.supplier, street_address='123 Test Street', city='City', state='State', zip=12345)
+        cls.customer = Customer.objects.create(first_name='first', last_name='last', email='firstlast@email.com', phone='1 (234) 567-8901')
+        cls.service = Service.objects.create(name='test service')
+        cls.material = Material.objects.create(name='material', size='2 inch X 4 inch X 8 feet', reorder_point=10)
+        cls.unused_material = Material.objects.create(name='unused material', size='1 inch', reorder_point=5)
+        cls.stocked_material = Material.objects.create(name='stocked material', size='1 inch', reorder_point=5)
+        cls.untracked_material = Material.objects.create(name='untracked material', size='1 inch')
+        cls.tool = Tool.objects.create(name='tool', reorder_point=2)
+        purchase = Purchase.objects.create(supplier=cls.supplier, supplier_address=cls.address, tax=0, date=cls.date - timezone.timedelta(days=90))
+        PurchaseMaterial.objects.create(purchase=purchase, inventory_item=cls.material, quantity=30, cost=30.0)
+        PurchaseMaterial.objects.create(purchase=purchase, inventory_item=cls.unused_material, quantity=3, cost=3.0)
+        PurchaseMaterial.objects.create(purchase=purchase, inventory_item=cls.stocked_material, quantity=20, cost=20.0)
+        PurchaseTool.objects.create(purchase=purchase, inventory_item=cls.tool, quantity=4, cost=40.0)
+        old_order = Order.objects.create(customer=cls.customer, date=cls.date - timezone.timedelta(days=60), description='old order', service=cls.service)
+        order = Order.objects.create(customer=cls.customer, date=cls.date, description='test description', service=cls.service)
+        OrderMaterial.objects.create(order=old_order, inventory_item=cls.material, quantity=10)
+        OrderMaterial.objects.create(order=order, inventory_item=cls.material, quantity=12)
+        OrderTool.objects.create(order=order, inventory_item=cls.tool, quantity=3, quantity_broken=3)
+        cls.user = User.objects.create(first_name='first', last_name='last', email='firstlast@example.com', phone='1 (234) 567-8901', password=make_password('test1234'))
+
+    ''' Test items at or below their reorder point are listed by days of cover '''
+    def test_get_low_stock(self):
+        self.client.force_authenticate(user=self.user)
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('low-stock'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([(item['type'], item['name']) for item in response.data], [('tool', 'tool'), ('material', 'material'), ('material', 'unused material')])
+        tool, material, unused_material = response.data
+        self.assertEqual((tool['on_hand'], tool['shortfall'], tool['recent_usage'], tool['daily_usage'], tool['days_of_cover']), (1, 1, 3, 0.1, 10.0))
+        self.assertEqual((material['on_hand'], material['shortfall'], material['recent_usage'], material['daily_usage'], material['days_of_cover']), (8, 2, 12, 0.4, 20.0))
+        self.assertEqual(material['size'], '2 inch X 4 inch X 8 feet')
+        self.assertEqual((unused_material['on_hand'], unused_material['recent_usage'], unused_material['days_of_cover']), (3, 0, None))
+
+    ''' Test the usage window and item type filters '''
+    def test_get_low_stock_filtered(self):
+        self.client.force_authenticate(user=self.user)
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('low-stock'), {'type': 'material', 'days': 90})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([item['name'] for item in response.data], ['material', 'unused material'])
+        self.assertEqual(response.data[0]['recent_usage'], 22)
+
+    ''' Test invalid filters are rejected '''
+    def test_get_low_stock_invalid(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(reverse('low-stock'), {'days': 0, 'type': 'asset'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('days', response.data)
+        self.assertIn('type', response.data)
+
+''' Tests for material and tool search '''
+class TestInventorySearch(APITestCase):
+
+    ''' Setup for tests '''
+    @classmethod
+    def setUpTestData(cls):
+        cls.client = APIClient()
+        cls.plywood = Material.objects.create(name='Plywood Sheet', size='4 feet X 8 feet', description='Sanded pine plywood')
+        cls.pine = Material.objects.create(name='Pine Board', size='1 inch X 6 inch X 8 feet')
+        cls.cafe = Material.objects.create(name='Café Paint', size='1 gallon', description='Interior latex')
+        for number in range(30):
+            Material.objects.create(name=f'Screw {number}', size=f'{number} inch')
+        cls.hammer = Tool.objects.create(name='Claw Hammer', description='16 ounce')
+        cls.user = User.objects.create(first_name='first', last_name='last', email='firstlast@example.com', phone='1 (234) 567-8901', password=make_password('test1234'))
+
+    ''' Test words are normalized into lower case tokens without accents '''
+    def test_tokenize(self):
+        self.assertEqual(MaterialSearchToken.tokenize('Café Paint', '1/2 Gallon', None), ['1', '2', 'cafe', 'gallon', 'paint'])
+
+    ''' Test tokens are replaced when an item is saved '''
+    def test_tokens_indexed(self):
+        self.pine.size = '2 inch X 4 inch'
+        self.pine.save()
+        self.assertEqual(list(MaterialSearchToken.objects.filter(item=self.pine).order_by('token').values_list('token', flat=True)), ['2', '4', 'board', 'inch', 'pine', 'x'])
+
+    ''' Test every word must prefix a word of the item and whole word and name matches rank first '''
+    def test_search_materials(self):
+        self.client.force_authenticate(user=self.user)
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('material-list'), {'q': 'pin'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([material['name'] for material in response.data['results']], ['Pine Board', 'Plywood Sheet'])
+        self.assertIsNone(response.data['next'])
+        response = self.client.get(reverse('material-list'), {'q': 'pine'})
+        self.assertEqual([material['name'] for material in response.data['results']], ['Pine Board', 'Plywood Sheet'])
+        response = self.client.get(reverse('material-list'), {'q': 'plywood pine'})
+        self.assertEqual([material['name'] for material in response.data['results']], ['Plywood Sheet'])
+        response = self.client.get(reverse('material-list'), {'q': 'cafe'})
+        self.assertEqual([material['name'] for material in response.data['results']], ['Café Paint'])
+        self.assertIn('available_quantity', response.data['results'][0])
+
+    ''' Test search results are paginated '''
+    def test_search_paginated(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(reverse('material-list'), {'q': 'screw'})
+        self.assertEqual(len(response.data['results']), 20)
+        self.assertIn('page=2', response.data['next'])
+        response = self.client.get(reverse('material-list'), {'q': 'screw', 'page': 2})
+        self.assertEqual(len(response.data['results']), 10)
+        self.assertIsNone(response.data['next'])
+
+    ''' Test tools are searched and empty queries match nothing '''
+    def test_search_tools(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(reverse('tool-list'), {'q': 'ham'})
+        self.assertEqual([tool['name'] for tool in response.data['results']], ['Claw Hammer'])
+        response = self.client.get(reverse('tool-list'), {'q': ' '})
+        self.assertEqual(response.data['results'], [])
+
+    ''' Test the rebuild command recreates the search tokens '''
+    def test_rebuild_search_tokens_command(self):
+        expected = list(MaterialSearchToken.objects.order_by('item', 'token').values_list('item', 'token'))
+        MaterialSearchToken.objects.all().delete()
+        output = StringIO()
+        call_command('rebuild_search_tokens', stdout=output)
+        self.assertEqual(list(MaterialSearchToken.objects.order_by('item', 'token').values_list('item', 'token')), expected)
+        self.assertIn('Rebuilt search tokens for 34 inventory items.', output.getvalue())
+
+''' Tests for material import view '''
+class TestMaterialImportView(APITestCase):
+
+    ''' Setup for tests '''
+    @classmethod
+    def setUpTestData(cls):
+        cls.client = APIClient()
+        cls.material = Material.objects.create(name='Pine Board', size='1 inch X 6 inch', description='old description', reorder_point=4)
+        cls.url = reverse('material-import')
+        cls.user = User.objects.create(first_name='first', last_name='last', email='firstlast@example.com', phone='1 (234) 567-8901', password=make_password('test1234'))
+
+    ''' Test JSON rows are created or update the material with the same name and size, returning errors by row '''
+    def test_import_json(self):
+        self.client.force_authenticate(user=self.user)
+        rows = [
+            {'name': 'Plywood Sheet', 'size': '4 feet X 8 feet', 'description': 'sanded'},
+            {'name': 'Pine Board', 'size': '1 inch X 6 inch', 'description': 'new description'},
+            {'name': 'Screw', 'reorder_point': -1},
+            {'name': 'Screw', 'size': '2 inch', 'reorder_point': 50},
+            {'name': 'Plywood Sheet', 'size': '4 feet X 8 feet'},
+        ]
+        response = self.client.post(self.url, rows, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['created'], response.data['updated']), (2, 1))
+        self.assertEqual([error['row'] for error in response.data['errors']], [3, 5])
+        self.assertIn('size', response.data['errors'][0]['errors'])
+        self.assertIn('reorder_point', response.data['errors'][0]['errors'])
+        self.assertEqual(response.data['errors'][1]['errors']['non_field_errors'], ['Duplicate of row 1.'])
+        self.assertEqual(Material.objects.count(), 3)
+        material = Material.objects.get(pk=self.material.pk)
+        self.assertEqual(material.description, 'new description')
+        self.assertEqual(material.reorder_point, 4)
+        screw = Material.objects.get(name='Screw')
+        self.assertEqual(screw.reorder_point, 50)
+        self.assertTrue(MaterialStock.objects.filter(item=screw).exists())
+        self.assertEqual(list(screw.search_tokens.order_by('token').values_list('token', flat=True)), ['2', 'inch', 'screw'])
+
+    ''' Test a CSV file only updates the columns it has '''
+    def test_import_csv(self):
+        self.client.force_authenticate(user=self.user)
+        file = SimpleUploadedFile('materials.csv', '﻿name,size,reorder_point\nPine Board,1 inch X 6 inch,12\nNail,1 inch,\n'.encode('utf-8'), content_type='text/csv')
+        response = self.client.post(self.url, {'file': file}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['created'], response.data['updated'], response.data['errors']), (1, 1, []))
+        material = Material.objects.get(pk=self.material.pk)
+        self.assertEqual((material.description, material.reorder_point), ('old description', 12))
+        self.assertEqual(Material.objects.get(name='Nail').reorder_point, 0)
+
+    ''' Test each row only updates the values it gives, whatever columns the other rows give '''
+    def test_import_partial_rows(self):
+        self.client.force_authenticate(user=self.user)
+        rows = [{'name': 'Pine Board', 'size': '1 inch X 6 inch'}, {'name': 'Nail', 'size': '16d', 'reorder_point': 5}]
+        response = self.client.post(self.url, rows, format='json')
+        self.assertEqual((response.data['created'], response.data['updated']), (1, 1))
+        material = Material.objects.get(pk=self.material.pk)
+        self.assertEqual((material.description, material.reorder_point), ('old description', 4))
+        file = SimpleUploadedFile('materials.csv', 'name,size,description,reorder_point\nPine Board,1 inch X 6 inch,,9\nNail,16d,common nail,\n'.encode('utf-8'), content_type='text/csv')
+        response = self.client.post(self.url, {'file': file}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        material = Material.objects.get(pk=self.material.pk)
+        self.assertEqual((material.description, material.reorder_point), ('old description', 9))
+        nail = Material.objects.get(name='Nail')
+        self.assertEqual((nail.description, nail.reorder_point), ('common nail', 5))
+
+    ''' Test a large catalog is imported with a fixed number of queries '''
+    def test_import_query_count(self):
+        self.client.force_authenticate(user=self.user)
+        rows = [{'name': f'Screw {number}', 'size': f'{number} inch'} for number in range(2000)]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.url, rows, format='json')
+        self.assertEqual(response.data['created'], 2000)
+        # Rows are written in batches, limited on SQLite by the number of query parameters
+        self.assertLess(len(queries), 60)
+        self.assertEqual(MaterialStock.objects.filter(item__name__startswith='Screw').count(), 2000)
+
+    ''' Test payloads that are not rows are rejected '''
+    def test_import_invalid(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post(self.url, {'name': 'Screw', 'size': '2 inch'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('non_field_errors', response.data)
+        file = SimpleUploadedFile('materials.csv', b'\xff\xfe\x00name', content_type='text/csv')
+        response = self.client.post(self.url, {'file': file}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('file', response.data)
+
+''' Tests for inventory valuation view '''
+class TestInventoryValuationView(APITestCase):
+
+    ''' Setup for tests '''
+    @classmethod
+    def setUpTestData(cls):
+        cls.client = APIClient()
+        cls.date = timezone.now().date()
+        cls.supplier = Supplier.objects.create(name='supplier')
+        cls.address = SupplierAddress.objects.create(supplier=cls.supplier, street_address='123 Test Street', city='City', state='State', zip=12345)
+        cls.customer = Customer.objects.create(first_name='first', last_name='last', email='firstlast@email.com', phone='1 (234) 567-8901')
+        cls.service = Service.objects.create(name='test service')
+        cls.board = Material.objects.create(name='board', size='2 inch X 4 inch')
+        cls.nail = Material.objects.create(name='nail', size='1 inch')
+        cls.hammer = Tool.objects.create(name='hammer')
+        cls.saw = Tool.objects.create(name='saw')
+        purchase = Purchase.objects.create(supplier=cls.supplier, supplier_address=cls.address, tax=0, date=cls.date - timezone.timedelta(days=10))
+        PurchaseMaterial.objects.create(purchase=purchase, inventory_item=cls.board, quantity=10, cost=30.0)
+        PurchaseMaterial.objects.create(purchase=purchase, inventory_item=cls.board, quantity=10, cost=50.0)
+        PurchaseTool.objects.create(purchase=purchase, inventory_item=cls.hammer, quantity=2, cost=40.0)
+        PurchaseTool.objects.create(purchase=purchase, inventory_item=cls.hammer, quantity=1, cost=25.0)
+        order = Order.objects.create(customer=cls.customer, date=cls.date, description='test description', service=cls.service)
+        OrderMaterial.objects.create(order=order, inventory_item=cls.board, quantity=5)
+        cls.user = User.objects.create(first_name='first', last_name='last', email='firstlast@example.com', phone='1 (234) 567-8901', password=make_password('test1234'))
+
+    ''' Test every item is valued at its unit cost in a single query with totals by type '''
+    def test_get_valuation(self):
+        self.client.force_authenticate(user=self.user)
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('inventory-valuation'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        items = {(item['type'], item['name']): (item['on_hand'], item['unit_cost'], item['value']) for item in response.data['items']}
+        self.assertEqual(items, {
+            ('material', 'board'): (15, Decimal('5.00'), Decimal('75.00')),
+            ('material', 'nail'): (0, Decimal('0.00'), Decimal('0.00')),
+            ('tool', 'hammer'): (3, Decimal('25.00'), Decimal('75.00')),
+            ('tool', 'saw'): (0, Decimal('0.00'), Decimal('0.00')),
+        })
+        self.assertEqual([(total['type'], total['items'], total['on_hand'], total['value']) for total in response.data['totals']], [('material', 2, 15, Decimal('75.00')), ('tool', 2, 3, Decimal('75.00'))])
+        self.assertEqual(response.data['total'], Decimal('150.00'))
+
+    ''' Test materials are valued with the active costing strategy '''
+    @override_settings(INVENTORY_COSTING='average')
+    def test_get_valuation_average_cost(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(reverse('inventory-valuation'))
+        board = next(item for item in response.data['items'] if item['name'] == 'board')
+        self.assertEqual((board['unit_cost'], board['value']), (Decimal('4.00'), Decimal('60.00')))
+        self.assertEqual(Material.objects.get(pk=self.board.pk).unit_cost, board['unit_cost'])
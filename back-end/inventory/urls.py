@@ -1,10 +1,18 @@
-from inventory.views import MaterialView, ToolView
+from inventory.views import MaterialView, MaterialStockView, MaterialImportView, ToolView, ToolStockView, LowStockView, InventoryValuationView
 from django.urls import path
 
 urlpatterns = [
     path('material/', MaterialView.as_view(), name='material-list'),
     path('material/<int:pk>/', MaterialView.as_view(), name='material-detail'),
+    path('material/stock/', MaterialStockView.as_view(), name='material-stock-list'),
+    path('material/<int:pk>/stock/', MaterialStockView.as_view(), name='material-stock-detail'),
+    path('material/import/', MaterialImportView.as_view(), name='material-import'),
 
     path('tool/', ToolView.as_view(), name='tool-list'),
     path('tool/<int:pk>/', ToolView.as_view(), name='tool-detail'),
+    path('tool/stock/', ToolStockView.as_view(), name='tool-stock-list'),
+    path('tool/<int:pk>/stock/', ToolStockView.as_view(), name='tool-stock-detail'),
+
+    path('low-stock/', LowStockView.as_view(), name='low-stock'),
+    path('valuation/', InventoryValuationView.as_view(), name='inventory-valuation'),
 ]
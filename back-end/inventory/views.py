@@ -1,18 +1,42 @@
-from inventory.serializers import MaterialSerializer, ToolSerializer
+from inventory.serializers import MaterialSerializer, ToolSerializer, StockDateSerializer, LowStockFilterSerializer, MaterialImportSerializer
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
-from inventory.models import Material, Tool
+from inventory.models import Material, Tool, InventoryItemBase
+from utils.pagination import RankedPagination
 from rest_framework.views import APIView
 from rest_framework import status
+from django.utils import timezone
+from utils import money
+import csv
+
+'''
+    Mixin for inventory item views to search items with the q parameter
+    -------------------------------------------------------------------
+    A page of the ranked ids is found first and only those items are fetched with their stock and unit cost, so a
+    search costs two queries however large the catalog is.
+'''
+class InventorySearchMixin:
+    model = None
+    serializer_class = None
+
+    def search(self, request, query):
+        paginator = RankedPagination()
+        ids = paginator.paginate_queryset(self.model.objects.search(query).values_list('pk', flat=True), request)
+        items = self.model.objects.with_stock().in_bulk(ids)
+        serializer = self.serializer_class([items[pk] for pk in ids], many=True)
+        return paginator.get_paginated_response(serializer.data)
 
 '''
     CRUD view for material model
     ----------------------------
-    get method returns either single instance or list of all instances
+    get method returns either single instance or list of all instances with their stock and unit cost annotated
+    With the q parameter get returns a page of the materials matching the search, best matches first
 '''
-class MaterialView(APIView):
+class MaterialView(InventorySearchMixin, APIView):
     permission_classes = [IsAuthenticated]
+    model = Material
+    serializer_class = MaterialSerializer
 
     def get_object(self, pk=None):
         return Material.objects.get(pk=pk)
@@ -21,12 +45,14 @@ class MaterialView(APIView):
         pk = kwargs.pop('pk', None)
         if pk:
             try:
-                material = self.get_object(pk)
+                material = Material.objects.with_stock().get(pk=pk)
                 serializer = MaterialSerializer(material)
             except Material.DoesNotExist:
                 return Response({'detail': 'Material Not Found.'}, status=status.HTTP_404_NOT_FOUND)
+        elif 'q' in request.query_params:
+            return self.search(request, request.query_params['q'])
         else:
-            materials = Material.objects.all()
+            materials = Material.objects.with_stock()
             serializer = MaterialSerializer(materials, many=True)
         return Response(serializer.data)
 
@@ -57,13 +83,78 @@ class MaterialView(APIView):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+'''
+    View to import materials in bulk
+    --------------------------------
+    post method accepts a JSON array of materials, or a CSV file in the file field, with name, size, description and
+    reorder_point columns. Rows are validated without querying the database, then valid rows create a material or
+    update the material with the same name and size in batches. Only the description and reorder point values each row
+    gives are updated, so rows leaving a column out or empty keep the stored value. Invalid rows and rows repeating an earlier name and size are not imported and are returned with their
+    errors by row number, counting the first row as 1.
+'''
+class MaterialImportView(APIView):
+    permission_classes = [IsAuthenticated]
+    max_rows = 10000
+    update_fields = ['description', 'reorder_point']
+
+    def post(self, request, *args, **kwargs):
+        try:
+            rows = self.get_rows(request)
+        except ValidationError as error:
+            return Response(error.detail, status=status.HTTP_400_BAD_REQUEST)
+        serializer = MaterialImportSerializer()
+        materials = {}
+        rows_by_key = {}
+        groups = {}
+        errors = []
+        for number, row in enumerate(rows, start=1):
+            try:
+                data = serializer.run_validation(row)
+            except ValidationError as error:
+                errors.append({'row': number, 'errors': error.detail})
+                continue
+            key = (data['name'], data['size'])
+            if key in rows_by_key:
+                errors.append({'row': number, 'errors': {'non_field_errors': [f'Duplicate of row {rows_by_key[key]}.']}})
+                continue
+            rows_by_key[key] = number
+            materials[key] = Material(**data)
+            # Existing materials only have the columns a row supplied updated, so left out columns and empty cells keep their values
+            update_fields = tuple(field for field in self.update_fields if field in row)
+            groups.setdefault(update_fields, []).append(materials[key])
+        existing = set(Material.objects.filter(name__in={name for name, _ in materials}).values_list('name', 'size')) & materials.keys() if materials else set()
+        for update_fields, group in groups.items():
+            Material.objects.bulk_upsert(group, unique_fields=['name', 'size'], update_fields=list(update_fields))
+        return Response({'created': len(materials) - len(existing), 'updated': len(existing), 'errors': errors}, status=status.HTTP_200_OK)
+
+    ''' Read the rows of the import from the uploaded CSV file or the JSON array '''
+    def get_rows(self, request):
+        upload = request.FILES.get('file')
+        if upload is not None:
+            try:
+                reader = csv.DictReader(upload.read().decode('utf-8-sig').splitlines())
+                # Empty CSV cells are left out so the field defaults apply
+                rows = [{column: value for column, value in row.items() if column and value not in ('', None)} for row in reader]
+            except (UnicodeDecodeError, csv.Error):
+                raise ValidationError({'file': ['The file must be a UTF-8 encoded CSV file.']})
+        elif isinstance(request.data, list):
+            rows = request.data
+        else:
+            raise ValidationError({'non_field_errors': ['Provide a JSON array of materials or a CSV file.']})
+        if len(rows) > self.max_rows:
+            raise ValidationError({'non_field_errors': [f'At most {self.max_rows} rows can be imported at once.']})
+        return rows
+
 '''
     CRUD view for tool model
     ------------------------
-    get method returns either single instance or list of all instances
+    get method returns either single instance or list of all instances with their stock and unit cost annotated
+    With the q parameter get returns a page of the tools matching the search, best matches first
 '''
-class ToolView(APIView):
+class ToolView(InventorySearchMixin, APIView):
     permission_classes = [IsAuthenticated]
+    model = Tool
+    serializer_class = ToolSerializer
 
     def get_object(self, pk=None):
         return Tool.objects.get(pk=pk)
@@ -72,12 +163,14 @@ class ToolView(APIView):
         pk = kwargs.pop('pk', None)
         if pk:
             try:
-                tool = self.get_object(pk)
+                tool = Tool.objects.with_stock().get(pk=pk)
                 serializer = ToolSerializer(tool)
             except Tool.DoesNotExist:
                 return Response({'detail': 'Tool Not Found.'}, status=status.HTTP_404_NOT_FOUND)
+        elif 'q' in request.query_params:
+            return self.search(request, request.query_params['q'])
         else:
-            tools = Tool.objects.all()
+            tools = Tool.objects.with_stock()
             serializer = ToolSerializer(tools, many=True)
         return Response(serializer.data)
 
@@ -106,3 +199,105 @@ class ToolView(APIView):
         tool = self.get_object(pk)
         tool.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
+
+'''
+    Base view for the stock of inventory items on a date
+    ----------------------------------------------------
+    get method returns either the quantity on hand of a single item or of every item on the date parameter, today by default
+    The quantity on hand is read from the balance of the last movement on or before the date in the movement journal
+'''
+class InventoryStockView(APIView):
+    permission_classes = [IsAuthenticated]
+    model = None
+    not_found_message = None
+
+    def get(self, request, *args, **kwargs):
+        pk = kwargs.pop('pk', None)
+        serializer = StockDateSerializer(data=request.query_params.dict())
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        date = serializer.validated_data['date']
+        movement_model = self.model.get_stock_model().movement_model
+        items = self.model.objects.annotate(on_hand=movement_model.balance_on(date)).order_by('pk').values('id', 'name', 'on_hand')
+        if pk:
+            item = items.filter(pk=pk).first()
+            if item is None:
+                return Response({'detail': self.not_found_message}, status=status.HTTP_404_NOT_FOUND)
+            return Response({**item, 'date': date}, status=status.HTTP_200_OK)
+        return Response([{**item, 'date': date} for item in items], status=status.HTTP_200_OK)
+
+''' View for the stock of materials on a date '''
+class MaterialStockView(InventoryStockView):
+    model = Material
+    not_found_message = 'Material Not Found.'
+
+''' View for the stock of tools on a date '''
+class ToolStockView(InventoryStockView):
+    model = Tool
+    not_found_message = 'Tool Not Found.'
+
+'''
+    View for the inventory items at or below their reorder point
+    ------------------------------------------------------------
+    get method returns the low materials and tools, each kind found with a single query of the quantity on hand and the
+    usage by orders over the days parameter, 30 by default. Days of cover estimates how long the quantity on hand lasts
+    at that rate of usage and is empty for items that were not used. Items running out soonest are listed first.
+'''
+class LowStockView(APIView):
+    permission_classes = [IsAuthenticated]
+    items = [('material', Material, ['size']), ('tool', Tool, [])]
+
+    def get(self, request, *args, **kwargs):
+        serializer = LowStockFilterSerializer(data=request.query_params.dict())
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        days = serializer.validated_data['days']
+        item_type = serializer.validated_data.get('type')
+        end_date = timezone.localdate()
+        start_date = end_date - timezone.timedelta(days=days - 1)
+        low_stock = []
+        for name, model, fields in self.items:
+            if item_type and item_type != name:
+                continue
+            items = model.objects.low_stock().with_usage(start_date, end_date).order_by('pk').values('id', 'name', *fields, 'reorder_point', 'stock_on_hand', 'recent_usage')
+            low_stock.extend(self.get_item_data(name, item, days) for item in items)
+        low_stock.sort(key=lambda item: (item['days_of_cover'] is None, item['days_of_cover'] or 0, -item['shortfall']))
+        return Response(low_stock, status=status.HTTP_200_OK)
+
+    def get_item_data(self, name, item, days):
+        on_hand = max(item.pop('stock_on_hand'), 0)
+        daily_usage = item['recent_usage'] / days
+        return {
+            'type': name,
+            **item,
+            'on_hand': on_hand,
+            'shortfall': item['reorder_point'] - on_hand,
+            'daily_usage': round(daily_usage, 2),
+            'days_of_cover': round(on_hand / daily_usage, 1) if daily_usage else None,
+        }
+
+'''
+    View for the value of the inventory on hand
+    -------------------------------------------
+    get method returns the quantity on hand, unit cost and value of every material and tool, with the totals of each
+    type and of the whole inventory. Every item is read with a single union query, see with_valuation, and valued at
+    the same unit cost the material and tool views show.
+'''
+class InventoryValuationView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        rows = Material.objects.with_valuation().union(Tool.objects.with_valuation(), all=True).order_by('item_type', 'name', 'id')
+        items = []
+        totals = {}
+        for row in rows:
+            on_hand = max(row['on_hand'], 0)
+            unit_cost = InventoryItemBase.calculate_unit_cost(row['stock_unit_cost'], row['latest_purchase_cost'], row['latest_purchase_quantity'])
+            value = money.round_money(unit_cost * on_hand)
+            items.append({'type': row['item_type'], 'id': row['id'], 'name': row['name'], 'size': row['item_size'], 'on_hand': on_hand, 'unit_cost': unit_cost, 'value': value})
+            total = totals.setdefault(row['item_type'], {'type': row['item_type'], 'items': 0, 'on_hand': 0, 'value': money.ZERO})
+            total['items'] += 1
+            total['on_hand'] += on_hand
+            total['value'] += value
+        type_totals = list(totals.values())
+        return Response({'items': items, 'totals': type_totals, 'total': money.round_money(money.sum_money(total['value'] for total in type_totals))}, status=status.HTTP_200_OK)
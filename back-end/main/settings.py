@@ -155,6 +155,9 @@ if DEBUG == True:
     MEDIA_URL = '/media/'
     MEDIA_ROOT = Path(BASE_DIR, 'media')
 else:
+    # PostgreSQL lookups used to search inventory items by trigram similarity
+    INSTALLED_APPS.append('django.contrib.postgres')
+
     # Production database
     DATABASES = {
         'default': {
@@ -230,3 +233,6 @@ SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(hours=4),
     "REFRESH_TOKEN_LIFETIME": timedelta(days=7)
 }
+
+# Costing strategy for material unit costs and order material costs: latest, average or fifo
+INVENTORY_COSTING = os.environ.get('INVENTORY_COSTING', 'latest')
@@ -1,6 +1,17 @@
+from django.db.models.signals import post_delete
 from django.apps import AppConfig
 
 
 class OrderConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'order'
+
+    def ready(self):
+        from inventory.models import remove_deleted_line_stock, replay_deleted_line_costs
+        from order.models import OrderMaterial, OrderTool, OrderCost, OrderWorkLog, OrderPayment, update_deleted_line_totals
+        # Lines deleted in cascade skip their delete method, so the stock, costs and order totals are kept up to date by signals
+        for model in [OrderMaterial, OrderTool]:
+            post_delete.connect(remove_deleted_line_stock, sender=model)
+        post_delete.connect(replay_deleted_line_costs, sender=OrderMaterial)
+        for model in [OrderMaterial, OrderCost, OrderWorkLog, OrderPayment]:
+            post_delete.connect(update_deleted_line_totals, sender=model)
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from order.models import Order, OrderQuerySet
+from django.db import transaction
+
+class Command(BaseCommand):
+    help = 'Rebuilds the stored order totals from work logs, materials, line items and payments and reconciles any that have drifted.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-b', '--batch-size', type=int, default=500, help='Define how many orders are priced and updated per batch.')
+        parser.add_argument('-d', '--dry-run', action='store_true', help='Report orders with drifted totals without updating them.')
+
+    def handle(self, *args, **kwargs):
+        batch_size = kwargs['batch_size']
+        dry_run = kwargs['dry_run']
+        checked = 0
+        changed = []
+        reconciled = 0
+
+        # Price every order in one query per chunk using the database calculated totals
+        for order in Order.objects.with_totals().order_by('pk').iterator(chunk_size=batch_size):
+            checked += 1
+            stored_totals = [getattr(order, field) for field in Order.TOTAL_FIELDS]
+            order.set_totals(**{field: getattr(order, field) for field in OrderQuerySet.CALCULATED_FIELDS})
+            if stored_totals != [getattr(order, field) for field in Order.TOTAL_FIELDS]:
+                changed.append(order)
+                if dry_run:
+                    self.stdout.write(self.style.WARNING(f'Order {order.pk} totals have drifted.'))
+            if len(changed) >= batch_size:
+                reconciled += self._update_totals(changed, dry_run)
+                changed = []
+        reconciled += self._update_totals(changed, dry_run)
+
+        # Indicate reconciliation is complete
+        if dry_run:
+            self.stdout.write(self.style.SUCCESS(f'{reconciled} of {checked} orders have drifted totals.'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Reconciled totals for {reconciled} of {checked} orders.'))
+
+    def _update_totals(self, orders, dry_run):
+        if orders and not dry_run:
+            with transaction.atomic():
+                Order.objects.bulk_update(orders, Order.TOTAL_FIELDS)
+        return len(orders)
@@ -0,0 +1,68 @@
+from order.models import Order, OrderMaterial, OrderQuerySet
+from django.core.management.base import BaseCommand
+from django.db.models import OuterRef, Subquery
+from purchase.models import PurchaseMaterial
+from django.db import transaction
+from utils import money
+
+class Command(BaseCommand):
+    help = 'Snapshots the cost of order materials from the latest purchase on or before each order date and updates the order totals.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-b', '--batch-size', type=int, default=500, help='Define how many order materials are updated per batch.')
+        parser.add_argument('-a', '--all', action='store_true', help='Snapshot every order material instead of only those without a cost.')
+
+    def handle(self, *args, **kwargs):
+        batch_size = kwargs['batch_size']
+        order_materials = OrderMaterial.objects.all() if kwargs['all'] else OrderMaterial.objects.filter(cost=0)
+
+        # Find the purchase each line is priced from in the same query, preferring purchases made by the order date
+        purchases = PurchaseMaterial.objects.filter(inventory_item=OuterRef('inventory_item'), quantity__gt=0).order_by('-id')
+        dated_purchases = purchases.filter(purchase__date__lte=OuterRef('order__date')).order_by('-purchase__date', '-id')
+        order_materials = order_materials.annotate(
+            dated_purchase_cost=Subquery(dated_purchases.values('cost')[:1]),
+            dated_purchase_quantity=Subquery(dated_purchases.values('quantity')[:1]),
+            latest_purchase_cost=Subquery(purchases.values('cost')[:1]),
+            latest_purchase_quantity=Subquery(purchases.values('quantity')[:1]),
+        ).order_by('pk')
+
+        changed = []
+        orders = set()
+        snapshotted = 0
+        for order_material in order_materials.iterator(chunk_size=batch_size):
+            if order_material.dated_purchase_quantity:
+                unit_cost = money.round_money(money.to_decimal(order_material.dated_purchase_cost) / order_material.dated_purchase_quantity)
+            elif order_material.latest_purchase_quantity:
+                unit_cost = money.round_money(money.to_decimal(order_material.latest_purchase_cost) / order_material.latest_purchase_quantity)
+            else:
+                unit_cost = money.round_money(0)
+            cost = money.round_money(unit_cost * order_material.quantity)
+            if cost != order_material.cost:
+                order_material.cost = cost
+                changed.append(order_material)
+                orders.add(order_material.order_id)
+            if len(changed) >= batch_size:
+                snapshotted += self._update_costs(changed)
+                changed = []
+        snapshotted += self._update_costs(changed)
+
+        # Reprice the orders whose materials changed from the new snapshots
+        orders = sorted(orders)
+        for start in range(0, len(orders), batch_size):
+            self._update_totals(orders[start:start + batch_size])
+
+        # Indicate snapshot is complete
+        self.stdout.write(self.style.SUCCESS(f'Snapshotted costs for {snapshotted} order materials across {len(orders)} orders.'))
+
+    def _update_costs(self, order_materials):
+        if order_materials:
+            with transaction.atomic():
+                OrderMaterial.objects.bulk_update(order_materials, ['cost'])
+        return len(order_materials)
+
+    def _update_totals(self, order_pks):
+        with transaction.atomic():
+            orders = list(Order.objects.select_for_update().with_totals().filter(pk__in=order_pks))
+            for order in orders:
+                order.set_totals(**{field: getattr(order, field) for field in OrderQuerySet.CALCULATED_FIELDS})
+            Order.objects.bulk_update(orders, Order.TOTAL_FIELDS)
@@ -1,13 +1,115 @@
 from django.core.validators import MinValueValidator, MaxValueValidator, MinLengthValidator, MaxLengthValidator
+from django.db.models import Count, DecimalField, DurationField, ExpressionWrapper, F, OuterRef, Prefetch, Subquery, Sum, Value
+from inventory.models import Material, Tool, StockMovementMixin, MaterialCostingMixin, MaterialStock
 from django.core.exceptions import ValidationError
+from django.db.models.functions import Cast, Coalesce, Concat, Greatest, TruncMonth
 from utils.fields import PresignedURLImageField
 from utils.mixins import AtomicOperationsMixin
-from inventory.models import Material, Tool
+from utils.functions import DurationHours
 from customer.models import Customer
 from service.models import Service
 from user.models import User
-from django.db import models
+from django.db import models, transaction
 from decimal import Decimal
+from utils import money
+
+''' Queryset for orders with support for database calculated totals '''
+class OrderQuerySet(models.QuerySet):
+
+    CALCULATED_FIELDS = ['calculated_hours_worked', 'calculated_material_cost', 'calculated_line_total', 'calculated_payment_total']
+    MINIMUM_HOURS = 3
+
+    '''
+        Build the billable hours of an order from its work logs
+        ---------------------------------------------------------
+        order_ref: the field of the outer query holding the order id, pk for orders and order for order related rows
+        The work log durations are summed and the minimum hours applied in the database, so hours are never
+        calculated by loading the work logs.
+    '''
+    @classmethod
+    def hours_worked_expression(cls, order_ref='pk'):
+        work_time = OrderWorkLog.objects.filter(order=OuterRef(order_ref)).values('order').annotate(total=Sum(F('end') - F('start'), output_field=DurationField())).values('total')
+        hours = DecimalField(max_digits=12, decimal_places=6)
+        return Greatest(Coalesce(DurationHours(Subquery(work_time, output_field=DurationField())), Value(0), output_field=hours), Value(cls.MINIMUM_HOURS), output_field=hours)
+
+    ''' Annotate the billable hours of each order '''
+    def with_hours_worked(self):
+        return self.annotate(calculated_hours_worked=self.hours_worked_expression())
+
+    '''
+        Annotate the values every order total is derived from
+        -------------------------------------------------------
+        All totals are calculated with correlated subqueries so a list of orders is priced in a single query.
+        Materials are priced from the cost stored on each order material, so new purchases never change past orders.
+        Used to rebuild the stored order totals whenever an order or one of its line items changes.
+    '''
+    def with_totals(self):
+        materials = OrderMaterial.objects.filter(order=OuterRef('pk')).values('order').annotate(total=Sum('cost')).values('total')
+        costs = OrderCost.objects.filter(order=OuterRef('pk')).values('order').annotate(total=Sum('cost')).values('total')
+        payments = OrderPayment.objects.filter(order=OuterRef('pk')).values('order').annotate(total=Sum('total')).values('total')
+        return self.annotate(
+            calculated_hours_worked=self.hours_worked_expression(),
+            calculated_material_cost=Subquery(materials, output_field=models.DecimalField(max_digits=10, decimal_places=2)),
+            calculated_line_total=Subquery(costs, output_field=models.DecimalField(max_digits=10, decimal_places=2)),
+            calculated_payment_total=Subquery(payments, output_field=models.DecimalField(max_digits=10, decimal_places=2)),
+        )
+
+    '''
+        Group the orders and add up their stored totals in the database
+        -----------------------------------------------------------------
+        group_by: month, service or customer
+        Each row holds the group, the number of orders and the sums of their labor, material, line item, callout,
+        subtotal, total, collected and outstanding amounts. Tax and discount are summed as subtotal times the
+        percentage, tax_basis and discount_basis, so the division by one hundred happens once per group in Decimal.
+    '''
+    def revenue(self, group_by='month'):
+        amount = DecimalField(max_digits=24, decimal_places=6)
+        labor = ExpressionWrapper(F('hourly_rate') * F('hours_worked'), output_field=amount)
+        subtotal = ExpressionWrapper(labor + F('material_total') + F('line_total') + Cast('callout', amount), output_field=amount)
+        groups = {
+            'month': {'month': TruncMonth('date')},
+            'service': {'service_name': F('service__name')},
+            'customer': {'customer_name': Concat('customer__first_name', Value(' '), 'customer__last_name')},
+        }
+        keys = {'month': ['month'], 'service': ['service', 'service_name'], 'customer': ['customer', 'customer_name']}[group_by]
+        # Calculate the per order amounts before grouping, as the group sums reuse the stored total names
+        orders = self.order_by().annotate(
+            order_labor=labor,
+            order_callout=Cast('callout', amount),
+            order_subtotal=subtotal,
+            order_tax_basis=ExpressionWrapper(subtotal * F('tax'), output_field=amount),
+            order_discount_basis=ExpressionWrapper(subtotal * F('discount'), output_field=amount),
+            **groups[group_by],
+        )
+        return orders.values(*keys).annotate(
+            orders=Count('id'),
+            labor_total=Sum('order_labor'),
+            material_total=Sum('material_total'),
+            line_total=Sum('line_total'),
+            callout_total=Sum('order_callout'),
+            subtotal=Sum('order_subtotal'),
+            tax_basis=Sum('order_tax_basis'),
+            discount_basis=Sum('order_discount_basis'),
+            total=Sum('total'),
+            collected=Sum('payment_total'),
+            outstanding=Sum('working_total'),
+        ).order_by(keys[0])
+
+    '''
+        Prefetch the pictures, line items, materials and tools serialized with each order
+        ----------------------------------------------------------------------------------
+        line_items: names of the related lists to prefetch (images, costs, materials, tools), all of them when not given
+    '''
+    def with_line_items(self, line_items=None):
+        prefetches = {
+            'images': 'images',
+            'costs': 'costs',
+            'materials': Prefetch('ordermaterial_set', queryset=OrderMaterial.objects.select_related('inventory_item').order_by('pk')),
+            'tools': Prefetch('ordertool_set', queryset=OrderTool.objects.select_related('inventory_item').order_by('pk')),
+        }
+        if line_items is None:
+            line_items = prefetches.keys()
+        return self.prefetch_related(*[prefetches[name] for name in line_items if name in prefetches])
 
 ''' Model for orders '''
 class Order(models.Model):
@@ -26,25 +128,30 @@ class Order(models.Model):
     discount = models.DecimalField(max_digits=10, decimal_places=2, default=0.0, validators=[MinValueValidator(Decimal(0.0)), MaxValueValidator(Decimal(100.0))])
     notes = models.CharField(max_length=10000, validators=[MaxLengthValidator(10000)], null=True, blank=True)
     callout = models.FloatField(choices=CALLOUT_CHOICES.choices, default=CALLOUT_CHOICES.STANDARD)
+    # Stored totals, kept up to date by the order and its work logs, materials, line items and payments
+    hours_worked = models.DecimalField(max_digits=12, decimal_places=6, default=3.0, editable=False)
+    material_total = models.DecimalField(max_digits=10, decimal_places=2, default=0.0, editable=False)
+    line_total = models.DecimalField(max_digits=10, decimal_places=2, default=0.0, editable=False)
+    payment_total = models.DecimalField(max_digits=10, decimal_places=2, default=0.0, editable=False)
+    total = models.DecimalField(max_digits=10, decimal_places=2, default=0.0, editable=False)
+    working_total = models.DecimalField(max_digits=10, decimal_places=2, default=0.0, editable=False)
 
-    ''' Dynamically calculate order hours worked '''
-    @property
-    def hours_worked(self):
-        work_logs = OrderWorkLog.objects.filter(order=self)
-        total_hours = sum((log.end - log.start).total_seconds() / 3600 for log in work_logs)
-        return Decimal(max(float(total_hours), 3.0))
+    objects = OrderQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['date', 'id'], name='order_date_id_idx'),
+            models.Index(fields=['customer', 'date'], name='order_customer_date_idx'),
+            models.Index(fields=['service', 'date'], name='order_service_date_idx'),
+            models.Index(fields=['completed', 'working_total'], name='order_status_idx'),
+        ]
+
+    TOTAL_FIELDS = ['hours_worked', 'material_total', 'line_total', 'payment_total', 'total', 'working_total']
 
     ''' Dynamically calculate order labor total '''
     @property
     def labor_total(self):
-        return Decimal(max(float(self.hourly_rate) * float(self.hours_worked), 0.0))
-
-    ''' Dynamically calculate the order material total based '''
-    @property
-    def material_total(self):
-        materials = OrderMaterial.objects.filter(order__pk=self.pk)
-        total_material_costs = sum((material.inventory_item.unit_cost * material.quantity) for material in materials)
-        return Decimal(max(float(total_material_costs) * (1 + float(self.material_upcharge) / 100), 0.0))
+        return money.labor_total(self.hourly_rate, self.hours_worked)
 
     ''' Dynamically calculate the order asset total '''
     # @property
@@ -53,41 +160,20 @@ class Order(models.Model):
     #     total_asset_costs = sum((asset.instance.rental_cost * asset.usage) for asset in assets)
     #     return Decimal(max(float(total_asset_costs), 0.0)).quantize(Decimal('0.01'))
 
-    ''' Dynamically calculate the order line item total '''
-    @property
-    def line_total(self):
-        costs = OrderCost.objects.filter(order__pk=self.pk)
-        return max(Decimal(sum(cost.cost for cost in costs)), Decimal(0.0))
-
     ''' Dynamically calculate the order subtotal '''
     @property
     def subtotal(self):
-        return Decimal(max(float(self.labor_total) + float(self.material_total) + float(self.line_total) + float(self.callout), 0))
+        return money.order_subtotal(self.labor_total, self.material_total, self.line_total, self.callout)
 
     ''' Dynamically calculate the order tax total '''
     @property
     def tax_total(self):
-        return Decimal(max((float(self.tax) / 100) * float(self.subtotal), 0.0))
+        return money.non_negative(money.percent_of(self.subtotal, self.tax))
 
     ''' Dynamically calculate the order discount total '''
     @property
     def discount_total(self):
-        return Decimal(max((float(self.discount) / 100) * float(self.subtotal), 0.0))
-
-    ''' Dynamically calculate the order total '''
-    @property
-    def total(self):
-        return Decimal(max(float(self.subtotal) + float(self.tax_total) - float(self.discount_total), 0.0))
-
-    ''' Dynamically calculate the total from payments on an order '''
-    @property
-    def payment_total(self):
-        return Decimal(max(float(sum(payment.total for payment in OrderPayment.objects.filter(order=self))), 0.0))
-
-    ''' Dynamically calculate the order working total or total due '''
-    @property
-    def working_total(self):
-        return Decimal(max(float(self.total) - float(self.payment_total), 0.0))
+        return money.non_negative(money.percent_of(self.subtotal, self.discount))
 
     ''' Dynamically calculate if the order is paid '''
     @property
@@ -97,8 +183,75 @@ class Order(models.Model):
         else:
             return False
 
+    '''
+        Set the stored totals from the values calculated by the with_totals queryset annotations
+        ------------------------------------------------------------------------------------------
+        The order is priced with the stored hours and material total so the total always matches its parts.
+    '''
+    def set_totals(self, calculated_hours_worked=None, calculated_material_cost=None, calculated_line_total=None, calculated_payment_total=None):
+        if calculated_hours_worked is None:
+            calculated_hours_worked = OrderQuerySet.MINIMUM_HOURS
+        self.hours_worked = money.to_decimal(calculated_hours_worked).quantize(Decimal('0.000001'))
+        price = money.price_order(self.hourly_rate, self.hours_worked, calculated_material_cost, self.material_upcharge, calculated_line_total, self.callout, self.tax, self.discount, calculated_payment_total)
+        self.material_total = price.material_total
+        self.line_total = price.line_total
+        self.payment_total = price.payment_total
+        self.total = price.total
+        self.working_total = price.working_total
+
+    ''' Recalculate and store the order totals, locking the order row so concurrent line item changes are applied in turn '''
+    def update_totals(self):
+        with transaction.atomic():
+            totals = Order.objects.select_for_update().with_totals().filter(pk=self.pk).values(*OrderQuerySet.CALCULATED_FIELDS).first()
+            if totals is None:
+                return
+            self.set_totals(**totals)
+            Order.objects.filter(pk=self.pk).update(**{field: getattr(self, field) for field in self.TOTAL_FIELDS})
+
+    ''' Override save method to recalculate the stored totals when the order rates change and move the stock used and replay the material costs when the date changes '''
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            previous = Order.objects.with_totals().filter(pk=self.pk).values('date', *OrderQuerySet.CALCULATED_FIELDS).first() if self.pk else None
+            previous_date = previous.pop('date') if previous else None
+            self.set_totals(**(previous or {}))
+            super().save(*args, **kwargs)
+            if previous_date is not None and previous_date != self.date:
+                OrderMaterial.redate_stock(self.ordermaterial_set.all(), previous_date, self.date)
+                OrderTool.redate_stock(self.ordertool_set.all(), previous_date, self.date)
+                OrderMaterial.rebuild_costs(self.ordermaterial_set.all())
+
+''' Mixin to keep the stored order totals up to date when an order line item is saved, deleted line items are handled by update_deleted_line_totals '''
+class OrderTotalsMixin:
+
+    ''' Override save method to update the order totals in the same transaction '''
+    def save(self, *args, **kwargs):
+        with self.save_transaction():
+            super().save(*args, **kwargs)
+            self.order.update_totals()
+
+    ''' Determine if a line item is deleted in cascade with its order, by deleting the order or a customer or service it belongs to '''
+    def is_deleted_with_order(self, origin):
+        if isinstance(origin, Order):
+            return origin.pk == self.order_id
+        owners = [Order] + [field.related_model for field in Order._meta.concrete_fields if field.is_relation and field.remote_field.on_delete is models.CASCADE]
+        return (origin.model if isinstance(origin, models.QuerySet) else type(origin)) in owners
+
+'''
+    Update the stored totals of the order of a deleted line item
+    ------------------------------------------------------------
+    Connected to post_delete of each line item model, which Django also sends for line items deleted in cascade, such
+    as the order materials of a deleted material. Line items deleted with their order are skipped, as are orders that
+    no longer exist, and an order already loaded on the line item is used instead of reading it again.
+'''
+def update_deleted_line_totals(sender, instance, origin=None, **kwargs):
+    if instance.is_deleted_with_order(origin):
+        return
+    order = instance.order if instance._meta.get_field('order').is_cached(instance) else Order.objects.filter(pk=instance.order_id).first()
+    if order is not None:
+        order.update_totals()
+
 ''' Model for order work logs '''
-class OrderWorkLog(AtomicOperationsMixin, models.Model):
+class OrderWorkLog(OrderTotalsMixin, AtomicOperationsMixin, models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='work_logs')
     start = models.DateTimeField()
     end = models.DateTimeField()
@@ -113,7 +266,7 @@ class OrderWorkLog(AtomicOperationsMixin, models.Model):
         super().save(*args, **kwargs)
 
 ''' Model for order line item charges '''
-class OrderCost(AtomicOperationsMixin, models.Model):
+class OrderCost(OrderTotalsMixin, AtomicOperationsMixin, models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='costs')
     name = models.CharField(max_length=300, validators=[MinLengthValidator(2), MaxLengthValidator(300)])
     cost = models.DecimalField(max_digits=10, decimal_places=2, default=0.0, validators=[MinValueValidator(Decimal(0.0))])
@@ -128,52 +281,49 @@ class OrderPicture(AtomicOperationsMixin, models.Model):
     image = PresignedURLImageField(folder_name='orders', null=True, blank=True)
 
 ''' Abstract base model for order inventory items with shared fields and overrides '''
-class OrderInventory(AtomicOperationsMixin, models.Model):
+class OrderInventory(AtomicOperationsMixin, StockMovementMixin, models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(validators=[MinValueValidator(0)])
 
+    STOCK_PARENT = 'order'
+
     # Ensures model is abstract and not created in database
     class Meta:
         abstract = True
 
-    ''' Overrides save method to ensure inventory is refreshed '''
-    def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        if hasattr(self.inventory_item, 'items_used'):
-            self.inventory_item.items_used.add(self)
-        elif hasattr(self.inventory_item, 'items_broken'):
-            self.inventory_item.items_broken.add(self)
-        self.inventory_item.refresh_from_db()
-
-    ''' Overrides save method to ensure inventory is refreshed '''
-    def delete(self, *args, **kwargs):
-        super().delete(*args, **kwargs)
-        if hasattr(self.inventory_item, 'items_used'):
-            self.inventory_item.items_used.remove(self)
-        elif hasattr(self.inventory_item, 'items_broken'):
-            self.inventory_item.items_broken.remove(self)
-        self.inventory_item.refresh_from_db()
-
 ''' Model for materials used in an order '''
-class OrderMaterial(OrderInventory):
+class OrderMaterial(OrderTotalsMixin, MaterialCostingMixin, OrderInventory):
     inventory_item = models.ForeignKey(Material, on_delete=models.CASCADE, related_name='order_materials')
     cost = models.DecimalField(max_digits=10, decimal_places=2, validators=[MinValueValidator(Decimal(0.0))], default=0.0)
 
+    STOCK_COUNTS = {'used': 'quantity'}
+    COST_MOVE = 'issue'
+
     '''
         Override save method to auto calculate cost
-        Calculate cost based on the unit_cost and quantity
+        Calculate cost based on the quantity and the active costing strategy, or the unit_cost when the material is not costed yet
+        The cost of an existing line is kept when the material changes only if the cost was changed with it
     '''
     def save(self, *args, **kwargs):
-        # Only calculate if cost is not set or is 0
-        if not self.cost or self.cost == Decimal('0.0'):
-            self.cost = Decimal(float(self.inventory_item.unit_cost) * float(self.quantity)).quantize(Decimal('0.01'))
-        super().save(*args, **kwargs)
+        with self.save_transaction() as previous:
+            # Only calculate if cost is not set or is 0, or is still the snapshot of a different material
+            item_changed = previous is not None and previous.inventory_item_id != self.inventory_item_id and previous.cost == self.cost
+            if not self.cost or self.cost == Decimal('0.0') or item_changed:
+                cost = MaterialStock.cost_of(self.inventory_item_id, self.quantity)
+                self.cost = cost if cost is not None else money.round_money(self.inventory_item.unit_cost * money.to_decimal(self.quantity))
+            elif previous is not None:
+                # Keep the snapshot unit cost when only the quantity of an existing line changes
+                if previous.quantity and previous.quantity != self.quantity and previous.cost == self.cost:
+                    self.cost = money.round_money(money.to_decimal(previous.cost) / previous.quantity * self.quantity)
+            super().save(*args, **kwargs)
 
 ''' Model for tools used and broken in an order '''
 class OrderTool(OrderInventory):
     inventory_item = models.ForeignKey(Tool, on_delete=models.CASCADE, related_name='order_tools')
     quantity_broken = models.PositiveIntegerField(default=0, validators=[MinValueValidator(0)])
 
+    STOCK_COUNTS = {'used': 'quantity', 'broken': 'quantity_broken'}
+
 ''' Model for assets used in an order '''
 # class OrderAsset(AtomicOperationsMixin, models.Model):
 #     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='assets')
@@ -198,7 +348,7 @@ class OrderTool(OrderInventory):
 #         self.order.save()
 
 ''' Model for payments made to an order '''
-class OrderPayment(AtomicOperationsMixin, models.Model):
+class OrderPayment(OrderTotalsMixin, AtomicOperationsMixin, models.Model):
     class PAYMENT_CHOICES(models.TextChoices):
         CASH = 'cash', 'Cash'
         CHECK = 'check', 'Check'
@@ -209,12 +359,25 @@ class OrderPayment(AtomicOperationsMixin, models.Model):
     total = models.DecimalField(max_digits=10, decimal_places=2, default=0.0, validators=[MinValueValidator(Decimal(0.0))])
     notes = models.CharField(max_length=255, validators=[MaxLengthValidator(255)], blank=True, null=True)
 
+''' Queryset for order workers with support for database calculated pay '''
+class OrderWorkerQuerySet(models.QuerySet):
+
+    ''' Annotate the billable hours of each worker's order and the pay earned at the worker's pay rate, for payroll queries '''
+    def with_pay(self):
+        return self.annotate(calculated_hours_worked=OrderQuerySet.hours_worked_expression('order')).annotate(
+            calculated_pay=Cast(F('user__pay_rate') * F('calculated_hours_worked'), output_field=DecimalField(max_digits=18, decimal_places=6))
+        )
+
 ''' Model for workers involved in an order '''
 class OrderWorker(AtomicOperationsMixin, models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='workers')
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='orders')
     total = models.DecimalField(max_digits=10, decimal_places=2, default=0.0, validators=[MinValueValidator(Decimal(0.0))])
 
+    objects = OrderWorkerQuerySet.as_manager()
+
+    ''' Override save method to price the worker with the order hours calculated in the database '''
     def save(self, *args, **kwargs):
-        self.total = Decimal(float(self.user.pay_rate) * float(self.order.hours_worked)).quantize(Decimal('0.01'))
+        hours_worked = Order.objects.with_hours_worked().filter(pk=self.order_id).values_list('calculated_hours_worked', flat=True).first()
+        self.total = money.round_money(money.labor_total(self.user.pay_rate, hours_worked))
         super().save(*args, **kwargs)
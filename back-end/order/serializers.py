@@ -1,4 +1,6 @@
 from order.models import Order, OrderCost, OrderMaterial, OrderTool, OrderPicture, OrderPayment, OrderWorkLog, OrderWorker
+from utils.serializers import DynamicFieldsMixin, DateRangeSerializer
+from inventory.models import InsufficientStock
 from rest_framework import serializers
 from decimal import Decimal
 
@@ -20,7 +22,7 @@ class OrderCostSerializer(serializers.ModelSerializer):
         model = OrderCost
         fields = ['id', 'order', 'name', 'cost']
 
-''' Serializer for order material model '''
+''' Serializer for order material model, reserving the stock of the material so orders can not use more than is on hand '''
 class OrderMaterialSerializer(serializers.ModelSerializer):
     name = serializers.CharField(source='inventory_item.name', read_only=True)
 
@@ -28,6 +30,21 @@ class OrderMaterialSerializer(serializers.ModelSerializer):
         model = OrderMaterial
         fields = ['id', 'order', 'inventory_item', 'name', 'quantity', 'cost']
 
+    def create(self, validated_data):
+        return self.save_reserved(OrderMaterial(**validated_data))
+
+    def update(self, instance, validated_data):
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+        return self.save_reserved(instance)
+
+    def save_reserved(self, instance):
+        try:
+            instance.save(reserve_stock=True)
+        except InsufficientStock as error:
+            raise serializers.ValidationError({'quantity': [f'Only {error.available} of {instance.inventory_item.name} are in stock.']})
+        return instance
+
 ''' Serializer for order tool model '''
 class OrderToolSerializer(serializers.ModelSerializer):
     name = serializers.CharField(source='inventory_item.name', read_only=True)
@@ -57,17 +74,28 @@ class OrderWorkerSerializer(serializers.ModelSerializer):
         model = OrderWorker
         fields = ['id', 'order', 'user', 'total']
 
-''' Serializer for order model '''
-class OrderSerializer(serializers.ModelSerializer):
+'''
+    Serializer for order model
+    --------------------------
+    Accepts fields and expand arguments to only serialize the requested fields and nested serializers
+'''
+class OrderSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     images = OrderPictureSerializer(many=True, read_only=True)
     uploaded_images = serializers.ListField(child = serializers.ImageField(max_length=1000000, allow_empty_file=False, use_url=False), write_only=True, required=False)
-    materials = OrderMaterialSerializer(many=True, read_only=True)
-    tools = OrderToolSerializer(many=True, read_only=True)
+    materials = OrderMaterialSerializer(source='ordermaterial_set', many=True, read_only=True)
+    tools = OrderToolSerializer(source='ordertool_set', many=True, read_only=True)
     costs = OrderCostSerializer(many=True, read_only=True)
+    hours_worked = serializers.DecimalField(max_digits=12, decimal_places=6, coerce_to_string=False, read_only=True)
+    material_total = serializers.DecimalField(max_digits=10, decimal_places=2, coerce_to_string=False, read_only=True)
+    line_total = serializers.DecimalField(max_digits=10, decimal_places=2, coerce_to_string=False, read_only=True)
+    payment_total = serializers.DecimalField(max_digits=10, decimal_places=2, coerce_to_string=False, read_only=True)
+    total = serializers.DecimalField(max_digits=10, decimal_places=2, coerce_to_string=False, read_only=True)
+    working_total = serializers.DecimalField(max_digits=10, decimal_places=2, coerce_to_string=False, read_only=True)
 
     class Meta:
         model = Order
         fields = ['id', 'customer', 'callout', 'date', 'description', 'service', 'hourly_rate', 'hours_worked', 'labor_total', 'material_upcharge', 'material_total', 'line_total', 'subtotal', 'tax', 'tax_total','completed', 'paid', 'discount', 'discount_total', 'total', 'payment_total', 'working_total', 'notes', 'images', 'uploaded_images', 'materials', 'tools', 'costs']
+        expandable_fields = ['images', 'materials', 'tools', 'costs']
 
     ''' Override create method to handle uploading images '''
     def create(self, validated_data):
@@ -95,3 +123,32 @@ class OrderSerializer(serializers.ModelSerializer):
         for image in uploaded_images:
             OrderPicture.objects.create(order=instance, image=image)
         return instance
+
+''' Serializer for validating order list filters passed as query parameters '''
+class OrderFilterSerializer(DateRangeSerializer):
+    completed = serializers.BooleanField(required=False)
+    paid = serializers.BooleanField(required=False)
+    customer = serializers.IntegerField(required=False, min_value=1)
+    service = serializers.IntegerField(required=False, min_value=1)
+
+    ''' Apply the validated filters to an order queryset so they run in the database '''
+    def filter_queryset(self, queryset):
+        filters = self.validated_data
+        if 'completed' in filters:
+            queryset = queryset.filter(completed=filters['completed'])
+        if 'paid' in filters:
+            # Orders are paid once nothing is left due on the stored working total
+            queryset = queryset.filter(working_total__lte=0) if filters['paid'] else queryset.filter(working_total__gt=0)
+        if 'customer' in filters:
+            queryset = queryset.filter(customer_id=filters['customer'])
+        if 'service' in filters:
+            queryset = queryset.filter(service_id=filters['service'])
+        if 'start_date' in filters:
+            queryset = queryset.filter(date__gte=filters['start_date'])
+        if 'end_date' in filters:
+            queryset = queryset.filter(date__lte=filters['end_date'])
+        return queryset
+
+''' Serializer for the revenue report parameters, accepting the order list filters and how to group the orders '''
+class RevenueReportFilterSerializer(OrderFilterSerializer):
+    group_by = serializers.ChoiceField(choices=['month', 'service', 'customer'], default='month')
@@ -1,5 +1,5 @@
 from order.serializers import OrderSerializer, OrderCostSerializer, OrderPictureSerializer, OrderMaterialSerializer, OrderToolSerializer, OrderPaymentSerializer, OrderWorkerSerializer
-from order.models import Order, OrderWorkLog, OrderCost, OrderPicture, OrderMaterial, OrderTool, OrderPayment, OrderWorker
+from order.models import Order, OrderQuerySet, OrderWorkLog, OrderCost, OrderPicture, OrderMaterial, OrderTool, OrderPayment, OrderWorker
 from django.core.files.uploadedfile import SimpleUploadedFile
 from rest_framework.test import APITestCase, APIClient
 from purchase.models import Purchase, PurchaseMaterial
@@ -7,18 +7,28 @@ from supplier.models import Supplier, SupplierAddress
 from django.contrib.auth.hashers import make_password
 from django.contrib.staticfiles.finders import find
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.test.utils import CaptureQueriesContext
+from rest_framework.exceptions import ValidationError as DRFValidationError
 from rest_framework.fields import DateTimeField
-from inventory.models import Material, Tool
+from inventory.models import Material, MaterialStock, Tool
 from customer.models import Customer
 from service.models import Service
 from django.utils import timezone
 from rest_framework import status
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.conf import settings
+from django.db import OperationalError, connection
 from django.urls import reverse
 from user.models import User
 from decimal import Decimal
+from io import StringIO
+from utils import money
+import threading
 import shutil
+import time
+import json
+import csv
 
 ''' Tests for order models '''
 class TestOrderModels(TestCase):
@@ -150,6 +160,155 @@ class TestOrderModels(TestCase):
     def test_order_worker_save(self):
         self.assertAlmostEqual(float(self.order_worker.total), float(self.user.pay_rate) * float(self.order.hours_worked), places=2)
 
+    ''' Test hours worked are summed in the database with the minimum hours applied '''
+    def test_with_hours_worked(self):
+        order = Order.objects.create(customer=self.customer, date=self.date, description='hours order', service=self.service)
+        self.assertEqual(Order.objects.with_hours_worked().get(pk=order.pk).calculated_hours_worked, Decimal(3))
+        start = timezone.now() - timezone.timedelta(hours=10)
+        OrderWorkLog.objects.create(order=order, start=start, end=start + timezone.timedelta(hours=2))
+        self.assertEqual(Order.objects.with_hours_worked().get(pk=order.pk).calculated_hours_worked, Decimal(3))
+        OrderWorkLog.objects.create(order=order, start=start + timezone.timedelta(hours=3), end=start + timezone.timedelta(hours=5, minutes=30))
+        self.assertEqual(Order.objects.with_hours_worked().get(pk=order.pk).calculated_hours_worked, Decimal('4.5'))
+        order.refresh_from_db()
+        self.assertEqual(order.hours_worked, Decimal('4.5'))
+
+    ''' Test worker pay is calculated in the database for payroll queries '''
+    def test_order_worker_with_pay(self):
+        start = timezone.now() - timezone.timedelta(hours=10)
+        OrderWorkLog.objects.create(order=self.order, start=start, end=start + timezone.timedelta(hours=4))
+        worker = OrderWorker.objects.with_pay().get(pk=self.order_worker.pk)
+        hours_worked = Order.objects.with_hours_worked().get(pk=self.order.pk).calculated_hours_worked
+        self.assertEqual(worker.calculated_hours_worked, hours_worked)
+        self.assertAlmostEqual(float(worker.calculated_pay), float(self.user.pay_rate) * float(hours_worked), places=4)
+
+    ''' Test stored order totals match the totals calculated from the with_totals annotations '''
+    def test_with_totals(self):
+        OrderWorkLog.objects.create(order=self.order, start=timezone.now() - timezone.timedelta(hours=5), end=timezone.now())
+        order = Order.objects.get(pk=self.order.pk)
+        annotated_order = Order.objects.with_totals().get(pk=self.order.pk)
+        annotated_order.set_totals(**{field: getattr(annotated_order, field) for field in OrderQuerySet.CALCULATED_FIELDS})
+        for field in Order.TOTAL_FIELDS:
+            self.assertAlmostEqual(float(getattr(annotated_order, field)), float(getattr(order, field)), places=2)
+
+    ''' Test stored totals for an order without work logs, materials, costs or payments '''
+    def test_totals_empty_order(self):
+        order = Order.objects.create(customer=self.customer, date=self.date, description='empty order', service=self.service)
+        order.refresh_from_db()
+        self.assertEqual(order.hours_worked, Decimal(3.0))
+        self.assertEqual(order.material_total, Decimal(0.0))
+        self.assertEqual(order.line_total, Decimal(0.0))
+        self.assertEqual(order.payment_total, Decimal(0.0))
+        self.assertAlmostEqual(float(order.total), float(order.subtotal + order.tax_total - order.discount_total), places=2)
+        self.assertEqual(order.working_total, order.total)
+
+    ''' Test stored totals are updated when line items are saved and deleted '''
+    def test_totals_updated_by_line_items(self):
+        initial_total = Order.objects.get(pk=self.order.pk).total
+        cost = OrderCost.objects.create(order=Order.objects.get(pk=self.order.pk), name='extra charge', cost=100.0)
+        order = Order.objects.get(pk=self.order.pk)
+        self.assertAlmostEqual(float(order.line_total), 155.68, places=2)
+        self.assertGreater(order.total, initial_total)
+        self.assertFalse(order.paid)
+        cost.delete()
+        order = Order.objects.get(pk=self.order.pk)
+        self.assertAlmostEqual(float(order.line_total), 55.68, places=2)
+        self.assertEqual(order.total, initial_total)
+        self.assertTrue(order.paid)
+
+    ''' Test stored totals are updated when line items are deleted in cascade with their material '''
+    def test_totals_updated_by_cascade_delete(self):
+        initial_total = Order.objects.get(pk=self.order.pk).total
+        self.assertGreater(Order.objects.get(pk=self.order.pk).material_total, 0)
+        self.material.delete()
+        order = Order.objects.get(pk=self.order.pk)
+        self.assertFalse(order.ordermaterial_set.exists())
+        self.assertEqual(order.material_total, Decimal('0.00'))
+        self.assertLess(order.total, initial_total)
+        # The payment covered the material that is no longer on the order
+        self.assertTrue(order.paid)
+
+    ''' Test deleting an order or its customer does not update the order totals, and deleting an order does not read it again, for each line item '''
+    def test_cascade_delete_skips_order_totals(self):
+        for name, owner in [('order', lambda order: order), ('customer', lambda order: order.customer)]:
+            reads = []
+            for lines in [1, 4]:
+                customer = Customer.objects.create(first_name='other', last_name='customer', email=f'{name}{lines}@email.com', phone='1 (234) 567-8902')
+                order = Order.objects.create(customer=customer, date=self.date, description='deleted order', service=self.service, callout=Order.CALLOUT_CHOICES.STANDARD)
+                for _ in range(lines):
+                    OrderCost.objects.create(order=order, name='charge', cost=10.0)
+                    OrderPayment.objects.create(order=order, date=self.date, type=OrderPayment.PAYMENT_CHOICES.CASH, total=5.0)
+                    OrderMaterial.objects.create(order=order, inventory_item=self.material, quantity=0)
+                order = Order.objects.get(pk=order.pk)
+                with CaptureQueriesContext(connection) as context:
+                    owner(order).delete()
+                self.assertFalse([query for query in context.captured_queries if query['sql'].startswith('UPDATE "order_order"')])
+                reads.append(len([query for query in context.captured_queries if query['sql'].startswith('SELECT') and 'FROM "order_order"' in query['sql']]))
+            if name == 'order':
+                self.assertEqual(reads, [0, 0])
+
+    ''' Test stored totals are updated when the order rates change '''
+    def test_totals_updated_by_order_rates(self):
+        order = Order.objects.get(pk=self.order.pk)
+        order.hourly_rate = Decimal(200.0)
+        order.save()
+        order.refresh_from_db()
+        self.assertAlmostEqual(float(order.total), float(order.subtotal + order.tax_total - order.discount_total), places=2)
+        self.assertAlmostEqual(float(order.working_total), float(order.total - order.payment_total), places=2)
+
+    ''' Test the recompute order totals command reconciles drifted totals '''
+    def test_recompute_order_totals_command(self):
+        expected_total = Order.objects.get(pk=self.order.pk).total
+        Order.objects.filter(pk=self.order.pk).update(total=0, working_total=0, line_total=0)
+        output = StringIO()
+        call_command('recompute_order_totals', stdout=output)
+        order = Order.objects.get(pk=self.order.pk)
+        self.assertEqual(order.total, expected_total)
+        self.assertAlmostEqual(float(order.line_total), 55.68, places=2)
+        self.assertIn('Reconciled totals for 1 of 1 orders.', output.getvalue())
+
+    ''' Test material totals use the stored cost snapshot and ignore later purchases '''
+    def test_material_total_uses_cost_snapshot(self):
+        material_total = Order.objects.get(pk=self.order.pk).material_total
+        PurchaseMaterial.objects.create(purchase=self.purchase, inventory_item=self.material, quantity=10, cost=500.0)
+        self.order.save()
+        self.assertEqual(Order.objects.get(pk=self.order.pk).material_total, material_total)
+
+    ''' Test changing the quantity of a material line keeps its snapshot unit cost '''
+    def test_order_material_quantity_change(self):
+        PurchaseMaterial.objects.create(purchase=self.purchase, inventory_item=self.material, quantity=10, cost=500.0)
+        order_material = OrderMaterial.objects.get(pk=self.order_material.pk)
+        order_material.quantity = 5
+        order_material.save()
+        self.assertEqual(OrderMaterial.objects.get(pk=self.order_material.pk).cost, Decimal('50.00'))
+        self.assertEqual(Order.objects.get(pk=self.order.pk).material_total, money.material_total(Decimal('50.00'), self.order.material_upcharge))
+
+    ''' Test changing the material of a line costs it from the new material instead of the old snapshot '''
+    def test_order_material_item_change(self):
+        other_material = Material.objects.create(name='other material', size='2 inch X 4 inch X 10 feet')
+        PurchaseMaterial.objects.create(purchase=self.purchase, inventory_item=other_material, quantity=10, cost=50.0)
+        order_material = OrderMaterial.objects.get(pk=self.order_material.pk)
+        order_material.inventory_item = other_material
+        order_material.quantity = 4
+        order_material.save()
+        self.assertEqual(OrderMaterial.objects.get(pk=self.order_material.pk).cost, Decimal('20.00'))
+        self.assertEqual(Order.objects.get(pk=self.order.pk).material_total, money.material_total(Decimal('20.00'), self.order.material_upcharge))
+
+    ''' Test the snapshot command backfills missing costs from the purchase made by the order date '''
+    def test_snapshot_order_material_costs_command(self):
+        earlier_purchase = Purchase.objects.create(supplier=self.supplier, supplier_address=self.address, tax=0, date=self.date - timezone.timedelta(days=30))
+        PurchaseMaterial.objects.create(purchase=earlier_purchase, inventory_item=self.material, quantity=10, cost=20.0)
+        later_purchase = Purchase.objects.create(supplier=self.supplier, supplier_address=self.address, tax=0, date=self.date + timezone.timedelta(days=30))
+        PurchaseMaterial.objects.create(purchase=later_purchase, inventory_item=self.material, quantity=10, cost=500.0)
+        OrderMaterial.objects.filter(pk=self.order_material.pk).update(cost=0)
+        output = StringIO()
+        call_command('snapshot_order_material_costs', stdout=output)
+        self.assertEqual(OrderMaterial.objects.get(pk=self.order_material.pk).cost, Decimal('100.00'))
+        self.assertEqual(Order.objects.get(pk=self.order.pk).material_total, money.material_total(Decimal('100.00'), self.order.material_upcharge))
+        self.assertIn('Snapshotted costs for 1 order materials across 1 orders.', output.getvalue())
+        OrderMaterial.objects.filter(pk=self.order_material.pk).update(cost=Decimal('1.00'))
+        call_command('snapshot_order_material_costs', '--all', stdout=output)
+        self.assertEqual(OrderMaterial.objects.get(pk=self.order_material.pk).cost, Decimal('100.00'))
+
 ''' Tests for order serializer '''
 class TestOrderSerializer(TestCase):
 
@@ -223,6 +382,17 @@ class TestOrderSerializer(TestCase):
         self.assertIn('discount', serializer.validated_data)
         self.assertIn('callout', serializer.validated_data)
 
+    ''' Test order serializer only serializes the requested fields and expansions '''
+    def test_order_serializer_dynamic_fields(self):
+        data = OrderSerializer(self.order, fields=['id', 'total', 'paid']).data
+        self.assertEqual(set(data.keys()), {'id', 'total', 'paid'})
+        data = OrderSerializer(self.order, expand=['costs']).data
+        self.assertIn('costs', data)
+        self.assertIn('subtotal', data)
+        self.assertNotIn('images', data)
+        self.assertEqual(OrderSerializer.get_expanded_fields(['id'], ['tools']), ['tools'])
+        self.assertEqual(OrderSerializer.get_expanded_fields(), ['images', 'materials', 'tools', 'costs'])
+
     ''' Test order serializer create override '''
     def test_order_serializer_create(self):
         serializer = OrderSerializer(data=self.valid_data)
@@ -643,6 +813,100 @@ class TestOrderView(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.data), Order.objects.all().count())
 
+    ''' Test get orders stays within a fixed query budget however many orders exist '''
+    def test_get_orders_query_count(self):
+        self.client.force_authenticate(user=self.user)
+        material = Material.objects.create(name='material', size='size')
+        tool = Tool.objects.create(name='tool')
+        for index in range(5):
+            order = Order.objects.create(customer=self.customer, date=self.date, description=f'test description {index}', service=self.service)
+            OrderPicture.objects.create(order=order, image='pergola-stain.jpg')
+            OrderCost.objects.create(order=order, name='test line item charge', cost=10.0)
+            OrderMaterial.objects.create(order=order, inventory_item=material, quantity=2)
+            OrderTool.objects.create(order=order, inventory_item=tool, quantity=1)
+        # One query for the orders plus one each for pictures, costs, materials and tools
+        with self.assertNumQueries(5):
+            response = self.client.get(self.list_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 6)
+        order_data = response.data[-1]
+        self.assertEqual(len(order_data['images']), 1)
+        self.assertEqual(len(order_data['costs']), 1)
+        self.assertEqual(order_data['materials'][0]['name'], material.name)
+        self.assertEqual(order_data['tools'][0]['name'], tool.name)
+
+    ''' Test get orders summary projection skips unrequested fields and their queries '''
+    def test_get_orders_sparse_fields(self):
+        self.client.force_authenticate(user=self.user)
+        OrderPicture.objects.create(order=self.order, image='pergola-stain.jpg')
+        OrderCost.objects.create(order=self.order, name='test line item charge', cost=10.0)
+        with self.assertNumQueries(1):
+            response = self.client.get(self.list_url, {'fields': 'id,customer,date,completed,paid,total'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(set(response.data[0].keys()), {'id', 'customer', 'date', 'completed', 'paid', 'total'})
+        with self.assertNumQueries(2):
+            response = self.client.get(self.list_url, {'fields': 'id,total', 'expand': 'costs'})
+        self.assertEqual(set(response.data[0].keys()), {'id', 'total', 'costs'})
+        self.assertEqual(len(response.data[0]['costs']), 1)
+
+    ''' Test get order with expanded nested line items only '''
+    def test_get_order_expand(self):
+        self.client.force_authenticate(user=self.user)
+        with self.assertNumQueries(2):
+            response = self.client.get(self.detail_url(self.order.pk), {'expand': 'images'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('images', response.data)
+        self.assertIn('total', response.data)
+        self.assertNotIn('materials', response.data)
+        self.assertNotIn('costs', response.data)
+
+    ''' Test get orders filtered by completed, paid, customer, service and date range '''
+    def test_get_orders_filtered(self):
+        self.client.force_authenticate(user=self.user)
+        customer = Customer.objects.create(first_name='other', last_name='customer', email='othercustomer@email.com', phone='1 (234) 567-8901')
+        completed_order = Order.objects.create(customer=customer, date=self.date - timezone.timedelta(days=30), description='completed order', service=self.service, completed=True)
+        OrderPayment.objects.create(order=completed_order, date=self.date, type=OrderPayment.PAYMENT_CHOICES.CASH, total=Order.objects.get(pk=completed_order.pk).total)
+        response = self.client.get(self.list_url, {'completed': 'true'})
+        self.assertEqual([order['id'] for order in response.data], [completed_order.pk])
+        response = self.client.get(self.list_url, {'paid': 'false'})
+        self.assertEqual([order['id'] for order in response.data], [self.order.pk])
+        response = self.client.get(self.list_url, {'customer': customer.pk, 'paid': 'true'})
+        self.assertEqual([order['id'] for order in response.data], [completed_order.pk])
+        response = self.client.get(self.list_url, {'service': self.service.pk, 'start_date': self.date - timezone.timedelta(days=1), 'end_date': self.date})
+        self.assertEqual([order['id'] for order in response.data], [self.order.pk])
+
+    ''' Test get orders with invalid filters '''
+    def test_get_orders_invalid_filters(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(self.list_url, {'completed': 'maybe', 'start_date': 'yesterday'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('completed', response.data)
+        self.assertIn('start_date', response.data)
+        response = self.client.get(self.list_url, {'start_date': self.date, 'end_date': self.date - timezone.timedelta(days=1)})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('end_date', response.data)
+
+    ''' Test get orders paginated by date with a cursor '''
+    def test_get_orders_paginated(self):
+        self.client.force_authenticate(user=self.user)
+        for days in range(1, 5):
+            Order.objects.create(customer=self.customer, date=self.date - timezone.timedelta(days=days), description='older order', service=self.service)
+        Order.objects.create(customer=self.customer, date=self.date, description='same day order', service=self.service)
+        expected_ids = list(Order.objects.order_by('-date', '-id').values_list('id', flat=True))
+        response = self.client.get(self.list_url, {'page_size': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        ids = [order['id'] for order in response.data['results']]
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            ids += [order['id'] for order in response.data['results']]
+        self.assertEqual(ids, expected_ids)
+
+    ''' Test get orders with an invalid cursor '''
+    def test_get_orders_invalid_cursor(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(self.list_url, {'cursor': 'invalid'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
     ''' Test create order with empty data '''
     def test_create_order_empty_data(self):
         self.client.force_authenticate(user=self.user)
@@ -750,6 +1014,154 @@ class TestOrderView(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
         self.assertEqual(Order.objects.count(), 0)
 
+''' Tests for order export view '''
+class TestOrderExportView(APITestCase):
+
+    ''' Set up testing data '''
+    @classmethod
+    def setUpTestData(cls):
+        cls.client = APIClient()
+        cls.date = timezone.now().date()
+        cls.service = Service.objects.create(name='test service')
+        cls.customer = Customer.objects.create(first_name='first', last_name='last', email='firstlast@email.com', phone='1 (234) 567-8901', notes='test customer')
+        cls.order = Order.objects.create(customer=cls.customer, date=cls.date - timezone.timedelta(days=1), description='first order', service=cls.service, hourly_rate=100.0, material_upcharge=15.0, tax=10.0, discount=0.0, callout=Order.CALLOUT_CHOICES.STANDARD)
+        cls.completed_order = Order.objects.create(customer=cls.customer, date=cls.date, description='completed order', service=cls.service, hourly_rate=80.0, material_upcharge=15.0, tax=0.0, discount=0.0, completed=True, callout=Order.CALLOUT_CHOICES.EMERGENCY)
+        OrderPayment.objects.create(order=cls.completed_order, date=cls.date, type=OrderPayment.PAYMENT_CHOICES.CASH, total=Decimal('415.00'))
+        cls.url = reverse('order-export')
+        cls.user = User.objects.create(first_name='first', last_name='last', email='firstlast@example.com', phone='1 (234) 567-8901', password=make_password('test1234'))
+
+    ''' Test export requires authentication '''
+    def test_export_orders_unauthenticated(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    ''' Test orders are streamed as csv with their totals '''
+    def test_export_orders_csv(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertIn('orders.csv', response['Content-Disposition'])
+        rows = list(csv.DictReader(StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual([int(row['id']) for row in rows], [self.order.pk, self.completed_order.pk])
+        self.assertEqual(rows[0]['customer'], 'first last')
+        self.assertEqual(rows[0]['service'], 'test service')
+        self.assertEqual(Decimal(rows[0]['labor_total']), Decimal('300.00'))
+        self.assertEqual(Decimal(rows[0]['subtotal']), Decimal('350.00'))
+        self.assertEqual(Decimal(rows[0]['tax_total']), Decimal('35.00'))
+        self.assertEqual(Decimal(rows[0]['total']), Decimal('385.00'))
+        self.assertEqual(rows[0]['paid'], 'False')
+        self.assertEqual(rows[1]['paid'], 'True')
+
+    ''' Test orders are streamed as newline delimited json '''
+    def test_export_orders_ndjson(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(self.url, {'type': 'ndjson'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1]['total'], 415.0)
+        self.assertEqual(rows[1]['working_total'], 0.0)
+        self.assertTrue(rows[1]['paid'])
+
+    ''' Test exported totals of an order with materials match its stored totals '''
+    def test_export_orders_match_stored_totals(self):
+        supplier = Supplier.objects.create(name='supplier')
+        address = SupplierAddress.objects.create(supplier=supplier, street_address='123 Test Street', city='City', state='State', zip=12345)
+        material = Material.objects.create(name='material', size='2 inch X 4 inch X 8 feet')
+        purchase = Purchase.objects.create(supplier=supplier, supplier_address=address, tax=6.83, date=self.date - timezone.timedelta(days=2))
+        PurchaseMaterial.objects.create(purchase=purchase, inventory_item=material, quantity=10, cost=100.0)
+        OrderMaterial.objects.create(order=self.order, inventory_item=material, quantity=3.0)
+        OrderCost.objects.create(order=self.order, name='permit', cost=Decimal('25.50'))
+        order = Order.objects.get(pk=self.order.pk)
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(self.url, {'type': 'ndjson'})
+        row = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()][0]
+        self.assertEqual(Decimal(str(row['material_total'])), order.material_total)
+        self.assertEqual(Decimal(str(row['line_total'])), order.line_total)
+        self.assertEqual(Decimal(str(row['total'])), order.total)
+        self.assertEqual(Decimal(str(row['working_total'])), order.working_total)
+
+    ''' Test the order list filters apply to the export '''
+    def test_export_orders_filtered(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(self.url, {'type': 'ndjson', 'completed': 'true'})
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row['id'] for row in rows], [self.completed_order.pk])
+
+    ''' Test invalid export types and filters are rejected '''
+    def test_export_orders_invalid(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(self.url, {'type': 'xml'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('type', response.data)
+        response = self.client.get(self.url, {'start_date': 'yesterday'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('start_date', response.data)
+
+''' Tests for order revenue report view '''
+class TestOrderRevenueReportView(APITestCase):
+
+    ''' Set up testing data '''
+    @classmethod
+    def setUpTestData(cls):
+        cls.client = APIClient()
+        cls.service = Service.objects.create(name='test service')
+        cls.other_service = Service.objects.create(name='other service')
+        cls.customer = Customer.objects.create(first_name='first', last_name='last', email='firstlast@email.com', phone='1 (234) 567-8901', notes='test customer')
+        cls.other_customer = Customer.objects.create(first_name='other', last_name='customer', email='othercustomer@email.com', phone='1 (234) 567-8902')
+        cls.orders = [
+            Order.objects.create(customer=cls.customer, date='2024-01-05', description='first order', service=cls.service, hourly_rate=100.0, material_upcharge=15.0, tax=10.0, discount=5.0, callout=Order.CALLOUT_CHOICES.STANDARD),
+            Order.objects.create(customer=cls.customer, date='2024-01-20', description='second order', service=cls.other_service, hourly_rate=93.0, material_upcharge=15.0, tax=12.0, discount=0.0, callout=Order.CALLOUT_CHOICES.EMERGENCY),
+            Order.objects.create(customer=cls.other_customer, date='2024-02-10', description='third order', service=cls.service, hourly_rate=80.0, material_upcharge=15.0, tax=0.0, discount=0.0, callout=Order.CALLOUT_CHOICES.STANDARD),
+        ]
+        OrderCost.objects.create(order=cls.orders[0], name='permit', cost=Decimal('25.50'))
+        OrderPayment.objects.create(order=cls.orders[1], date='2024-01-21', type=OrderPayment.PAYMENT_CHOICES.CHECK, total=Decimal('100.00'))
+        cls.url = reverse('order-revenue-report')
+        cls.user = User.objects.create(first_name='first', last_name='last', email='firstlast@example.com', phone='1 (234) 567-8901', password=make_password('test1234'))
+
+    ''' Test revenue is grouped by month by default and matches the order totals '''
+    def test_revenue_by_month(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([str(row['month']) for row in response.data], ['2024-01-01', '2024-02-01'])
+        january = response.data[0]
+        orders = [Order.objects.get(pk=order.pk) for order in self.orders[:2]]
+        self.assertEqual(january['orders'], 2)
+        self.assertEqual(january['labor_total'], sum(money.round_money(order.labor_total) for order in orders))
+        self.assertEqual(january['line_total'], Decimal('25.50'))
+        self.assertEqual(january['tax_total'], money.round_money(sum(order.tax_total for order in orders)))
+        self.assertEqual(january['discount_total'], money.round_money(sum(order.discount_total for order in orders)))
+        self.assertEqual(january['total'], sum(order.total for order in orders))
+        self.assertEqual(january['collected'], Decimal('100.00'))
+        self.assertEqual(january['outstanding'], sum(order.working_total for order in orders))
+
+    ''' Test revenue grouped by service and customer '''
+    def test_revenue_by_service_and_customer(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(self.url, {'group_by': 'service'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual({row['service_name']: row['orders'] for row in response.data}, {'test service': 2, 'other service': 1})
+        response = self.client.get(self.url, {'group_by': 'customer'})
+        self.assertEqual({row['customer_name']: row['orders'] for row in response.data}, {'first last': 2, 'other customer': 1})
+
+    ''' Test revenue over a date range '''
+    def test_revenue_date_range(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(self.url, {'start_date': '2024-02-01', 'end_date': '2024-02-29'})
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual(response.data[0]['total'], Order.objects.get(pk=self.orders[2].pk).total)
+
+    ''' Test invalid report parameters are rejected '''
+    def test_revenue_invalid_parameters(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(self.url, {'group_by': 'year'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('group_by', response.data)
+
 ''' Tests for order work log view '''
 class TestOrderWorkLogView(APITestCase):
 
@@ -1009,6 +1421,10 @@ class TestOrderMaterialView(APITestCase):
         cls.customer = Customer.objects.create(first_name='first', last_name='last', email='firstlast@email.com', phone='1 (234) 567-8901', notes='test customer')
         cls.order = Order.objects.create(customer=cls.customer, date=cls.date, description='test description', service=cls.service, hourly_rate=50.0, material_upcharge=9.25, tax=13.5, completed=False, discount=1.75, notes='test order', callout=Order.CALLOUT_CHOICES.STANDARD)
         cls.material = Material.objects.create(name='material', description='material description', size='size')
+        cls.supplier = Supplier.objects.create(name='supplier')
+        cls.address = SupplierAddress.objects.create(supplier=cls.supplier, street_address='123 Test Street', city='City', state='State', zip=12345)
+        cls.purchase = Purchase.objects.create(supplier=cls.supplier, supplier_address=cls.address, tax=0, date=cls.date)
+        PurchaseMaterial.objects.create(purchase=cls.purchase, inventory_item=cls.material, quantity=60, cost=60.0)
         cls.order_material = OrderMaterial.objects.create(order=cls.order, inventory_item=cls.material, quantity=10)
         cls.empty_data = {'order': '', 'inventory_item': '', 'quantity': ''}
         cls.negative_data = {'order': cls.order.pk, 'inventory_item': cls.material.pk, 'quantity': -10}
@@ -1062,6 +1478,15 @@ class TestOrderMaterialView(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertEqual(OrderMaterial.objects.count(), 2)
 
+    ''' Test create order material with more than is in stock '''
+    def test_create_order_material_insufficient_stock(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post(self.list_url(self.order.pk), data={**self.create_data, 'quantity': 51})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['quantity'], ['Only 50 of material are in stock.'])
+        self.assertEqual(OrderMaterial.objects.count(), 1)
+        self.assertEqual(MaterialStock.objects.get(item=self.material).on_hand, 50)
+
     ''' Test update order material with empty data '''
     def test_update_order_material_empty_data(self):
         self.client.force_authenticate(user=self.user)
@@ -1084,6 +1509,15 @@ class TestOrderMaterialView(APITestCase):
         material = OrderMaterial.objects.get(pk=self.order_material.pk)
         self.assertEqual(material.quantity, self.patch_data['quantity'])
 
+    ''' Test update order material to more than is in stock '''
+    def test_update_order_material_insufficient_stock(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.patch(self.detail_url(self.order.pk, self.order_material.pk), data={'quantity': 61})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('quantity', response.data)
+        self.assertEqual(OrderMaterial.objects.get(pk=self.order_material.pk).quantity, 10)
+        self.assertEqual(MaterialStock.objects.get(item=self.material).on_hand, 50)
+
     ''' Test delete order material success '''
     def test_delete_order_material_success(self):
         self.client.force_authenticate(user=self.user)
@@ -1521,3 +1955,52 @@ class TestOrderWorkerView(APITestCase):
         response = self.client.delete(self.detail_url(self.order.pk, self.order_worker.pk))
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
         self.assertEqual(OrderWorker.objects.count(), 0)
+
+''' Tests for reserving stock for order materials from concurrent requests '''
+class TestOrderMaterialReservation(TransactionTestCase):
+
+    def setUp(self):
+        date = timezone.now().date()
+        service = Service.objects.create(name='test service')
+        customer = Customer.objects.create(first_name='first', last_name='last', email='firstlast@email.com', phone='1 (234) 567-8901')
+        supplier = Supplier.objects.create(name='supplier')
+        address = SupplierAddress.objects.create(supplier=supplier, street_address='123 Test Street', city='City', state='State', zip=12345)
+        purchase = Purchase.objects.create(supplier=supplier, supplier_address=address, tax=0, date=date)
+        self.material = Material.objects.create(name='material', size='size')
+        self.other_material = Material.objects.create(name='other material', size='size')
+        PurchaseMaterial.objects.create(purchase=purchase, inventory_item=self.material, quantity=10, cost=10.0)
+        PurchaseMaterial.objects.create(purchase=purchase, inventory_item=self.other_material, quantity=100, cost=100.0)
+        self.orders = [Order.objects.create(customer=customer, date=date, description=f'order {number}', service=service) for number in range(8)]
+
+    ''' Add a material to an order from its own thread and connection, retrying while the database is locked by another writer '''
+    def reserve(self, order, material, results):
+        try:
+            for attempt in range(200):
+                try:
+                    serializer = OrderMaterialSerializer(data={'order': order.pk, 'inventory_item': material.pk, 'quantity': 3})
+                    serializer.is_valid(raise_exception=True)
+                    serializer.save()
+                    results.append(True)
+                    return
+                except OperationalError:
+                    time.sleep(0.01)
+                except DRFValidationError:
+                    results.append(False)
+                    return
+        finally:
+            connection.close()
+
+    ''' Test crews adding the same material at once never take more than is in stock '''
+    def test_concurrent_reservations(self):
+        results = []
+        threads = [threading.Thread(target=self.reserve, args=(order, self.material, results)) for order in self.orders]
+        threads += [threading.Thread(target=self.reserve, args=(order, self.other_material, results)) for order in self.orders]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 16)
+        self.assertEqual(OrderMaterial.objects.filter(inventory_item=self.material).count(), 3)
+        self.assertEqual(OrderMaterial.objects.filter(inventory_item=self.other_material).count(), 8)
+        self.assertEqual(MaterialStock.objects.get(item=self.material).on_hand, 1)
+        self.assertEqual(MaterialStock.objects.get(item=self.other_material).on_hand, 76)
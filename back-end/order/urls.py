@@ -1,10 +1,13 @@
-from order.views import OrderView, OrderCostView, OrderPictureView, OrderMaterialView, OrderToolView, OrderPaymentView, OrderWorkLogView, OrderWorkerView, PublicView
+from order.views import OrderView, OrderExportView, OrderRevenueReportView, OrderCostView, OrderPictureView, OrderMaterialView, OrderToolView, OrderPaymentView, OrderWorkLogView, OrderWorkerView, PublicView
 from django.urls import path
 
 urlpatterns = [
     path('', OrderView.as_view(), name='order-list'),
     path('<int:pk>/', OrderView.as_view(), name='order-detail'),
 
+    path('export/', OrderExportView.as_view(), name='order-export'),
+    path('report/revenue/', OrderRevenueReportView.as_view(), name='order-revenue-report'),
+
     path('public/', PublicView.as_view(), name='order-public'),
 
     path('image/<int:pk>/', OrderPictureView.as_view(), name='order-picture-detail'),
@@ -1,13 +1,21 @@
-from order.serializers import OrderSerializer, OrderCostSerializer, OrderMaterialSerializer, OrderToolSerializer, OrderPaymentSerializer, OrderWorkLogSerializer, OrderWorkerSerializer
+from order.serializers import OrderSerializer, OrderFilterSerializer, RevenueReportFilterSerializer, OrderCostSerializer, OrderMaterialSerializer, OrderToolSerializer, OrderPaymentSerializer, OrderWorkLogSerializer, OrderWorkerSerializer
 from order.models import Order, OrderCost, OrderPicture, OrderMaterial, OrderTool, OrderPayment, OrderWorkLog, OrderWorker
+from django.db.models import F, Value, Sum, Subquery, OuterRef, DecimalField
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.exceptions import ValidationError
+from utils.streaming import stream_csv, stream_ndjson
 from customer.serializers import CustomerSerializer
+from utils.pagination import DateKeysetPagination
+from utils.serializers import parse_field_list
+from django.http import StreamingHttpResponse
+from django.db.models.functions import Concat
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from customer.models import Customer
 from service.models import Service
 from rest_framework import status
+from itertools import islice
+from utils import money
 
 ''' View for public site contact form '''
 class PublicView(APIView):
@@ -52,24 +60,42 @@ class PublicView(APIView):
         except ValidationError as error:
             return Response(error.detail, status=status.HTTP_400_BAD_REQUEST)
 
-''' CRUD view for order model '''
+'''
+    CRUD view for order model
+    -------------------------
+    get method returns either single instance or list of instances filtered by completed, paid, customer,
+    service, start_date and end_date, paginated by date when a cursor or page_size is requested
+    get method only returns the fields and nested line items requested with the fields and expand parameters
+'''
 class OrderView(APIView):
     permission_classes = [IsAuthenticated]
+    pagination_class = DateKeysetPagination
 
     def get_object(self, pk=None):
         return Order.objects.get(pk=pk)
 
     def get(self, request, *args, **kwargs):
         pk = kwargs.pop('pk', None)
+        fields = parse_field_list(request, 'fields')
+        expand = parse_field_list(request, 'expand')
+        # Only prefetch the nested line items that will be serialized
+        queryset = Order.objects.with_line_items(OrderSerializer.get_expanded_fields(fields, expand))
         if pk:
             try:
-                order = self.get_object(pk)
-                serializer = OrderSerializer(order)
+                order = queryset.get(pk=pk)
+                serializer = OrderSerializer(order, fields=fields, expand=expand)
             except Order.DoesNotExist:
                 return Response({'detail': 'Order Not Found.'}, status=status.HTTP_404_NOT_FOUND)
         else:
-            orders = Order.objects.all()
-            serializer = OrderSerializer(orders, many=True)
+            filters = OrderFilterSerializer(data=request.query_params.dict())
+            if not filters.is_valid():
+                return Response(filters.errors, status=status.HTTP_400_BAD_REQUEST)
+            orders = filters.filter_queryset(queryset)
+            paginator = self.pagination_class()
+            if paginator.is_requested(request):
+                page = paginator.paginate_queryset(orders, request)
+                return paginator.get_paginated_response(OrderSerializer(page, many=True, fields=fields, expand=expand).data)
+            serializer = OrderSerializer(orders, many=True, fields=fields, expand=expand)
         return Response(serializer.data)
 
     def post(self, request, *args, **kwargs):
@@ -161,6 +187,88 @@ class OrderWorkLogView(APIView):
         work_log.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+'''
+    Export view for orders
+    ----------------------
+    get method streams every order matching the order list filters with its totals as csv or ndjson, chosen with the type parameter
+    Orders are read and priced in chunks so memory use does not grow with the number of orders exported
+'''
+class OrderExportView(APIView):
+    permission_classes = [IsAuthenticated]
+    chunk_size = 1000
+    columns = ['id', 'date', 'customer', 'service', 'description', 'completed', 'paid', 'callout', 'hourly_rate', 'hours_worked', 'labor_total', 'material_upcharge', 'material_total', 'line_total', 'subtotal', 'tax', 'tax_total', 'discount', 'discount_total', 'total', 'payment_total', 'working_total']
+    exports = {
+        'csv': (stream_csv, 'text/csv'),
+        'ndjson': (stream_ndjson, 'application/x-ndjson'),
+    }
+
+    '''
+        Yield each order with its totals priced by the shared order pricing
+        ---------------------------------------------------------------------
+        Orders are read in chunks of chunk_size and each chunk is priced with money.price_orders from the stored
+        hours, line item and payment totals and the summed order material costs, the same inputs the stored totals use.
+    '''
+    def get_rows(self, orders):
+        materials = OrderMaterial.objects.filter(order=OuterRef('pk')).values('order').annotate(total=Sum('cost')).values('total')
+        orders = orders.order_by('date', 'pk').annotate(
+            customer_name=Concat('customer__first_name', Value(' '), 'customer__last_name'),
+            service_name=F('service__name'),
+            material_cost=Subquery(materials, output_field=DecimalField(max_digits=10, decimal_places=2)),
+        ).values('id', 'date', 'customer_name', 'service_name', 'description', 'completed', 'callout', 'hourly_rate', 'hours_worked', 'material_upcharge', 'material_cost', 'line_total', 'tax', 'discount', 'payment_total')
+        rows = orders.iterator(chunk_size=self.chunk_size)
+        while chunk := list(islice(rows, self.chunk_size)):
+            for order, price in zip(chunk, money.price_orders(chunk)):
+                order['customer'] = order.pop('customer_name')
+                order['service'] = order.pop('service_name')
+                order.pop('material_cost')
+                order['labor_total'] = money.round_money(price.labor_total)
+                order['material_total'] = price.material_total
+                order['subtotal'] = money.round_money(price.subtotal)
+                order['tax_total'] = money.round_money(price.tax_total)
+                order['discount_total'] = money.round_money(price.discount_total)
+                order['total'] = price.total
+                order['working_total'] = price.working_total
+                order['paid'] = price.paid
+                yield order
+
+    def get(self, request, *args, **kwargs):
+        export_type = request.query_params.get('type', 'csv')
+        if export_type not in self.exports:
+            return Response({'type': [f'Export type must be one of {", ".join(self.exports)}.']}, status=status.HTTP_400_BAD_REQUEST)
+        filters = OrderFilterSerializer(data=request.query_params.dict())
+        if not filters.is_valid():
+            return Response(filters.errors, status=status.HTTP_400_BAD_REQUEST)
+        stream, content_type = self.exports[export_type]
+        response = StreamingHttpResponse(stream(self.columns, self.get_rows(filters.filter_queryset(Order.objects.all()))), content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="orders.{export_type}"'
+        return response
+
+'''
+    Revenue report view for orders
+    ------------------------------
+    get method returns the labor, material, line item, callout, tax, discount, total, collected and outstanding amounts
+    of the orders matching the order list filters, grouped by month, service or customer with the group_by parameter
+    Every sum is calculated with a single grouped query over the stored order totals
+'''
+class OrderRevenueReportView(APIView):
+    permission_classes = [IsAuthenticated]
+    amounts = ['labor_total', 'material_total', 'line_total', 'callout_total', 'subtotal', 'total', 'collected', 'outstanding']
+
+    ''' Round the group sums to whole cents and convert the tax and discount sums to amounts '''
+    def get_row(self, row):
+        row['tax_total'] = money.round_money(money.to_decimal(row.pop('tax_basis')) / money.HUNDRED)
+        row['discount_total'] = money.round_money(money.to_decimal(row.pop('discount_basis')) / money.HUNDRED)
+        for amount in self.amounts:
+            row[amount] = money.round_money(row[amount])
+        return row
+
+    def get(self, request, *args, **kwargs):
+        filters = RevenueReportFilterSerializer(data=request.query_params.dict())
+        if not filters.is_valid():
+            return Response(filters.errors, status=status.HTTP_400_BAD_REQUEST)
+        rows = filters.filter_queryset(Order.objects.all()).revenue(filters.validated_data['group_by'])
+        return Response([self.get_row(row) for row in rows], status=status.HTTP_200_OK)
+
 ''' CRUD view for order cost model '''
 class OrderCostView(APIView):
     permission_classes = [IsAuthenticated]
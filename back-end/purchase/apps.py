@@ -1,6 +1,15 @@
+from django.db.models.signals import post_delete
 from django.apps import AppConfig
 
 
 class PurchaseConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'purchase'
+
+    def ready(self):
+        from inventory.models import remove_deleted_line_stock, replay_deleted_line_costs
+        from purchase.models import PurchaseMaterial, PurchaseTool
+        # Lines deleted in cascade skip their delete method, so the stock and costs are kept up to date by signals
+        for model in [PurchaseMaterial, PurchaseTool]:
+            post_delete.connect(remove_deleted_line_stock, sender=model)
+        post_delete.connect(replay_deleted_line_costs, sender=PurchaseMaterial)
@@ -1,10 +1,94 @@
+from inventory.models import Material, Tool, StockMovementMixin, MaterialCostingMixin, MaterialStock
+from django.db.models import Count, DecimalField, F, Max, OuterRef, Prefetch, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, TruncMonth
 from supplier.models import Supplier, SupplierAddress
 from django.core.validators import MinValueValidator
 from utils.fields import PresignedURLImageField
 from utils.mixins import AtomicOperationsMixin
-from inventory.models import Material, Tool
-from django.db import models
+from django.db import models, transaction
 from decimal import Decimal
+from utils import money
+
+''' Queryset for purchases with support for database calculated totals '''
+class PurchaseQuerySet(models.QuerySet):
+    CALCULATED_FIELDS = ['calculated_material_total', 'calculated_tool_total', 'calculated_subtotal', 'calculated_total']
+
+    '''
+        Annotate the material total, tool total, subtotal and total of each purchase
+        ----------------------------------------------------------------------------
+        The material and tool totals are correlated sums of the purchase lines, so a list of purchases is priced in a
+        single query without joining both line tables and multiplying their rows.
+    '''
+    def with_totals(self):
+        totals = {}
+        for name, line_model in [('material', PurchaseMaterial), ('tool', PurchaseTool)]:
+            lines = line_model.objects.filter(purchase=OuterRef('pk')).order_by().values('purchase').annotate(total=Sum('cost')).values('total')
+            totals[f'calculated_{name}_total'] = Coalesce(Subquery(lines), Value(0), output_field=DecimalField(max_digits=12, decimal_places=2))
+        return self.annotate(**totals).annotate(
+            calculated_subtotal=F('calculated_material_total') + F('calculated_tool_total'),
+        ).annotate(
+            calculated_total=F('calculated_subtotal') + F('tax'),
+        )
+
+    '''
+        Add up the spend of the purchases for each month with aggregated queries
+        -----------------------------------------------------------------------
+        top_items: how many of the items with the most spend to list for each month
+        Returns the months oldest first with their purchase count, line counts, material, tool and tax totals and the
+        items with the most spend, from one query of the purchases and one of each kind of line.
+    '''
+    def spend_by_month(self, top_items=5):
+        months = {}
+        for row in self.annotate(month=TruncMonth('date')).order_by('month').values('month').annotate(purchases=Count('pk'), tax=Sum('tax')):
+            months[row['month']] = {'month': row['month'], 'purchases': row['purchases'], 'material_lines': 0, 'tool_lines': 0, 'material_total': money.ZERO, 'tool_total': money.ZERO, 'tax': row['tax'], 'items': []}
+        for name, line_model in [('material', PurchaseMaterial), ('tool', PurchaseTool)]:
+            items = line_model.objects.filter(purchase__in=self.values('pk')).annotate(month=TruncMonth('purchase__date')).order_by().values('month', 'inventory_item', 'inventory_item__name')
+            for item in items.annotate(lines=Count('pk'), quantity=Sum('quantity'), spend=Sum('cost')):
+                month = months[item['month']]
+                month[f'{name}_lines'] += item['lines']
+                month[f'{name}_total'] = money.sum_money([month[f'{name}_total'], item['spend']])
+                month['items'].append({'type': name, 'id': item['inventory_item'], 'name': item['inventory_item__name'], 'quantity': item['quantity'], 'spend': money.round_money(item['spend'])})
+        for month in months.values():
+            month['items'] = sorted(month['items'], key=lambda item: -item['spend'])[:top_items]
+            self.round_spend(month)
+        return list(months.values())
+
+    '''
+        Add up the spend of the purchases for each supplier with aggregated queries
+        ---------------------------------------------------------------------------
+        Returns the suppliers with their name, purchase count, date of the latest purchase, line counts and material,
+        tool and tax totals, from one query of the purchases and one of each kind of line.
+    '''
+    def spend_by_supplier(self):
+        suppliers = {}
+        for row in self.order_by('supplier').values('supplier', 'supplier__name').annotate(purchases=Count('pk'), latest_purchase=Max('date'), tax=Sum('tax')):
+            suppliers[row['supplier']] = {'supplier': row['supplier'], 'name': row['supplier__name'], 'purchases': row['purchases'], 'latest_purchase': row['latest_purchase'], 'material_lines': 0, 'tool_lines': 0, 'material_total': money.ZERO, 'tool_total': money.ZERO, 'tax': row['tax']}
+        for name, line_model in [('material', PurchaseMaterial), ('tool', PurchaseTool)]:
+            lines = line_model.objects.filter(purchase__in=self.values('pk')).order_by().values('purchase__supplier')
+            for row in lines.annotate(lines=Count('pk'), spend=Sum('cost')):
+                supplier = suppliers[row['purchase__supplier']]
+                supplier[f'{name}_lines'] = row['lines']
+                supplier[f'{name}_total'] = row['spend']
+        for supplier in suppliers.values():
+            self.round_spend(supplier)
+        return list(suppliers.values())
+
+    ''' Round the material, tool and tax totals of a spend row to cents and add its subtotal and total '''
+    @staticmethod
+    def round_spend(row):
+        for field in ['material_total', 'tool_total', 'tax']:
+            row[field] = money.round_money(money.non_negative(row[field]))
+        row['subtotal'] = money.sum_money([row['material_total'], row['tool_total']])
+        row['total'] = money.sum_money([row['subtotal'], row['tax']])
+        return row
+
+    ''' Prefetch the receipts, materials and tools of each purchase with their inventory items '''
+    def with_lines(self):
+        return self.prefetch_related(
+            'images',
+            Prefetch('purchasematerial_set', queryset=PurchaseMaterial.objects.select_related('inventory_item')),
+            Prefetch('purchasetool_set', queryset=PurchaseTool.objects.select_related('inventory_item')),
+        )
 
 ''' Model for purchases '''
 class Purchase(AtomicOperationsMixin, models.Model):
@@ -13,19 +97,44 @@ class Purchase(AtomicOperationsMixin, models.Model):
     tax = models.DecimalField(max_digits=10, decimal_places=2, default=0.0, validators=[MinValueValidator(Decimal(0.0))])
     date = models.DateField()
 
+    objects = PurchaseQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['date', 'id'], name='purchase_date_id_idx'),
+            models.Index(fields=['supplier', 'date'], name='purchase_supplier_date_idx'),
+            models.Index(fields=['supplier_address', 'date'], name='purchase_address_date_idx'),
+        ]
+
+    '''
+        Read the totals from the with_totals annotations, or calculate them all with a single query when the purchase was not annotated
+        ---------------------------------------------------------------------------------------------------------------------------------
+        Calculated totals are kept on the purchase until it is saved or refreshed from the database, so the query runs at most once.
+    '''
+    def get_totals(self):
+        if hasattr(self, 'calculated_total'):
+            return {field: getattr(self, field) for field in PurchaseQuerySet.CALCULATED_FIELDS}
+        if '_totals' not in self.__dict__:
+            totals = Purchase.objects.with_totals().filter(pk=self.pk).values(*PurchaseQuerySet.CALCULATED_FIELDS).first() if self.pk else None
+            if totals is None:
+                return {'calculated_material_total': 0, 'calculated_tool_total': 0, 'calculated_subtotal': 0, 'calculated_total': self.tax}
+            self._totals = totals
+        return self._totals
+
+    ''' Override refresh_from_db method to calculate the totals again when they are next read '''
+    def refresh_from_db(self, *args, **kwargs):
+        self.__dict__.pop('_totals', None)
+        super().refresh_from_db(*args, **kwargs)
+
     ''' Dynamically calculate purchase material total '''
     @property
     def material_total(self):
-        materials = PurchaseMaterial.objects.filter(purchase__pk=self.pk)
-        total_material_costs = sum(material.cost for material in materials)
-        return Decimal(max(float(total_material_costs), 0.0)).quantize(Decimal('0.01'))
+        return money.round_money(money.non_negative(self.get_totals()['calculated_material_total']))
 
     ''' Dynamically calculate purchase tool total '''
     @property
     def tool_total(self):
-        tools = PurchaseTool.objects.filter(purchase__pk=self.pk)
-        total_tool_costs = sum(tool.cost for tool in tools)
-        return Decimal(max(float(total_tool_costs), 0.0)).quantize(Decimal('0.01'))
+        return money.round_money(money.non_negative(self.get_totals()['calculated_tool_total']))
 
     ''' Dynamically calculate purchase asset total '''
     # @property
@@ -37,12 +146,23 @@ class Purchase(AtomicOperationsMixin, models.Model):
     ''' Dynamically calculate purchase subtotal '''
     @property
     def subtotal(self):
-        return Decimal(max(float(self.material_total) + float(self.tool_total), 0.0)).quantize(Decimal('0.01'))
+        return money.round_money(money.non_negative(self.get_totals()['calculated_subtotal']))
 
     ''' Dynamically calculate purchase total '''
     @property
     def total(self):
-        return Decimal(max(float(self.subtotal) + float(self.tax), 0.0)).quantize(Decimal('0.01'))
+        return money.round_money(money.non_negative(self.get_totals()['calculated_total']))
+
+    ''' Override save method to move the stock and replay the costs of the purchased materials and tools when the purchase date changes, calculating the totals again when they are next read '''
+    def save(self, *args, **kwargs):
+        self.__dict__.pop('_totals', None)
+        with transaction.atomic():
+            previous_date = Purchase.objects.filter(pk=self.pk).values_list('date', flat=True).first() if self.pk else None
+            super().save(*args, **kwargs)
+            if previous_date is not None and previous_date != self.date:
+                PurchaseMaterial.redate_stock(self.purchasematerial_set.all(), previous_date, self.date)
+                PurchaseTool.redate_stock(self.purchasetool_set.all(), previous_date, self.date)
+                PurchaseMaterial.rebuild_costs(self.purchasematerial_set.all())
 
 '''
     Model for purchase in a purchase
@@ -54,31 +174,82 @@ class PurchaseReceipt(AtomicOperationsMixin, models.Model):
     image = PresignedURLImageField(folder_name='purchases', null=True, blank=True)
 
 ''' Abstract base model for purchase inventory items with shared fields and overrides '''
-class PurchaseInventory(AtomicOperationsMixin, models.Model):
+class PurchaseInventory(AtomicOperationsMixin, StockMovementMixin, models.Model):
     purchase = models.ForeignKey(Purchase, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(validators=[MinValueValidator(0)])
     cost = models.DecimalField(max_digits=10, decimal_places=2, validators=[MinValueValidator(Decimal(0.0))])
 
+    STOCK_COUNTS = {'purchased': 'quantity'}
+    STOCK_PARENT = 'purchase'
+
     # Ensures model is abstract and not created in database
     class Meta:
         abstract = True
+        # Finds the purchases of an item for its price history without reading the lines of other items
+        indexes = [ models.Index(fields=['inventory_item', 'purchase'], name='%(class)s_price_idx') ]
 
-    ''' Overrides save method to ensure inventory is refreshed '''
-    def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        self.inventory_item.items_purchased.add(self)
-        self.inventory_item.refresh_from_db()
+    '''
+        Read the unit price paid for an inventory item at each purchase, oldest first
+        -----------------------------------------------------------------------------
+        start_date, end_date: only read purchases dated within this range when given
+        Lines with no quantity have no unit price and are left out.
+    '''
+    @classmethod
+    def price_history(cls, item_id, start_date=None, end_date=None):
+        lines = cls.objects.filter(inventory_item_id=item_id, quantity__gt=0)
+        if start_date:
+            lines = lines.filter(purchase__date__gte=start_date)
+        if end_date:
+            lines = lines.filter(purchase__date__lte=end_date)
+        history = list(lines.order_by('purchase__date', 'pk').values('purchase', 'quantity', 'cost', date=F('purchase__date'), supplier=F('purchase__supplier'), supplier_name=F('purchase__supplier__name')))
+        for line in history:
+            line['unit_cost'] = money.round_money(money.to_decimal(line['cost']) / line['quantity'])
+        return history
+
+    ''' Return the lowest unit price each supplier charged in a price history, cheapest supplier first and the most recent purchase on ties '''
+    @staticmethod
+    def cheapest_suppliers(history):
+        suppliers = {}
+        for line in history:
+            cheapest = suppliers.get(line['supplier'])
+            if cheapest is None or line['unit_cost'] <= cheapest['unit_cost']:
+                suppliers[line['supplier']] = {'supplier': line['supplier'], 'supplier_name': line['supplier_name'], 'unit_cost': line['unit_cost'], 'date': line['date'], 'purchase': line['purchase']}
+        return sorted(suppliers.values(), key=lambda supplier: (supplier['unit_cost'], -supplier['date'].toordinal()))
 
-    ''' Overrides save method to ensure inventory is refreshed '''
-    def delete(self, *args, **kwargs):
-        super().delete(*args, **kwargs)
-        self.inventory_item.items_purchased.remove(self)
-        self.inventory_item.refresh_from_db()
+    '''
+        Add lines for many inventory items to a purchase at once
+        --------------------------------------------------------
+        lines: maps the primary keys of the inventory items to the quantity and cost purchased
+        Items the purchase already has a line for have that line updated with save, like a line entered on its own.
+        The other lines are written with one bulk_create and their stock is added per item. Returns the new lines.
+    '''
+    @classmethod
+    def bulk_add(cls, purchase, lines):
+        with transaction.atomic():
+            existing = {}
+            for line in cls.objects.filter(purchase=purchase, inventory_item__in=lines.keys()).order_by('pk'):
+                existing.setdefault(line.inventory_item_id, line)
+            for item_id, line in existing.items():
+                line.quantity, line.cost = lines[item_id]
+                line.save()
+            created = cls.objects.bulk_create([cls(purchase=purchase, inventory_item_id=item_id, quantity=quantity, cost=cost) for item_id, (quantity, cost) in lines.items() if item_id not in existing])
+            cls.add_stock(created, purchase.date)
+            return created
 
 ''' Model for materials in a purchase '''
-class PurchaseMaterial(PurchaseInventory):
+class PurchaseMaterial(MaterialCostingMixin, PurchaseInventory):
     inventory_item = models.ForeignKey(Material, on_delete=models.CASCADE, related_name='purchse_materials')
 
+    COST_MOVE = 'receive'
+
+    ''' Add lines to a purchase in bulk and receive the new lines into the cost layers and costs of their materials '''
+    @classmethod
+    def bulk_add(cls, purchase, lines):
+        with transaction.atomic():
+            created = super().bulk_add(purchase, lines)
+            MaterialStock.receive_lines(created, purchase.date)
+            return created
+
 ''' Model for tools in a purchase '''
 class PurchaseTool(PurchaseInventory):
     inventory_item = models.ForeignKey(Tool, on_delete=models.CASCADE, related_name='purchase_tools')
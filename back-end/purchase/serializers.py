@@ -1,5 +1,10 @@
 from purchase.models import Purchase, PurchaseMaterial, PurchaseReceipt, PurchaseTool
+from inventory.models import Material, Tool
+from utils.serializers import DateRangeSerializer
 from rest_framework import serializers
+from django.db import transaction
+from decimal import Decimal
+from utils import money
 
 ''' Serializer for purchase receipt model '''
 class PurchaseReceiptSerializer(serializers.ModelSerializer):
@@ -39,8 +44,8 @@ class PurchaseToolSerializer(serializers.ModelSerializer):
 class PurchaseSerializer(serializers.ModelSerializer):
     images = PurchaseReceiptSerializer(many=True, read_only=True)
     uploaded_images = serializers.ListField(child = serializers.ImageField(max_length=1000000, allow_empty_file=False, use_url=False), write_only=True)
-    materials = PurchaseMaterialSerializer(many=True, read_only=True)
-    tools = PurchaseToolSerializer(many=True, read_only=True)
+    materials = PurchaseMaterialSerializer(source='purchasematerial_set', many=True, read_only=True)
+    tools = PurchaseToolSerializer(source='purchasetool_set', many=True, read_only=True)
     # assets = PurchaseAssetSerializer(many=True, read_only=True)
 
     class Meta:
@@ -64,3 +69,91 @@ class PurchaseSerializer(serializers.ModelSerializer):
         for image in uploaded_images:
             PurchaseReceipt.objects.create(purchase=instance, image=image)
         return instance
+
+''' Serializer for a material line of a purchase batch, naming the material so materials not in the inventory yet can be created '''
+class PurchaseBatchMaterialSerializer(serializers.Serializer):
+    name = serializers.CharField(min_length=2, max_length=255)
+    size = serializers.CharField(min_length=2, max_length=255)
+    description = serializers.CharField(max_length=500, required=False, allow_blank=True, allow_null=True)
+    quantity = serializers.IntegerField(min_value=0)
+    cost = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=Decimal(0))
+
+''' Serializer for a tool line of a purchase batch, naming the tool so tools not in the inventory yet can be created '''
+class PurchaseBatchToolSerializer(serializers.Serializer):
+    name = serializers.CharField(min_length=2, max_length=255)
+    description = serializers.CharField(max_length=500, required=False, allow_blank=True, allow_null=True)
+    quantity = serializers.IntegerField(min_value=0)
+    cost = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=Decimal(0))
+
+'''
+    Serializer for a whole receipt of materials and tools added to a purchase at once
+    ---------------------------------------------------------------------------------
+    Materials are matched by name and size and tools by name, each with one query, and the ones not in the inventory
+    yet are created in bulk. Lines repeating an item are added together. Saving takes the purchase to add the lines to.
+'''
+class PurchaseBatchSerializer(serializers.Serializer):
+    materials = PurchaseBatchMaterialSerializer(many=True, default=list)
+    tools = PurchaseBatchToolSerializer(many=True, default=list)
+
+    max_lines = 500
+
+    def validate(self, data):
+        lines = len(data['materials']) + len(data['tools'])
+        if not lines:
+            raise serializers.ValidationError('Provide at least one material or tool.')
+        if lines > self.max_lines:
+            raise serializers.ValidationError(f'At most {self.max_lines} lines can be added at once.')
+        return data
+
+    def create(self, validated_data):
+        purchase = validated_data['purchase']
+        with transaction.atomic():
+            for line_model, item_model, key_fields, lines in [(PurchaseMaterial, Material, ['name', 'size'], validated_data['materials']), (PurchaseTool, Tool, ['name'], validated_data['tools'])]:
+                if lines:
+                    item_ids = self.get_item_ids(item_model, key_fields, lines)
+                    line_model.bulk_add(purchase, self.get_line_totals(item_ids, key_fields, lines))
+        return purchase
+
+    ''' Find the inventory items named by the lines with one query, creating the missing ones in bulk, and return their primary keys by key '''
+    @staticmethod
+    def get_item_ids(item_model, key_fields, lines):
+        described = {tuple(line[field] for field in key_fields): line.get('description') for line in reversed(lines)}
+        candidates = item_model.objects.filter(**{f'{key_fields[0]}__in': {key[0] for key in described}}).order_by('-pk').values_list('pk', *key_fields)
+        item_ids = {tuple(key): pk for pk, *key in candidates if tuple(key) in described}
+        missing = [item_model(description=description, **dict(zip(key_fields, key))) for key, description in described.items() if key not in item_ids]
+        if missing:
+            for item in item_model.objects.bulk_upsert(missing, unique_fields=key_fields, update_fields=[]):
+                item_ids.setdefault(tuple(getattr(item, field) for field in key_fields), item.pk)
+        return item_ids
+
+    ''' Add up the quantity and cost of the lines of each inventory item '''
+    @staticmethod
+    def get_line_totals(item_ids, key_fields, lines):
+        totals = {}
+        for line in lines:
+            item_id = item_ids[tuple(line[field] for field in key_fields)]
+            quantity, cost = totals.get(item_id, (0, 0))
+            totals[item_id] = (quantity + line['quantity'], money.sum_money([cost, line['cost']]))
+        return totals
+
+''' Serializer for validating purchase list filters passed as query parameters '''
+class PurchaseFilterSerializer(DateRangeSerializer):
+    supplier = serializers.IntegerField(required=False, min_value=1)
+    supplier_address = serializers.IntegerField(required=False, min_value=1)
+
+    ''' Apply the validated filters to a purchase queryset so they run in the database '''
+    def filter_queryset(self, queryset):
+        filters = self.validated_data
+        if 'supplier' in filters:
+            queryset = queryset.filter(supplier_id=filters['supplier'])
+        if 'supplier_address' in filters:
+            queryset = queryset.filter(supplier_address_id=filters['supplier_address'])
+        if 'start_date' in filters:
+            queryset = queryset.filter(date__gte=filters['start_date'])
+        if 'end_date' in filters:
+            queryset = queryset.filter(date__lte=filters['end_date'])
+        return queryset
+
+''' Serializer for the price history filters, the cheapest suppliers are found over the given number of days up to today '''
+class PriceHistoryFilterSerializer(DateRangeSerializer):
+    days = serializers.IntegerField(min_value=1, max_value=3650, default=90)
@@ -9,7 +9,9 @@ from django.contrib.staticfiles.finders import find
 from inventory.models import Material, Tool
 from rest_framework import status
 from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
 from django.test import TestCase
+from django.db import connection
 from django.conf import settings
 from django.urls import reverse
 from user.models import User
@@ -43,6 +45,28 @@ class TestPurchaseModel(TestCase):
         purchase.save()
         self.assertEqual(purchase.total, purchase.tax)
 
+    ''' Test with_totals annotates the same totals the properties calculate '''
+    def test_purchase_with_totals(self):
+        purchase = Purchase.objects.with_totals().get(pk=self.purchase.pk)
+        self.assertEqual(purchase.calculated_material_total, Decimal('100.00'))
+        self.assertEqual(purchase.calculated_tool_total, Decimal('854.39'))
+        with self.assertNumQueries(0):
+            self.assertEqual(purchase.subtotal, Decimal('954.39'))
+            self.assertEqual(purchase.total, Decimal('961.22'))
+
+    ''' Test totals of a purchase without annotations are calculated once in a single query '''
+    def test_purchase_totals_without_annotations(self):
+        purchase = Purchase.objects.get(pk=self.purchase.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(purchase.total, Decimal('961.22'))
+            self.assertEqual(purchase.material_total, Decimal('100.00'))
+            self.assertEqual(purchase.tool_total, Decimal('854.39'))
+            self.assertEqual(purchase.subtotal, Decimal('954.39'))
+        # Refreshing the purchase calculates the totals again
+        PurchaseTool.objects.filter(purchase=purchase).delete()
+        purchase.refresh_from_db()
+        self.assertEqual(purchase.total, Decimal('106.83'))
+
     ''' Test save method for purchase material model '''
     def test_purchase_material_save(self):
         initial_quantity = self.material.available_quantity
@@ -398,6 +422,74 @@ class TestPurchaseView(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.data), Purchase.objects.count())
 
+    ''' Test get purchases returns the totals, materials and tools with a fixed number of queries '''
+    def test_get_purchases_query_count(self):
+        material = Material.objects.create(name='material', size='2 inch X 4 inch X 8 feet')
+        tool = Tool.objects.create(name='tool', description='tool description')
+        PurchaseMaterial.objects.create(purchase=self.purchase, inventory_item=material, quantity=10, cost=100.0)
+        PurchaseTool.objects.create(purchase=self.purchase, inventory_item=tool, quantity=2, cost=50.25)
+        self.client.force_authenticate(user=self.user)
+        with self.assertNumQueries(4):
+            response = self.client.get(self.list_url)
+        for index in range(3):
+            purchase = Purchase.objects.create(supplier=self.supplier, supplier_address=self.address, tax=1.00, date=timezone.now().date())
+            PurchaseMaterial.objects.create(purchase=purchase, inventory_item=material, quantity=index + 1, cost=10.0)
+        with self.assertNumQueries(4):
+            response = self.client.get(self.list_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        purchase = next(item for item in response.data if item['id'] == self.purchase.pk)
+        self.assertEqual(Decimal(purchase['material_total']), Decimal('100.00'))
+        self.assertEqual(Decimal(purchase['tool_total']), Decimal('50.25'))
+        self.assertEqual(Decimal(purchase['total']), Decimal('157.08'))
+        self.assertEqual(len(purchase['materials']), 1)
+        self.assertEqual(len(purchase['tools']), 1)
+
+    ''' Test get purchases filtered by supplier, supplier address and date range '''
+    def test_get_purchases_filtered(self):
+        self.client.force_authenticate(user=self.user)
+        supplier = Supplier.objects.create(name='other supplier')
+        address = SupplierAddress.objects.create(supplier=supplier, street_address='456 Test Street', city='City', state='State', zip=12345)
+        other_purchase = Purchase.objects.create(supplier=supplier, supplier_address=address, tax=1.00, date=timezone.now().date() - timezone.timedelta(days=30))
+        response = self.client.get(self.list_url, {'supplier': supplier.pk})
+        self.assertEqual([purchase['id'] for purchase in response.data], [other_purchase.pk])
+        response = self.client.get(self.list_url, {'supplier_address': self.address.pk})
+        self.assertEqual([purchase['id'] for purchase in response.data], [self.purchase.pk])
+        response = self.client.get(self.list_url, {'start_date': timezone.now().date() - timezone.timedelta(days=31), 'end_date': timezone.now().date() - timezone.timedelta(days=1)})
+        self.assertEqual([purchase['id'] for purchase in response.data], [other_purchase.pk])
+
+    ''' Test get purchases with invalid filters '''
+    def test_get_purchases_invalid_filters(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(self.list_url, {'supplier': 'first', 'start_date': 'yesterday'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('supplier', response.data)
+        self.assertIn('start_date', response.data)
+        response = self.client.get(self.list_url, {'start_date': timezone.now().date(), 'end_date': timezone.now().date() - timezone.timedelta(days=1)})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('end_date', response.data)
+
+    ''' Test get purchases paginated by date with a cursor '''
+    def test_get_purchases_paginated(self):
+        self.client.force_authenticate(user=self.user)
+        for days in range(1, 5):
+            Purchase.objects.create(supplier=self.supplier, supplier_address=self.address, tax=1.00, date=timezone.now().date() - timezone.timedelta(days=days))
+        Purchase.objects.create(supplier=self.supplier, supplier_address=self.address, tax=1.00, date=timezone.now().date())
+        expected_ids = list(Purchase.objects.order_by('-date', '-id').values_list('id', flat=True))
+        with self.assertNumQueries(4):
+            response = self.client.get(self.list_url, {'page_size': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        ids = [purchase['id'] for purchase in response.data['results']]
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            ids += [purchase['id'] for purchase in response.data['results']]
+        self.assertEqual(ids, expected_ids)
+
+    ''' Test get purchases with an invalid cursor '''
+    def test_get_purchases_invalid_cursor(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(self.list_url, {'cursor': 'invalid'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
     ''' Test create purchase with empty data '''
     def test_create_purchase_empty_data(self):
         self.client.force_authenticate(user=self.user)
@@ -646,6 +738,170 @@ class TestPurchaseNewMaterialView(APITestCase):
         self.assertEqual(self.purchase_material.quantity, self.existing_data['quantity'])
         self.assertAlmostEqual(float(self.purchase_material.cost), self.existing_data['cost'], places=2)
 
+''' Tests for purchase batch view '''
+class TestPurchaseBatchView(APITestCase):
+
+    ''' Set up testing data '''
+    @classmethod
+    def setUpTestData(cls):
+        cls.client = APIClient()
+        cls.password = 'test1234'
+        cls.supplier = Supplier.objects.create(name='supplier')
+        cls.address = SupplierAddress.objects.create(supplier=cls.supplier, street_address='123 Test Street', city='City', state='State', zip=12345)
+        cls.purchase = Purchase.objects.create(supplier=cls.supplier, supplier_address=cls.address, tax=6.83, date=timezone.now().date())
+        cls.material = Material.objects.create(name='stud', size='2 inch X 4 inch X 8 feet', description='test')
+        cls.tool = Tool.objects.create(name='hammer', description='test')
+        cls.purchase_material = PurchaseMaterial.objects.create(purchase=Purchase.objects.create(supplier=cls.supplier, supplier_address=cls.address, tax=0, date=timezone.now().date() - timezone.timedelta(days=7)), inventory_item=cls.material, quantity=10, cost=20.0)
+        cls.valid_data = {
+            'materials': [
+                {'name': 'stud', 'size': '2 inch X 4 inch X 8 feet', 'quantity': 10, 'cost': 40.00},
+                {'name': 'stud', 'size': '2 inch X 6 inch X 8 feet', 'description': 'wider', 'quantity': 5, 'cost': 30.00},
+                {'name': 'screws', 'size': '3 inch', 'quantity': 2, 'cost': 12.50},
+                {'name': 'screws', 'size': '3 inch', 'quantity': 1, 'cost': 6.25},
+            ],
+            'tools': [
+                {'name': 'hammer', 'quantity': 1, 'cost': 25.00},
+                {'name': 'level', 'description': 'four feet', 'quantity': 2, 'cost': 60.00},
+            ],
+        }
+        cls.url = lambda purchase_pk: reverse('purchase-batch', kwargs={'purchase_pk': purchase_pk})
+        cls.user = User.objects.create(first_name='first', last_name='last', email='firstlast@example.com', phone='1 (234) 567-8901', password=make_password(cls.password))
+
+    ''' Test batch for a purchase that does not exist '''
+    def test_batch_purchase_not_found(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post(self.url(96), data=self.valid_data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(response.data['detail'], 'Purchase Not Found.')
+
+    ''' Test batch without any lines '''
+    def test_batch_empty_data(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post(self.url(self.purchase.pk), data={'materials': [], 'tools': []}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('non_field_errors', response.data)
+
+    ''' Test batch with an invalid line adds none of the lines '''
+    def test_batch_invalid_line(self):
+        self.client.force_authenticate(user=self.user)
+        data = {'materials': self.valid_data['materials'] + [{'name': 'f', 'size': 'size', 'quantity': -1, 'cost': 5}], 'tools': self.valid_data['tools']}
+        response = self.client.post(self.url(self.purchase.pk), data=data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('name', response.data['materials'][4])
+        self.assertIn('quantity', response.data['materials'][4])
+        self.assertFalse(PurchaseMaterial.objects.filter(purchase=self.purchase).exists())
+        self.assertFalse(Material.objects.filter(name='screws').exists())
+
+    ''' Test batch success matches existing items, creates missing items and adds the lines with their stock and costs '''
+    def test_batch_success(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post(self.url(self.purchase.pk), data=self.valid_data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Decimal(str(response.data['material_total'])), Decimal('88.75'))
+        self.assertEqual(Decimal(str(response.data['tool_total'])), Decimal('85.00'))
+        self.assertEqual(len(response.data['materials']), 3)
+        self.assertEqual(len(response.data['tools']), 2)
+        self.assertEqual(Material.objects.filter(name='stud').count(), 2)
+        self.assertEqual(Material.objects.get(size='2 inch X 6 inch X 8 feet').description, 'wider')
+        screws = Material.objects.get(name='screws')
+        self.assertEqual(screws.available_quantity, 3)
+        self.assertEqual(screws.unit_cost, Decimal('6.25'))
+        self.assertEqual(Tool.objects.get(name='level').available_quantity, 2)
+        self.assertEqual(Tool.objects.filter(name='hammer').count(), 1)
+        self.assertEqual(Material.objects.search('screws').count(), 1)
+        self.material.refresh_from_db()
+        self.assertEqual(self.material.available_quantity, 20)
+        self.assertEqual(self.material.stock.average_cost, Decimal('3'))
+        self.assertEqual(self.material.stock.latest_cost, Decimal('4'))
+        self.assertEqual(self.material.stock.fifo_cost, Decimal('2'))
+        self.assertEqual(self.material.cost_layers.count(), 2)
+
+    ''' Test batch updates the line of an item the purchase already has '''
+    def test_batch_existing_line(self):
+        purchase_tool = PurchaseTool.objects.create(purchase=self.purchase, inventory_item=self.tool, quantity=3, cost=75.00)
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post(self.url(self.purchase.pk), data={'tools': [{'name': 'hammer', 'quantity': 2, 'cost': 50.00}]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        purchase_tool.refresh_from_db()
+        self.assertEqual(purchase_tool.quantity, 2)
+        self.assertEqual(PurchaseTool.objects.filter(purchase=self.purchase).count(), 1)
+        self.assertEqual(Tool.objects.get(pk=self.tool.pk).available_quantity, 2)
+
+    ''' Test the number of queries of a batch does not grow with the number of new items '''
+    def test_batch_query_count(self):
+        self.client.force_authenticate(user=self.user)
+        query_counts = {}
+        for count in [5, 40]:
+            data = {'materials': [{'name': f'board {count}-{index}', 'size': '1 inch X 6 inch', 'quantity': 2, 'cost': 10.00} for index in range(count)]}
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(self.url(self.purchase.pk), data=data, format='json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            query_counts[count] = len(queries)
+        # Only the stock level and movement journal of each material are still written one material at a time
+        self.assertLessEqual(query_counts[40] - query_counts[5], 4 * 35)
+
+''' Tests for price history view '''
+class TestPriceHistoryView(APITestCase):
+
+    ''' Set up testing data '''
+    @classmethod
+    def setUpTestData(cls):
+        cls.client = APIClient()
+        cls.password = 'test1234'
+        cls.today = timezone.localdate()
+        cls.lumber_yard = Supplier.objects.create(name='lumber yard')
+        cls.hardware_store = Supplier.objects.create(name='hardware store')
+        cls.material = Material.objects.create(name='stud', size='2 inch X 4 inch X 8 feet')
+        cls.tool = Tool.objects.create(name='hammer', description='test')
+        for supplier, days_ago, quantity, cost in [(cls.lumber_yard, 200, 10, 20.00), (cls.hardware_store, 30, 10, 45.00), (cls.lumber_yard, 20, 10, 50.00), (cls.lumber_yard, 10, 4, 16.00), (cls.hardware_store, 5, 0, 0)]:
+            address = SupplierAddress.objects.create(supplier=supplier, street_address='123 Test Street', city='City', state='State', zip=12345)
+            purchase = Purchase.objects.create(supplier=supplier, supplier_address=address, tax=0, date=cls.today - timezone.timedelta(days=days_ago))
+            PurchaseMaterial.objects.create(purchase=purchase, inventory_item=cls.material, quantity=quantity, cost=cost)
+        cls.material_url = lambda pk: reverse('material-price-history', kwargs={'item_pk': pk})
+        cls.tool_url = lambda pk: reverse('tool-price-history', kwargs={'item_pk': pk})
+        cls.user = User.objects.create(first_name='first', last_name='last', email='firstlast@example.com', phone='1 (234) 567-8901', password=make_password(cls.password))
+
+    ''' Test price history for a material that does not exist '''
+    def test_price_history_not_found(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(self.material_url(96))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(response.data['detail'], 'Material Not Found.')
+
+    ''' Test price history with an end date before the start date '''
+    def test_price_history_invalid_dates(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(self.material_url(self.material.pk), {'start_date': self.today, 'end_date': self.today - timezone.timedelta(days=1)})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('end_date', response.data)
+
+    ''' Test price history returns the unit prices oldest first and the cheapest recent supplier '''
+    def test_price_history_success(self):
+        self.client.force_authenticate(user=self.user)
+        with self.assertNumQueries(3):
+            response = self.client.get(self.material_url(self.material.pk))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([line['unit_cost'] for line in response.data['history']], [Decimal('2.00'), Decimal('4.50'), Decimal('5.00'), Decimal('4.00')])
+        self.assertEqual(response.data['history'][0]['supplier_name'], 'lumber yard')
+        self.assertEqual([supplier['supplier_name'] for supplier in response.data['suppliers']], ['lumber yard', 'hardware store'])
+        self.assertEqual(response.data['cheapest']['unit_cost'], Decimal('4.00'))
+        self.assertEqual(response.data['cheapest']['date'], self.today - timezone.timedelta(days=10))
+
+    ''' Test price history within a date range and recent window '''
+    def test_price_history_filters(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(self.material_url(self.material.pk), {'start_date': self.today - timezone.timedelta(days=25), 'days': 15})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['history']), 2)
+        self.assertEqual(len(response.data['suppliers']), 1)
+
+    ''' Test price history of a tool that was never purchased '''
+    def test_price_history_no_purchases(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(self.tool_url(self.tool.pk))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'history': [], 'suppliers': [], 'cheapest': None})
+
 ''' Tests for purchase tool view '''
 class TestPurchaseToolView(APITestCase):
 
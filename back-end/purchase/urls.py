@@ -1,4 +1,5 @@
-from purchase.views import PurchaseView, PurchaseMaterialView, PurchaseNewMaterialView, PurchaseReceiptView, PurchaseToolView, PurchaseNewToolView
+from purchase.views import PurchaseView, PurchaseMaterialView, PurchaseNewMaterialView, PurchaseReceiptView, PurchaseToolView, PurchaseNewToolView, PurchaseBatchView, PriceHistoryView
+from purchase.models import PurchaseMaterial, PurchaseTool
 from django.urls import path
 
 urlpatterns = [
@@ -12,11 +13,16 @@ urlpatterns = [
 
     path('new/material/<int:purchase_pk>/', PurchaseNewMaterialView.as_view(), name='purchase-new-material'),
 
+    path('batch/<int:purchase_pk>/', PurchaseBatchView.as_view(), name='purchase-batch'),
+
     path('tool/<int:purchase_pk>/', PurchaseToolView.as_view(), name='purchase-tool-list'),
     path('tool/<int:purchase_pk>/<int:tool_pk>/', PurchaseToolView.as_view(), name='purchase-tool-detail'),
 
     path('new/tool/<int:purchase_pk>/', PurchaseNewToolView.as_view(), name='purchase-new-tool'),
 
+    path('price/material/<int:item_pk>/', PriceHistoryView.as_view(line_model=PurchaseMaterial), name='material-price-history'),
+    path('price/tool/<int:item_pk>/', PriceHistoryView.as_view(line_model=PurchaseTool), name='tool-price-history'),
+
     # path('asset/<int:purchase_pk>/', PurchaseAssetView.as_view(), name='purchase-asset-list'),
     # path('asset/<int:purchase_pk>/<int:asset_pk>/', PurchaseAssetView.as_view(), name='purchase-asset-detail'),
 
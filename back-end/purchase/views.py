@@ -1,30 +1,50 @@
-from purchase.serializers import PurchaseSerializer, PurchaseMaterialSerializer, PurchaseToolSerializer
+from purchase.serializers import PurchaseSerializer, PurchaseMaterialSerializer, PurchaseToolSerializer, PurchaseBatchSerializer, PriceHistoryFilterSerializer, PurchaseFilterSerializer
 from purchase.models import Purchase, PurchaseMaterial, PurchaseReceipt, PurchaseTool
 from inventory.serializers import MaterialSerializer, ToolSerializer
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.exceptions import ValidationError
+from utils.pagination import DateKeysetPagination
 from rest_framework.response import Response
 from inventory.models import Material, Tool
 from rest_framework.views import APIView
+from django.utils import timezone
 from rest_framework import status
 
-''' CRUD view for purchase model '''
+'''
+    CRUD view for purchase model
+    ----------------------------
+    get method returns either single instance or list of instances filtered by supplier, supplier_address, start_date
+    and end_date, paginated by date when a cursor or page_size is requested
+    get method annotates the totals and prefetches the receipts, materials and tools, so the number of queries does not
+    grow with the number of purchases
+'''
 class PurchaseView(APIView):
     permission_classes = [IsAuthenticated]
+    pagination_class = DateKeysetPagination
 
     def get_object(self, pk=None):
         return Purchase.objects.get(pk=pk)
 
+    def get_queryset(self):
+        return Purchase.objects.with_totals().with_lines()
+
     def get(self, request, *args, **kwargs):
         pk = kwargs.pop('pk', None)
         if pk:
             try:
-                purchase = self.get_object(pk)
+                purchase = self.get_queryset().get(pk=pk)
                 serializer = PurchaseSerializer(purchase)
             except Purchase.DoesNotExist:
                 return Response({'detail': 'Purchase Not Found.'}, status=status.HTTP_404_NOT_FOUND)
         else:
-            purchases = Purchase.objects.all()
+            filters = PurchaseFilterSerializer(data=request.query_params.dict())
+            if not filters.is_valid():
+                return Response(filters.errors, status=status.HTTP_400_BAD_REQUEST)
+            purchases = filters.filter_queryset(self.get_queryset())
+            paginator = self.pagination_class()
+            if paginator.is_requested(request):
+                page = paginator.paginate_queryset(purchases, request)
+                return paginator.get_paginated_response(PurchaseSerializer(page, many=True).data)
             serializer = PurchaseSerializer(purchases, many=True)
         return Response(serializer.data)
 
@@ -151,6 +171,55 @@ class PurchaseNewMaterialView(APIView):
         except ValidationError as error:
             return Response(error.detail, status=status.HTTP_400_BAD_REQUEST)
 
+'''
+    View for entering a whole receipt of materials and tools into a purchase at once
+    --------------------------------------------------------------------------------
+    post method adds every line of the receipt in a single transaction and returns the purchase with its totals and lines
+'''
+class PurchaseBatchView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        purchase_pk = kwargs.pop('purchase_pk', None)
+        try:
+            purchase = Purchase.objects.get(pk=purchase_pk)
+        except Purchase.DoesNotExist:
+            return Response({'detail': 'Purchase Not Found.'}, status=status.HTTP_404_NOT_FOUND)
+        serializer = PurchaseBatchSerializer(data=request.data)
+        try:
+            serializer.is_valid(raise_exception=True)
+            serializer.save(purchase=purchase)
+            purchase = Purchase.objects.with_totals().with_lines().get(pk=purchase.pk)
+            return Response(PurchaseSerializer(purchase).data, status=status.HTTP_201_CREATED)
+        except ValidationError as error:
+            return Response(error.detail, status=status.HTTP_400_BAD_REQUEST)
+
+'''
+    View for the price history of a material or tool, used when quoting jobs
+    ------------------------------------------------------------------------
+    get method returns the unit price paid at each purchase of the item within start_date and end_date, oldest first,
+    and the lowest unit price each supplier charged within the last days, cheapest supplier first
+    line_model: the purchase line model of the kind of item, set for each url
+'''
+class PriceHistoryView(APIView):
+    permission_classes = [IsAuthenticated]
+    line_model = None
+
+    def get(self, request, *args, **kwargs):
+        item_pk = kwargs.pop('item_pk', None)
+        item_model = self.line_model._meta.get_field('inventory_item').related_model
+        if not item_model.objects.filter(pk=item_pk).exists():
+            return Response({'detail': f'{item_model.__name__} Not Found.'}, status=status.HTTP_404_NOT_FOUND)
+        serializer = PriceHistoryFilterSerializer(data=request.query_params.dict())
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        filters = serializer.validated_data
+        history = self.line_model.price_history(item_pk, filters.get('start_date'), filters.get('end_date'))
+        today = timezone.localdate()
+        recent = self.line_model.price_history(item_pk, start_date=today - timezone.timedelta(days=filters['days'] - 1), end_date=today)
+        suppliers = self.line_model.cheapest_suppliers(recent)
+        return Response({'history': history, 'suppliers': suppliers, 'cheapest': suppliers[0] if suppliers else None}, status=status.HTTP_200_OK)
+
 ''' CRUD view for purchase tool model '''
 class PurchaseToolView(APIView):
     permission_classes = [IsAuthenticated]
@@ -1,4 +1,5 @@
 from supplier.models import Supplier, SupplierAddress
+from utils.serializers import DateRangeSerializer
 from rest_framework import serializers
 
 ''' Serializer for supplier address model '''
@@ -56,3 +57,7 @@ class SupplierSerializer(serializers.ModelSerializer):
         for address in existing_addresses:
             if address.id not in incoming_ids:
                 address.delete()
+
+''' Serializer for the supplier spend filters, only purchases dated within start_date and end_date are added up when given '''
+class SpendFilterSerializer(DateRangeSerializer):
+    top = serializers.IntegerField(min_value=1, max_value=50, default=5)
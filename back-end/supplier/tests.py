@@ -1,11 +1,15 @@
 from supplier.serializers import SupplierSerializer, SupplierAddressSerializer
+from purchase.models import Purchase, PurchaseMaterial, PurchaseTool
 from rest_framework.test import APITestCase, APIClient
 from django.contrib.auth.hashers import make_password
 from supplier.models import Supplier, SupplierAddress
+from inventory.models import Material, Tool
 from rest_framework import status
 from django.test import TestCase
 from django.urls import reverse
 from user.models import User
+from decimal import Decimal
+from datetime import date
 
 ''' Tests for supplier models '''
 class TestSupplierModels(TestCase):
@@ -21,6 +25,7 @@ class TestSupplierModels(TestCase):
     def tearDownClass(cls):
         cls.address.delete()
         cls.supplier.delete()
+        super().tearDownClass()
 
     ''' Test string method for supplier model '''
     def test_supplier_string(self):
@@ -54,6 +59,7 @@ class TestSupplierSerializers(TestCase):
     def tearDownClass(cls):
         cls.address.delete()
         cls.supplier.delete()
+        super().tearDownClass()
 
     ''' Test supplier serializer with empty data '''
     def test_supplier_serializer_empty_data(self):
@@ -245,3 +251,85 @@ class TestSupplierView(APITestCase):
         response = self.client.delete(self.detail_url(self.supplier.pk))
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
         self.assertEqual(Supplier.objects.count(), 0)
+
+''' Tests for supplier spend view '''
+class TestSupplierSpendView(APITestCase):
+
+    ''' Set up test data '''
+    @classmethod
+    def setUpTestData(cls):
+        cls.client = APIClient()
+        cls.password = 'test1234'
+        cls.lumber_yard = Supplier.objects.create(name='lumber yard')
+        cls.hardware_store = Supplier.objects.create(name='hardware store')
+        cls.stud = Material.objects.create(name='stud', size='2 inch X 4 inch X 8 feet')
+        cls.screws = Material.objects.create(name='screws', size='3 inch')
+        cls.hammer = Tool.objects.create(name='hammer', description='test')
+        purchases = {}
+        for supplier, day, tax in [(cls.lumber_yard, date(2026, 1, 5), 2.50), (cls.lumber_yard, date(2026, 1, 20), 1.00), (cls.lumber_yard, date(2026, 2, 3), 0.75), (cls.hardware_store, date(2026, 2, 10), 3.10)]:
+            address = SupplierAddress.objects.create(supplier=supplier, street_address='123 Test Street', city='City', state='State', zip=12345)
+            purchases[day] = Purchase.objects.create(supplier=supplier, supplier_address=address, tax=tax, date=day)
+        PurchaseMaterial.objects.create(purchase=purchases[date(2026, 1, 5)], inventory_item=cls.stud, quantity=10, cost=40.00)
+        PurchaseMaterial.objects.create(purchase=purchases[date(2026, 1, 5)], inventory_item=cls.screws, quantity=2, cost=12.50)
+        PurchaseMaterial.objects.create(purchase=purchases[date(2026, 1, 20)], inventory_item=cls.stud, quantity=5, cost=20.10)
+        PurchaseTool.objects.create(purchase=purchases[date(2026, 1, 20)], inventory_item=cls.hammer, quantity=1, cost=25.00)
+        PurchaseMaterial.objects.create(purchase=purchases[date(2026, 2, 3)], inventory_item=cls.screws, quantity=1, cost=6.25)
+        PurchaseTool.objects.create(purchase=purchases[date(2026, 2, 10)], inventory_item=cls.hammer, quantity=2, cost=49.90)
+        cls.summary_url = reverse('supplier-spend-summary')
+        cls.detail_url = lambda pk: reverse('supplier-spend', kwargs={'pk': pk})
+        cls.user = User.objects.create(first_name='first', last_name='last', email='firstlast@example.com', phone='1 (234) 567-8901', password=make_password(cls.password))
+
+    ''' Test spend for a supplier that does not exist '''
+    def test_supplier_spend_not_found(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(self.detail_url(96))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(response.data['detail'], 'Supplier Not Found.')
+
+    ''' Test spend with an end date before the start date '''
+    def test_supplier_spend_invalid_dates(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(self.summary_url, {'start_date': '2026-02-01', 'end_date': '2026-01-01'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('end_date', response.data)
+
+    ''' Test spend of a supplier by month with aggregated queries '''
+    def test_supplier_spend_success(self):
+        self.client.force_authenticate(user=self.user)
+        with self.assertNumQueries(4):
+            response = self.client.get(self.detail_url(self.lumber_yard.pk), {'top': 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['name'], 'lumber yard')
+        self.assertEqual(response.data['purchases'], 3)
+        self.assertEqual(response.data['material_lines'], 4)
+        self.assertEqual(response.data['tool_lines'], 1)
+        self.assertEqual(response.data['tax'], Decimal('4.25'))
+        self.assertEqual(response.data['total'], Decimal('108.10'))
+        january, february = response.data['months']
+        self.assertEqual(january['month'], date(2026, 1, 1))
+        self.assertEqual(january['material_total'], Decimal('72.60'))
+        self.assertEqual(january['total'], Decimal('101.10'))
+        self.assertEqual(january['items'], [{'type': 'material', 'id': self.stud.pk, 'name': 'stud', 'quantity': 15, 'spend': Decimal('60.10')}])
+        self.assertEqual(february['purchases'], 1)
+        self.assertEqual(february['total'], Decimal('7.00'))
+
+    ''' Test spend summary across every supplier '''
+    def test_supplier_spend_summary(self):
+        self.client.force_authenticate(user=self.user)
+        with self.assertNumQueries(6):
+            response = self.client.get(self.summary_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['purchases'], 4)
+        self.assertEqual(response.data['total'], Decimal('161.10'))
+        self.assertEqual([supplier['name'] for supplier in response.data['suppliers']], ['lumber yard', 'hardware store'])
+        self.assertEqual(response.data['suppliers'][1]['total'], Decimal('53.00'))
+        self.assertEqual(response.data['suppliers'][1]['latest_purchase'], date(2026, 2, 10))
+        self.assertEqual(response.data['months'][1]['items'][0]['name'], 'hammer')
+
+    ''' Test spend summary within a date range '''
+    def test_supplier_spend_date_range(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(self.summary_url, {'start_date': '2026-02-01'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['months']), 1)
+        self.assertEqual(response.data['total'], Decimal('60.00'))
@@ -1,4 +1,4 @@
-from supplier.views import SupplierView, AddressView
+from supplier.views import SupplierView, AddressView, SupplierSpendView
 from django.urls import path
 
 urlpatterns = [
@@ -6,4 +6,7 @@ urlpatterns = [
     path('<int:pk>/', SupplierView.as_view(), name='supplier-detail'),
 
     path('address/<int:pk>/', AddressView.as_view(), name='supplier-address'),
+
+    path('spend/', SupplierSpendView.as_view(), name='supplier-spend-summary'),
+    path('<int:pk>/spend/', SupplierSpendView.as_view(), name='supplier-spend'),
 ]
@@ -1,10 +1,12 @@
+from supplier.serializers import SupplierSerializer, SpendFilterSerializer
 from rest_framework.permissions import IsAuthenticated
 from supplier.models import Supplier, SupplierAddress
 from rest_framework.exceptions import ValidationError
-from supplier.serializers import SupplierSerializer
 from rest_framework.response import Response
 from rest_framework.views import APIView
+from purchase.models import Purchase
 from rest_framework import status
+from utils import money
 
 ''' CRUD view for supplier model '''
 class SupplierView(APIView):
@@ -63,3 +65,40 @@ class AddressView(APIView):
         pk = kwargs.pop('pk', None)
         address = self.get_object(pk)
         return Response({'representation': address.__str__()})
+
+'''
+    View for the spend with suppliers
+    ---------------------------------
+    get method returns the spend with a single supplier, or with every supplier when no pk is given, for each month
+    with the items with the most spend, added up by aggregated queries of the purchases and their lines
+'''
+class SupplierSpendView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        pk = kwargs.pop('pk', None)
+        serializer = SpendFilterSerializer(data=request.query_params.dict())
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        filters = serializer.validated_data
+        purchases = Purchase.objects.all()
+        if filters.get('start_date'):
+            purchases = purchases.filter(date__gte=filters['start_date'])
+        if filters.get('end_date'):
+            purchases = purchases.filter(date__lte=filters['end_date'])
+        if pk:
+            supplier = Supplier.objects.filter(pk=pk).values('id', 'name').first()
+            if supplier is None:
+                return Response({'detail': 'Supplier Not Found.'}, status=status.HTTP_404_NOT_FOUND)
+            months = purchases.filter(supplier=pk).spend_by_month(filters['top'])
+            return Response({**supplier, **self.get_totals(months), 'months': months}, status=status.HTTP_200_OK)
+        months = purchases.spend_by_month(filters['top'])
+        suppliers = sorted(purchases.spend_by_supplier(), key=lambda supplier: -supplier['total'])
+        return Response({**self.get_totals(months), 'suppliers': suppliers, 'months': months}, status=status.HTTP_200_OK)
+
+    ''' Add up the totals and counts of the months '''
+    def get_totals(self, months):
+        totals = {field: sum(month[field] for month in months) for field in ['purchases', 'material_lines', 'tool_lines']}
+        for field in ['material_total', 'tool_total', 'tax', 'subtotal', 'total']:
+            totals[field] = money.round_money(money.sum_money(month[field] for month in months))
+        return totals
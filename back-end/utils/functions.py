@@ -0,0 +1,14 @@
+from django.db.models import DecimalField, Func
+
+'''
+    Convert a duration expression to a decimal number of hours
+    -----------------------------------------------------------
+    SQLite stores durations as microseconds while PostgreSQL returns an interval, so each backend needs its own SQL.
+'''
+class DurationHours(Func):
+    arity = 1
+    output_field = DecimalField(max_digits=12, decimal_places=6)
+    template = '(%(expressions)s / 3600000000.0)'
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, template='(EXTRACT(EPOCH FROM %(expressions)s) / 3600)', **extra_context)
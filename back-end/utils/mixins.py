@@ -1,13 +1,31 @@
+from contextlib import contextmanager
 from django.db import transaction
 
 ''' Mixin to provide atomic save and delete operations with row locking '''
 class AtomicOperationsMixin:
 
-    ''' Override save method to ensure database transaction is atomic and handles race conditions '''
-    def save(self, *args, **kwargs):
+    '''
+        Run a save method in one transaction with the saved row of the instance locked
+        ------------------------------------------------------------------------------
+        Yields the row as it was before the save, or None for a new instance. The outermost save method of the model
+        starts the transaction and locks the row, and the save methods it calls share both, so the row is read once.
+    '''
+    @contextmanager
+    def save_transaction(self):
+        if hasattr(self, '_saved_row'):
+            yield self._saved_row
+            return
         with transaction.atomic():
             # Lock the row if it exists
-            self.__class__.objects.select_for_update().filter(pk=self.pk).first()
+            self._saved_row = self.__class__.objects.select_for_update().filter(pk=self.pk).first() if self.pk else None
+            try:
+                yield self._saved_row
+            finally:
+                del self._saved_row
+
+    ''' Override save method to ensure database transaction is atomic and handles race conditions '''
+    def save(self, *args, **kwargs):
+        with self.save_transaction():
             super().save(*args, **kwargs)
 
     ''' Override delete method to ensure database transaction is atomic and handles race conditions '''
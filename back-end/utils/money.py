@@ -0,0 +1,116 @@
+from decimal import Decimal, Context, ROUND_HALF_UP, localcontext
+from collections import namedtuple
+
+'''
+    Exact money calculations for orders and purchases
+    -------------------------------------------------
+    All amounts are calculated in Decimal using one shared context and rounded once to whole cents.
+    Floats are converted through their shortest string representation so binary rounding errors never
+    enter a calculation.
+'''
+
+MONEY_CONTEXT = Context(prec=28, rounding=ROUND_HALF_UP)
+CENTS = Decimal('0.01')
+ZERO = Decimal('0')
+HUNDRED = Decimal('100')
+
+''' Priced order totals returned by price_order and price_orders '''
+OrderPrice = namedtuple('OrderPrice', ['labor_total', 'material_total', 'line_total', 'subtotal', 'tax_total', 'discount_total', 'total', 'payment_total', 'working_total', 'paid'])
+
+''' Convert a number or None to a Decimal without float rounding errors '''
+def to_decimal(value):
+    if value is None:
+        return ZERO
+    if isinstance(value, Decimal):
+        return value
+    if isinstance(value, float):
+        return Decimal(repr(value))
+    return Decimal(value)
+
+''' Round an amount to whole cents using the shared money context '''
+def round_money(value):
+    return to_decimal(value).quantize(CENTS, context=MONEY_CONTEXT)
+
+''' Return an amount that is never negative '''
+def non_negative(value):
+    return max(to_decimal(value), ZERO)
+
+''' Calculate a percentage of an amount '''
+def percent_of(amount, rate):
+    with localcontext(MONEY_CONTEXT):
+        return to_decimal(amount) * to_decimal(rate) / HUNDRED
+
+''' Add the total of a list of amounts '''
+def sum_money(values):
+    with localcontext(MONEY_CONTEXT):
+        return sum((to_decimal(value) for value in values), ZERO)
+
+''' Calculate the labor total from an hourly rate and hours worked '''
+def labor_total(hourly_rate, hours_worked):
+    with localcontext(MONEY_CONTEXT):
+        return non_negative(to_decimal(hourly_rate) * to_decimal(hours_worked))
+
+''' Calculate the material total from the material cost and the material upcharge percentage '''
+def material_total(material_cost, material_upcharge):
+    with localcontext(MONEY_CONTEXT):
+        return round_money(non_negative(to_decimal(material_cost) + percent_of(material_cost, material_upcharge)))
+
+''' Calculate the order subtotal from the labor, material, line item and callout totals '''
+def order_subtotal(labor, materials, line_items, callout):
+    with localcontext(MONEY_CONTEXT):
+        return non_negative(to_decimal(labor) + to_decimal(materials) + to_decimal(line_items) + to_decimal(callout))
+
+''' Calculate the order total from the subtotal, tax percentage and discount percentage '''
+def order_total(subtotal, tax, discount):
+    with localcontext(MONEY_CONTEXT):
+        return round_money(non_negative(to_decimal(subtotal) + percent_of(subtotal, tax) - percent_of(subtotal, discount)))
+
+'''
+    Price a single order
+    --------------------
+    hours_worked: billable hours, already including any minimum
+    material_cost: cost of the materials used before the upcharge
+    line_total, payment_total: sums of the order line items and payments
+    hourly_rate, material_upcharge, callout, tax, discount: the order rates
+'''
+def price_order(hourly_rate, hours_worked, material_cost, material_upcharge, line_total, callout, tax, discount, payment_total):
+    with localcontext(MONEY_CONTEXT):
+        labor = labor_total(hourly_rate, hours_worked)
+        materials = material_total(material_cost, material_upcharge)
+        line_items = round_money(non_negative(line_total))
+        subtotal = order_subtotal(labor, materials, line_items, callout)
+        total = order_total(subtotal, tax, discount)
+        payments = round_money(non_negative(payment_total))
+        working_total = round_money(non_negative(total - payments))
+        return OrderPrice(
+            labor_total=labor,
+            material_total=materials,
+            line_total=line_items,
+            subtotal=subtotal,
+            tax_total=percent_of(subtotal, tax),
+            discount_total=percent_of(subtotal, discount),
+            total=total,
+            payment_total=payments,
+            working_total=working_total,
+            paid=working_total <= ZERO,
+        )
+
+'''
+    Price a batch of order rows in one pass
+    ---------------------------------------
+    rows: mappings with the price_order argument names as keys, for example rows from a values() queryset
+    Returns the priced totals in the same order as the rows.
+'''
+def price_orders(rows):
+    with localcontext(MONEY_CONTEXT):
+        return [price_order(
+            hourly_rate=row['hourly_rate'],
+            hours_worked=row['hours_worked'],
+            material_cost=row.get('material_cost'),
+            material_upcharge=row['material_upcharge'],
+            line_total=row.get('line_total'),
+            callout=row['callout'],
+            tax=row['tax'],
+            discount=row['discount'],
+            payment_total=row.get('payment_total'),
+        ) for row in rows]
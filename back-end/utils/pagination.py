@@ -0,0 +1,117 @@
+from rest_framework.utils.urls import replace_query_param
+from rest_framework.exceptions import NotFound
+from rest_framework.response import Response
+from django.utils.dateparse import parse_date
+from django.db.models import Q
+import base64
+
+'''
+    Keyset pagination ordered newest first by a date field and the primary key
+    ---------------------------------------------------------------------------
+    Each page is fetched with an indexed range filter on (date, id) instead of an offset, so the cost of a page
+    does not grow with the number of rows before it. Pagination is opt in with the cursor or page_size query
+    parameters so list endpoints keep returning a plain array to clients that do not ask for pages.
+'''
+class DateKeysetPagination:
+    date_field = 'date'
+    page_size = 50
+    max_page_size = 500
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    invalid_cursor_message = 'Invalid cursor.'
+
+    ''' Determine if the request asked for a paginated response '''
+    def is_requested(self, request):
+        return self.cursor_query_param in request.query_params or self.page_size_query_param in request.query_params
+
+    ''' Return a single page of the queryset starting after the requested cursor '''
+    def paginate_queryset(self, queryset, request):
+        self.request = request
+        page_size = self.get_page_size(request)
+        queryset = queryset.order_by(f'-{self.date_field}', '-pk')
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            date, pk = self.decode_cursor(cursor)
+            queryset = queryset.filter(Q(**{f'{self.date_field}__lt': date}) | Q(**{self.date_field: date, 'pk__lt': pk}))
+        # Fetch one extra row to know if there is a next page without counting
+        page = list(queryset[:page_size + 1])
+        self.next_cursor = None
+        if len(page) > page_size:
+            page = page[:page_size]
+            last = page[-1]
+            self.next_cursor = self.encode_cursor(getattr(last, self.date_field), last.pk)
+        return page
+
+    ''' Return the paginated response with a link to the next page '''
+    def get_paginated_response(self, data):
+        return Response({'next': self.get_next_link(), 'results': data})
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, self.next_cursor)
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def encode_cursor(self, date, pk):
+        return base64.urlsafe_b64encode(f'{date.isoformat()}|{pk}'.encode('ascii')).decode('ascii')
+
+    def decode_cursor(self, cursor):
+        try:
+            date, pk = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('ascii').split('|')
+            date = parse_date(date)
+            pk = int(pk)
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+        if date is None:
+            raise NotFound(self.invalid_cursor_message)
+        return date, pk
+
+'''
+    Page number pagination for ranked results such as search
+    --------------------------------------------------------
+    Ranked results have no stable key to continue after, so pages are fetched with a limit and offset. One extra row is
+    fetched to know if there is a next page without counting the results.
+'''
+class RankedPagination:
+    page_size = 20
+    max_page_size = 100
+    page_query_param = 'page'
+    page_size_query_param = 'page_size'
+
+    ''' Return a single page of the queryset '''
+    def paginate_queryset(self, queryset, request):
+        self.request = request
+        page_size = self.get_page_size(request)
+        self.page_number = self.get_page_number(request)
+        offset = (self.page_number - 1) * page_size
+        page = list(queryset[offset:offset + page_size + 1])
+        self.has_next = len(page) > page_size
+        return page[:page_size]
+
+    ''' Return the paginated response with a link to the next page '''
+    def get_paginated_response(self, data):
+        return Response({'next': self.get_next_link(), 'results': data})
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), self.page_query_param, self.page_number + 1)
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def get_page_number(self, request):
+        try:
+            return max(int(request.query_params.get(self.page_query_param, 1)), 1)
+        except ValueError:
+            return 1
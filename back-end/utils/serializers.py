@@ -0,0 +1,57 @@
+from rest_framework import serializers
+
+'''
+    Serializer mixin to only serialize the fields and nested serializers a client asks for
+    --------------------------------------------------------------------------------------
+    fields: names of the fields to return, all non expandable fields when not given
+    expand: names of the nested serializers listed in Meta.expandable_fields to return
+    When neither is given every field is returned.
+'''
+class DynamicFieldsMixin:
+
+    def __init__(self, *args, fields=None, expand=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is None and expand is None:
+            return
+        allowed = self.get_allowed_fields(self.fields.keys(), fields, expand)
+        for name in list(self.fields):
+            if name not in allowed:
+                self.fields.pop(name)
+
+    ''' Return the names of the fields to serialize for the requested fields and expansions '''
+    @classmethod
+    def get_allowed_fields(cls, field_names, fields=None, expand=None):
+        expandable = set(getattr(cls.Meta, 'expandable_fields', []))
+        if fields is None and expand is None:
+            return set(field_names)
+        allowed = set(fields) if fields else set(field_names) - expandable
+        return allowed | (set(expand or []) & expandable)
+
+    ''' Return the nested serializers that will be serialized, so views only prefetch what is used '''
+    @classmethod
+    def get_expanded_fields(cls, fields=None, expand=None):
+        expandable = getattr(cls.Meta, 'expandable_fields', [])
+        allowed = cls.get_allowed_fields(expandable, fields, expand)
+        return [name for name in expandable if name in allowed]
+
+''' Read a comma separated list of names from a query parameter, returning None when it is not given '''
+def parse_field_list(request, name):
+    value = request.query_params.get(name)
+    if value is None:
+        return None
+    return [field.strip() for field in value.split(',') if field.strip()]
+
+'''
+    Serializer for query parameters that limit results to a range of dates
+    ----------------------------------------------------------------------
+    start_date, end_date: optional bounds of the range, both included
+    Filter serializers with a date range subclass it so the range is checked the same way everywhere.
+'''
+class DateRangeSerializer(serializers.Serializer):
+    start_date = serializers.DateField(required=False)
+    end_date = serializers.DateField(required=False)
+
+    def validate(self, data):
+        if 'start_date' in data and 'end_date' in data and data['start_date'] > data['end_date']:
+            raise serializers.ValidationError({'end_date': 'The end date must not be before the start date.'})
+        return data
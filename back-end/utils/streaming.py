@@ -0,0 +1,20 @@
+from rest_framework.utils.encoders import JSONEncoder
+import json
+import csv
+
+''' File like object that returns each written row instead of buffering it, so csv writer output can be streamed '''
+class Echo:
+    def write(self, value):
+        return value
+
+''' Yield a csv file one row at a time, starting with a header of the column names '''
+def stream_csv(columns, rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(columns)
+    for row in rows:
+        yield writer.writerow([row[column] for column in columns])
+
+''' Yield one json document per row, each on its own line '''
+def stream_ndjson(columns, rows):
+    for row in rows:
+        yield json.dumps({column: row[column] for column in columns}, cls=JSONEncoder) + '\n'
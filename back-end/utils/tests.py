@@ -0,0 +1,61 @@
+from utils.serializers import DateRangeSerializer
+from django.test import SimpleTestCase
+from decimal import Decimal
+from utils import money
+
+''' Tests for money calculations '''
+class TestMoney(SimpleTestCase):
+
+    ''' Test floats are converted without binary rounding errors '''
+    def test_to_decimal(self):
+        self.assertEqual(money.to_decimal(0.1), Decimal('0.1'))
+        self.assertEqual(money.to_decimal(None), Decimal('0'))
+        self.assertEqual(money.to_decimal(3), Decimal('3'))
+
+    ''' Test amounts are rounded half up to whole cents '''
+    def test_round_money(self):
+        self.assertEqual(money.round_money(Decimal('2.675')), Decimal('2.68'))
+        self.assertEqual(money.round_money(Decimal('2.674')), Decimal('2.67'))
+
+    ''' Test a single order is priced exactly and rounded once '''
+    def test_price_order(self):
+        price = money.price_order(hourly_rate=Decimal('120.00'), hours_worked=Decimal('3'), material_cost=Decimal('100.00'), material_upcharge=Decimal('15.00'), line_total=Decimal('55.68'), callout=50.0, tax=Decimal('10.00'), discount=Decimal('5.00'), payment_total=Decimal('100.00'))
+        self.assertEqual(price.labor_total, Decimal('360.00'))
+        self.assertEqual(price.material_total, Decimal('115.00'))
+        self.assertEqual(price.subtotal, Decimal('580.68'))
+        self.assertEqual(price.tax_total, Decimal('58.068'))
+        self.assertEqual(price.discount_total, Decimal('29.034'))
+        self.assertEqual(price.total, Decimal('609.71'))
+        self.assertEqual(price.working_total, Decimal('509.71'))
+        self.assertFalse(price.paid)
+
+    ''' Test overpaid orders have nothing due '''
+    def test_price_order_overpaid(self):
+        price = money.price_order(hourly_rate=75, hours_worked=3, material_cost=None, material_upcharge=15, line_total=None, callout=50.0, tax=0, discount=0, payment_total=Decimal('500'))
+        self.assertEqual(price.total, Decimal('275.00'))
+        self.assertEqual(price.working_total, Decimal('0.00'))
+        self.assertTrue(price.paid)
+
+    ''' Test a batch of order rows is priced in order '''
+    def test_price_orders(self):
+        rows = [
+            {'hourly_rate': Decimal('100'), 'hours_worked': Decimal('4'), 'material_upcharge': Decimal('25'), 'callout': 50.0, 'tax': Decimal('0'), 'discount': Decimal('0')},
+            {'hourly_rate': Decimal('100'), 'hours_worked': Decimal('3'), 'material_cost': Decimal('10'), 'material_upcharge': Decimal('25'), 'callout': 175.0, 'tax': Decimal('10'), 'discount': Decimal('0'), 'payment_total': Decimal('10')},
+        ]
+        prices = money.price_orders(rows)
+        self.assertEqual([price.total for price in prices], [Decimal('450.00'), Decimal('536.25')])
+        self.assertEqual(prices[1].working_total, Decimal('526.25'))
+
+''' Tests for the shared date range serializer '''
+class TestDateRangeSerializer(SimpleTestCase):
+
+    ''' Test a range is valid when either bound is missing or the bounds are in order '''
+    def test_date_range_valid(self):
+        for data in [{}, {'start_date': '2024-01-01'}, {'end_date': '2024-01-01'}, {'start_date': '2024-01-01', 'end_date': '2024-01-01'}]:
+            self.assertTrue(DateRangeSerializer(data=data).is_valid())
+
+    ''' Test an end date before the start date is rejected on the end date '''
+    def test_date_range_reversed(self):
+        serializer = DateRangeSerializer(data={'start_date': '2024-02-01', 'end_date': '2024-01-01'})
+        self.assertFalse(serializer.is_valid())
+        self.assertEqual(serializer.errors['end_date'], ['The end date must not be before the start date.'])